@@ -0,0 +1,526 @@
+# allocation.py
+# Moteur d'allocation : version vectorisée (NumPy) de l'algorithme en trois passes.
+# Ce module ne dépend ni de Flask ni de l'ORM : il travaille sur des tableaux denses
+# phase x intervenant et peut traiter une pile de projets en un seul appel.
+#
+# Conventions des matrices vérif :
+#   NaN -> montant non spécifié (l'intervenant est ajustable / peut servir de tampon)
+#   0   -> intervenant non impliqué dans la phase
+#   > 0 -> montant vérif fixe pour la phase
+from contextlib import nullcontext
+
+import numpy as np
+
+# Tolérance (en %) sur les montants vérif globaux des intervenants
+TOLERANCE_ECART = 5.0
+
+# Méthodes de la troisième passe : 'greedy' (répartition en un passage, par défaut) ou
+# 'solver' (ajustement itératif jusqu'à respecter la tolérance, voir solve_adjustment)
+ALLOCATION_METHODS = ('greedy', 'solver')
+
+# Méthode 'solver' : nombre maximal d'itérations, part de la tolérance visée (la bande
+# visée est un peu plus étroite pour terminer à l'intérieur de la tolérance) et part du
+# montant libre de la phase donnée au départ aux cellules mobiles laissées à zéro
+SOLVER_MAX_ITERATIONS = 1000
+SOLVER_BAND = 0.98
+SOLVER_SEED = 1e-3
+
+# Méthode 'solver' : un projet dont le dépassement des bandes n'a pas diminué d'au moins
+# 0,1% en SOLVER_STALL_ITERATIONS itérations quitte l'ajustement itératif (il stagne) et
+# est tranché par la résolution exacte (flot maximal, voir transport_flow)
+SOLVER_STALL_ITERATIONS = 50
+
+
+def find_buffer_index(names):
+    # L'intervenant 'MB' sert de tampon ; à défaut, le dernier intervenant
+    for index, name in enumerate(names):
+        if name.lower() == 'mb':
+            return index
+    return len(names) - 1 if names else None
+
+
+def build_verif_matrix(phase_ids, intervenant_ids, cells):
+    # Construire la matrice vérif (phases x intervenants) à partir de triplets
+    # (phase_id, intervenant_id, montant_verif) ; les cellules absentes valent NaN
+    phase_index = {phase_id: i for i, phase_id in enumerate(phase_ids)}
+    intervenant_index = {intervenant_id: j for j, intervenant_id in enumerate(intervenant_ids)}
+
+    verif = np.full((len(phase_ids), len(intervenant_ids)), np.nan)
+    for phase_id, intervenant_id, montant_verif in cells:
+        i = phase_index.get(phase_id)
+        j = intervenant_index.get(intervenant_id)
+        if i is not None and j is not None and montant_verif is not None:
+            verif[i, j] = montant_verif
+    return verif
+
+
+def stack_projects(projects):
+    # Empiler plusieurs projets (total_marche, percentages, verif, montant_verif, buffer_index)
+    # dans des tableaux de forme commune ; les cases de bourrage valent 0 ("non impliqué")
+    projects = list(projects)
+    count = len(projects)
+    max_phases = max((len(p[1]) for p in projects), default=0)
+    max_intervenants = max((len(p[3]) for p in projects), default=0)
+
+    total_marche = np.zeros(count)
+    percentages = np.zeros((count, max_phases))
+    verif = np.zeros((count, max_phases, max_intervenants))
+    montant_verif = np.full((count, max_intervenants), np.nan)
+    buffer_index = np.zeros(count, dtype=np.intp)
+    phase_mask = np.zeros((count, max_phases), dtype=bool)
+    intervenant_mask = np.zeros((count, max_intervenants), dtype=bool)
+
+    for k, (marche, phase_percentages, phase_verif, intervenant_verif, buffer) in enumerate(projects):
+        n_phases = len(phase_percentages)
+        n_intervenants = len(intervenant_verif)
+        total_marche[k] = marche
+        percentages[k, :n_phases] = phase_percentages
+        verif[k, :n_phases, :n_intervenants] = phase_verif
+        montant_verif[k, :n_intervenants] = np.asarray(intervenant_verif, dtype=float)
+        buffer_index[k] = buffer
+        phase_mask[k, :n_phases] = True
+        intervenant_mask[k, :n_intervenants] = True
+
+    return total_marche, percentages, verif, montant_verif, buffer_index, phase_mask, intervenant_mask
+
+
+def allocate(total_marche, percentages, verif, montant_verif, buffer_index, tolerance=TOLERANCE_ECART,
+             method='greedy'):
+    # Allocation d'un seul projet : percentages (P,), verif (P, I), montant_verif (I,)
+    final_percent, final_amount, feasible = allocate_batch(
+        np.asarray([total_marche], dtype=float),
+        np.asarray(percentages, dtype=float)[None, :],
+        np.asarray(verif, dtype=float)[None, :, :],
+        np.asarray(montant_verif, dtype=float)[None, :],
+        np.asarray([buffer_index], dtype=np.intp),
+        tolerance=tolerance,
+        method=method,
+    )
+    return final_percent[0], final_amount[0], bool(feasible[0])
+
+
+def _percent_of(amount, base):
+    # amount / base * 100, avec 0 lorsque le montant de la phase est nul
+    return np.divide(amount * 100, base, out=np.zeros(np.broadcast(amount, base).shape),
+                     where=base != 0)
+
+
+def _untimed(name):
+    return nullcontext()
+
+
+def allocate_batch(total_marche, percentages, verif, montant_verif, buffer_index,
+                   phase_mask=None, intervenant_mask=None, tolerance=TOLERANCE_ECART, method='greedy',
+                   timer=_untimed):
+    # Allocation d'une pile de B projets :
+    #   total_marche (B,), percentages (B, P), verif (B, P, I),
+    #   montant_verif (B, I) (NaN si non défini), buffer_index (B,),
+    #   tolerance : écart toléré en %, commun ou propre à chaque projet (B,),
+    #   method : méthode de la troisième passe (ALLOCATION_METHODS), commune ou (B,),
+    #   timer : timer(nom) -> gestionnaire de contexte mesurant chaque passe
+    #           ('allocation_pass1', 'allocation_pass2', 'allocation_pass3')
+    # Retourne (final_percent, final_amount, feasible) : deux tableaux (B, P, I) et un
+    # tableau (B,) vrai lorsque l'allocation rendue respecte toutes les contraintes (voir
+    # valid_allocation). Avec la méthode 'solver', feasible est faux seulement si aucune
+    # allocation valide n'existe (l'allocation gloutonne est alors rendue).
+    # Seules les cellules de pourcentage > 0 correspondent à une allocation à enregistrer.
+    total_marche = np.asarray(total_marche, dtype=float)
+    percentages = np.asarray(percentages, dtype=float)
+    verif = np.asarray(verif, dtype=float)
+    montant_verif = np.asarray(montant_verif, dtype=float)
+    buffer_index = np.asarray(buffer_index, dtype=np.intp)
+    method = np.broadcast_to(np.asarray(method), total_marche.shape)
+    unknown = ~np.isin(method, ALLOCATION_METHODS)
+    if unknown.any():
+        raise ValueError(f"Méthode d'allocation inconnue : '{method[unknown][0]}'")
+
+    phase_amount = total_marche[:, None] * percentages / 100
+    with timer('allocation_pass1'):
+        percent, amount = first_pass(phase_amount, verif, buffer_index)
+        first_amount = amount
+    with timer('allocation_pass2'):
+        has_verif, ecart, ecart_percent = second_pass(amount, montant_verif)
+    with timer('allocation_pass3'):
+        percent, amount = third_pass(percent, amount, phase_amount, verif, buffer_index,
+                                     has_verif, ecart, ecart_percent, tolerance)
+
+        # Méthode 'solver' : repartir du résultat glouton pour les projets concernés
+        tolerance = np.broadcast_to(np.asarray(tolerance, dtype=float), total_marche.shape)
+        solved = np.flatnonzero(method == 'solver')
+        if solved.size:
+            percent[solved], amount[solved], solver_feasible = solve_adjustment(
+                percent[solved], amount[solved], phase_amount[solved], verif[solved],
+                montant_verif[solved], tolerance[solved], fixed_amount=first_amount[solved])
+
+    # Neutraliser les cases de bourrage d'une pile de projets
+    if phase_mask is not None or intervenant_mask is not None:
+        valid = np.ones(percent.shape, dtype=bool)
+        if phase_mask is not None:
+            valid &= np.asarray(phase_mask, dtype=bool)[:, :, None]
+        if intervenant_mask is not None:
+            valid &= np.asarray(intervenant_mask, dtype=bool)[:, None, :]
+        percent = np.where(valid, percent, 0.0)
+        amount = np.where(valid, amount, 0.0)
+
+    feasible = valid_allocation(amount, phase_amount, verif, montant_verif, tolerance)
+    if solved.size:
+        feasible[solved] = solver_feasible
+    return percent, amount, feasible
+
+
+def first_pass(phase_amount, verif, buffer_index):
+    # Première passe : chaque phase est traitée indépendamment des autres, on peut donc
+    # l'appliquer à un sous-ensemble de phases (B, P', I)
+    n_intervenants = verif.shape[2]
+    columns = np.arange(n_intervenants)
+    phase_amount_cells = phase_amount[:, :, None]                     # (B, P, 1)
+
+    adjustable = np.isnan(verif)
+    fixed = verif > 0
+
+    # Montants fixes, dans l'ordre des intervenants et limités au pourcentage restant de la phase
+    fixed_amount = np.where(fixed, verif, 0.0)
+    fixed_percent = _percent_of(fixed_amount, phase_amount_cells)
+    cumul = np.cumsum(fixed_percent, axis=2)
+    capped_cumul = np.minimum(cumul, 100.0)
+    previous_cumul = np.concatenate(
+        [np.zeros(capped_cumul.shape[:2] + (1,)), capped_cumul[:, :, :-1]], axis=2)
+    capped = fixed & (cumul > 100.0)
+
+    percent = np.where(capped, capped_cumul - previous_cumul, fixed_percent)
+    amount = np.where(capped, phase_amount_cells * percent / 100, fixed_amount)
+
+    remaining_percent = 100.0 - capped_cumul[:, :, -1]                 # (B, P)
+    remaining_amount = phase_amount - amount.sum(axis=2)
+
+    # Tampon de la phase : MB, sauf si MB a un montant fixe ; dans ce cas le premier
+    # intervenant ajustable (s'il en existe un)
+    mb_fixed = np.take_along_axis(fixed, np.broadcast_to(buffer_index[:, None, None], fixed.shape[:2] + (1,)),
+                                  axis=2)[:, :, 0]
+    buffer_column = np.where(mb_fixed, np.argmax(adjustable, axis=2), buffer_index[:, None])
+    has_buffer = ~mb_fixed | adjustable.any(axis=2)
+    is_buffer = (columns[None, None, :] == buffer_column[:, :, None]) & has_buffer[:, :, None]
+
+    # Répartir le pourcentage restant équitablement entre les ajustables (hors tampon)
+    shared = adjustable & ~is_buffer
+    shared_count = shared.sum(axis=2)
+    distribute = (shared_count > 0) & (remaining_percent > 0)
+    per_adjustable = np.where(distribute, remaining_percent / np.maximum(shared_count, 1), 0.0)
+    share_cells = shared & distribute[:, :, None]
+    percent = np.where(share_cells, per_adjustable[:, :, None], percent)
+    amount = np.where(share_cells, phase_amount_cells * per_adjustable[:, :, None] / 100, amount)
+
+    # Attribuer le reste au tampon lorsque personne d'autre ne l'a absorbé
+    to_buffer = is_buffer & ((remaining_percent > 0) & ~distribute)[:, :, None]
+    percent = np.where(to_buffer, remaining_percent[:, :, None], percent)
+    amount = np.where(to_buffer, remaining_amount[:, :, None], amount)
+
+    return percent, amount
+
+
+def adjust(percent, amount, phase_amount, verif, montant_verif, buffer_index, tolerance=TOLERANCE_ECART):
+    # Deuxième et troisième passes : elles dépendent des totaux de chaque intervenant
+    # sur toutes les phases et portent donc toujours sur le projet entier
+    has_verif, ecart, ecart_percent = second_pass(amount, montant_verif)
+    return third_pass(percent, amount, phase_amount, verif, buffer_index,
+                      has_verif, ecart, ecart_percent, tolerance)
+
+
+def second_pass(amount, montant_verif):
+    # Deuxième passe : écarts par rapport aux montants vérif globaux
+    # -> (intervenants avec montant vérif, écart, écart en %), tableaux (B, I)
+    has_verif = np.nan_to_num(montant_verif) != 0
+    safe_verif = np.where(has_verif, montant_verif, 1.0)
+    ecart = np.where(has_verif, amount.sum(axis=1) - safe_verif, 0.0)
+    ecart_percent = np.where(has_verif, ecart / safe_verif * 100, 0.0)
+    return has_verif, ecart, ecart_percent
+
+
+def third_pass(percent, amount, phase_amount, verif, buffer_index, has_verif, ecart, ecart_percent,
+               tolerance=TOLERANCE_ECART):
+    # Troisième passe : répartir l'écart des intervenants hors tolérance sur leurs
+    # phases ajustables et transférer la différence au tampon (MB)
+    n_intervenants = verif.shape[2]
+    is_mb = np.arange(n_intervenants)[None, :] == buffer_index[:, None]   # (B, I)
+    adjustable = np.isnan(verif)
+    adjustable_count = adjustable.sum(axis=1)                           # (B, I)
+    tolerance = np.asarray(tolerance, dtype=float)[..., None]          # commune ou (B, 1)
+    needs_adjustment = (has_verif & ~is_mb & (np.abs(ecart_percent) > tolerance)
+                        & (adjustable_count > 0))
+    adjustment = np.where(needs_adjustment, ecart / np.maximum(adjustable_count, 1), 0.0)
+    adjust_cells = adjustable & needs_adjustment[:, None, :]
+
+    new_amount = np.maximum(amount - adjustment[:, None, :], 0.0)
+    new_percent = _percent_of(new_amount, phase_amount[:, :, None])
+    delta_percent = np.where(adjust_cells, percent - new_percent, 0.0).sum(axis=2)
+    delta_amount = np.where(adjust_cells, adjustment[:, None, :], 0.0).sum(axis=2)
+
+    percent = np.where(adjust_cells, new_percent, percent)
+    amount = np.where(adjust_cells, new_amount, amount)
+    percent = percent + is_mb[:, None, :] * delta_percent[:, :, None]
+    amount = amount + is_mb[:, None, :] * delta_amount[:, :, None]
+
+    return percent, amount
+
+
+def solve_adjustment(percent, amount, phase_amount, verif, montant_verif, tolerance=TOLERANCE_ECART,
+                     max_iterations=SOLVER_MAX_ITERATIONS, fixed_amount=None):
+    # Troisième passe de la méthode 'solver'. Problème : trouver des montants >= 0 pour
+    # les cellules mobiles (montant vérif non spécifié, tampon compris) tels que chaque
+    # phase garde son montant et que le total de chaque intervenant ayant un montant vérif
+    # soit dans sa bande de tolérance. Les cellules fixées (vérif > 0) gardent leur montant
+    # de la première passe (fixed_amount ; amount par défaut) : la troisième passe
+    # gloutonne peut avoir modifié celui du tampon. Les cellules nulles (vérif = 0) restent
+    # à 0, même celles du tampon que la première passe a chargées du reste de la phase. Résolu par ajustement
+    # proportionnel itératif (IPF) à partir de l'allocation gloutonne : on ramène chaque
+    # total d'intervenant dans sa bande, puis chaque phase à son montant, jusqu'à ce que
+    # toutes les contraintes soient respectées. Si l'ajustement stagne, un flot maximal
+    # (transport_flow) décide exactement s'il existe une solution et en donne une, que
+    # l'on rapproche ensuite du dernier ajustement (closest_on_segment).
+    # Les projets dont l'allocation gloutonne respecte déjà toutes les contraintes ne sont
+    # pas modifiés. Retourne (percent, amount, feasible (B,)) ; feasible est faux lorsque
+    # aucune allocation respectant les contraintes n'existe (l'allocation gloutonne est
+    # alors conservée).
+    movable = np.isnan(verif)
+    frozen = np.where(movable | (verif == 0), 0.0, amount if fixed_amount is None else fixed_amount)
+    has_verif = np.nan_to_num(montant_verif) != 0
+    safe_verif = np.where(has_verif, montant_verif, 0.0)
+    tolerance = np.asarray(tolerance, dtype=float)[..., None] / 100    # commune ou (B, 1)
+
+    # Contraintes sur la partie mobile : montant de chaque phase, bande de chaque intervenant
+    phase_target = phase_amount - frozen.sum(axis=2)                                  # (B, P)
+    frozen_total = frozen.sum(axis=1)                                                 # (B, I)
+    margin = np.abs(safe_verif) * tolerance
+    low = np.where(has_verif, safe_verif - margin - frozen_total, -np.inf)
+    high = np.where(has_verif, safe_verif + margin - frozen_total, np.inf)
+    aim_low = np.where(has_verif, safe_verif - margin * SOLVER_BAND - frozen_total, -np.inf)
+    aim_high = np.where(has_verif, np.maximum(safe_verif + margin * SOLVER_BAND - frozen_total, 0.0), np.inf)
+    slack = 1e-9 * np.maximum(np.abs(safe_verif), 1.0)
+    phase_slack = 1e-9 * np.maximum(np.abs(phase_amount), 1.0)
+
+    def excess(x):
+        # Dépassement des bandes de tolérance, rapporté aux montants vérif (B,)
+        total = x.sum(axis=1)
+        return (np.maximum(np.maximum(low - total, total - high), 0.0)
+                / np.maximum(np.abs(safe_verif), 1.0)).sum(axis=1)
+
+    def inside(x):
+        total = x.sum(axis=1)
+        return ((total >= low - slack) & (total <= high + slack)).all(axis=1)
+
+    def valid(x):
+        # Contraintes sur la partie mobile x (B,) : montants >= 0, chaque phase à son
+        # montant (avec les cellules figées), chaque intervenant dans sa bande
+        phases = np.abs(x.sum(axis=2) - phase_target) <= phase_slack
+        return inside(x) & (x >= 0).all(axis=(1, 2)) & phases.all(axis=1)
+
+    # Allocation gloutonne déjà valide sur la grille entière, cellules figées comprises :
+    # conservée telle quelle
+    already_valid = (valid_allocation(amount, phase_amount, verif, montant_verif, tolerance[..., 0] * 100)
+                     & (movable | (np.abs(amount - frozen) <= phase_slack[:, :, None])).all(axis=(1, 2)))
+    feasible = already_valid.copy()
+
+    # Projets à résoudre : sans contrainte impossible à l'évidence (bande entièrement
+    # négative, phase dépassée par ses montants fixes, montant requis sans cellule mobile)
+    # (la méthode gloutonne peut laisser un montant négatif au tampon : repartir de 0)
+    x = np.maximum(np.where(movable, amount, 0.0), 0.0)
+    impossible = (((high < -slack) | ((low > slack) & ~movable.any(axis=1))).any(axis=1)
+                  | (phase_target < -phase_slack).any(axis=1)
+                  | ((phase_target > phase_slack) & ~movable.any(axis=2)).any(axis=1))
+    phase_target = np.maximum(phase_target, 0.0)
+    active = ~feasible & ~impossible
+
+    # Départ : les cellules mobiles à zéro reçoivent une petite part du montant libre de
+    # la phase, sans quoi l'ajustement proportionnel ne pourrait pas les faire croître
+    movable_count = movable.sum(axis=2)
+    seed = SOLVER_SEED * np.divide(phase_target, movable_count, out=np.zeros(phase_target.shape),
+                                   where=movable_count > 0)
+    x = np.where(active[:, None, None] & movable, np.maximum(x, seed[:, :, None]), x)
+
+    checkpoint = excess(x)
+    for iteration in range(1, max_iterations + 1):
+        if not active.any():
+            break
+        total = x.sum(axis=1)
+        scale = np.ones(total.shape)
+        np.divide(aim_low, total, out=scale, where=(total < aim_low) & (total > 0))
+        np.divide(aim_high, total, out=scale, where=(total > aim_high) & (total > 0))
+        step = x * scale[:, None, :]
+        phase_total = step.sum(axis=2)
+        step *= np.divide(phase_target, phase_total, out=np.ones(phase_total.shape),
+                          where=phase_total > 0)[:, :, None]
+        x = np.where(active[:, None, None], step, x)
+        converged = active & valid(x)
+        feasible |= converged
+        active &= ~converged
+        if iteration % SOLVER_STALL_ITERATIONS == 0:
+            current = excess(x)
+            active &= current < checkpoint * 0.999
+            checkpoint = current
+
+    # Ajustement sans convergence : résolution exacte, rapprochée du dernier ajustement
+    for k in np.flatnonzero(~feasible & ~impossible):
+        exact = transport_flow(phase_target[k], np.maximum(low[k], 0.0), high[k], movable[k])
+        if exact is None:
+            continue
+        closest = closest_on_segment(exact, x[k], low[k], high[k], phase_target[k], phase_slack[k])
+        x[k] = closest if valid(closest[None])[0] else exact
+        feasible[k] = True
+
+    # Sans solution, l'allocation gloutonne est conservée
+    solved = (feasible & ~already_valid)[:, None, None]
+    amount = np.where(solved, np.where(movable, x, frozen), amount)
+    percent = np.where(solved, _percent_of(amount, phase_amount[:, :, None]), percent)
+    return percent, amount, feasible
+
+
+def transport_flow(phase_target, low, high, movable):
+    # Résolution exacte d'un projet : montants x (P, I) >= 0, non nuls seulement sur les
+    # cellules mobiles, avec x.sum(axis=1) == phase_target (P,) et le total de chaque
+    # intervenant dans [low, high] (I,), high infini sans montant vérif. Flot maximal d'une
+    # source vers un puits : source -> phase (phase_target), phase -> intervenant (cellules
+    # mobiles, sans limite), intervenant -> puits (low, la part obligatoire) et
+    # intervenant -> réserve (high - low) -> puits (somme des phases - somme des low).
+    # Une solution existe si et seulement si le flot sature les phases ; retourne alors x,
+    # sinon None.
+    n_phases, n_intervenants = movable.shape
+    required = phase_target.sum()
+    slack = 1e-9 * max(required, 1.0)
+    if (high < low - slack).any() or low.sum() > required + slack:
+        return None
+    unlimited = required + low.sum() + 1.0
+    source, sink, reserve = 0, 1, 2
+    phase_node = 3 + np.arange(n_phases)
+    intervenant_node = 3 + n_phases + np.arange(n_intervenants)
+    tails, heads, capacities = [], [], []
+    for i in range(n_phases):
+        tails.append(source), heads.append(phase_node[i]), capacities.append(phase_target[i])
+    cells = np.argwhere(movable)
+    for i, j in cells:
+        tails.append(phase_node[i]), heads.append(intervenant_node[j]), capacities.append(unlimited)
+    for j in range(n_intervenants):
+        tails.append(intervenant_node[j]), heads.append(sink), capacities.append(low[j])
+        tails.append(intervenant_node[j]), heads.append(reserve)
+        capacities.append(min(high[j], unlimited) - low[j])
+    tails.append(reserve), heads.append(sink), capacities.append(max(required - low.sum(), 0.0))
+
+    value, flow = max_flow(3 + n_phases + n_intervenants, tails, heads, capacities, source, sink)
+    if value < required - slack:
+        return None
+    x = np.zeros((n_phases, n_intervenants))
+    x[cells[:, 0], cells[:, 1]] = flow[n_phases:n_phases + len(cells)]
+    return x
+
+
+def max_flow(n_nodes, tails, heads, capacities, source, sink):
+    # Flot maximal (algorithme de Dinic) -> (valeur, flot de chaque arc)
+    n_edges = len(tails)
+    head = [0] * (2 * n_edges)
+    residual = [0.0] * (2 * n_edges)
+    edges = [[] for _ in range(n_nodes)]
+    for e, (u, v, capacity) in enumerate(zip(tails, heads, capacities)):
+        head[2 * e], residual[2 * e] = int(v), max(float(capacity), 0.0)
+        head[2 * e + 1] = int(u)
+        edges[int(u)].append(2 * e)
+        edges[int(v)].append(2 * e + 1)
+    eps = 1e-12 * max(sum(residual), 1.0)
+
+    value = 0.0
+    while True:
+        # Graphe de niveaux (parcours en largeur depuis la source)
+        level = [-1] * n_nodes
+        level[source] = 0
+        queue = [source]
+        for u in queue:
+            for e in edges[u]:
+                if residual[e] > eps and level[head[e]] < 0:
+                    level[head[e]] = level[u] + 1
+                    queue.append(head[e])
+        if level[sink] < 0:
+            break
+        # Flot bloquant : chemins augmentants en profondeur, arcs épuisés sautés
+        current = [0] * n_nodes
+        while True:
+            path, u = [], source
+            while u != sink:
+                while current[u] < len(edges[u]):
+                    e = edges[u][current[u]]
+                    if residual[e] > eps and level[head[e]] == level[u] + 1:
+                        break
+                    current[u] += 1
+                if current[u] == len(edges[u]):
+                    if u == source:
+                        break
+                    level[u] = -1     # impasse : retirer le nœud et revenir en arrière
+                    u = head[path.pop() ^ 1]
+                    continue
+                e = edges[u][current[u]]
+                path.append(e)
+                u = head[e]
+            if u != sink:
+                break
+            pushed = min(residual[e] for e in path)
+            for e in path:
+                residual[e] -= pushed
+                residual[e ^ 1] += pushed
+            value += pushed
+    flow = np.array([residual[2 * e + 1] for e in range(n_edges)])
+    return value, flow
+
+
+def closest_on_segment(exact, x, low, high, phase_target, phase_slack):
+    # Point le plus proche de x sur le segment [exact, x] qui reste dans les bandes
+    # (les deux extrémités sont >= 0 et, si x respecte les montants des phases, tout le
+    # segment aussi) : le résultat garde la forme de l'ajustement proportionnel
+    if (np.abs(x.sum(axis=1) - phase_target) > phase_slack).any():
+        return exact
+    start, end = exact.sum(axis=0), x.sum(axis=0)
+    change = end - start
+    limit = np.ones(change.shape)
+    np.divide(high - start, change, out=limit, where=(end > high) & (change > 0))
+    np.divide(low - start, change, out=limit, where=(end < low) & (change < 0))
+    t = np.clip(limit.min(initial=1.0), 0.0, 1.0) * (1 - 1e-9)
+    return exact + t * (x - exact)
+
+
+def valid_allocation(amount, phase_amount, verif, montant_verif, tolerance=TOLERANCE_ECART):
+    # Allocation (B, P, I) respectant toutes les contraintes (B,) : montants >= 0, nuls
+    # pour les intervenants non impliqués (vérif = 0), chaque phase à son montant, total de
+    # chaque intervenant ayant un montant vérif dans la tolérance (en %, commune ou (B,))
+    has_verif = np.nan_to_num(montant_verif) != 0
+    safe_verif = np.where(has_verif, montant_verif, 0.0)
+    margin = np.abs(safe_verif) * np.asarray(tolerance, dtype=float)[..., None] / 100
+    slack = 1e-9 * np.maximum(np.abs(safe_verif), 1.0)
+    phase_slack = 1e-9 * np.maximum(np.abs(phase_amount), 1.0)
+    total = amount.sum(axis=1)
+    return ((amount >= 0).all(axis=(1, 2))
+            & ((verif != 0) | (amount == 0)).all(axis=(1, 2))
+            & (np.abs(amount.sum(axis=2) - phase_amount) <= phase_slack).all(axis=1)
+            & (~has_verif | (np.abs(total - safe_verif) <= margin + slack)).all(axis=1))
+
+
+def intervenant_totals(amount, montant_verif):
+    # Totaux par intervenant d'une pile d'allocations (B, P, I) : montant alloué, écart
+    # et écart en % par rapport au montant vérif global (0 sans montant vérif, comme
+    # les totaux matérialisés de summary.py). Retourne trois tableaux (B, I).
+    total = amount.sum(axis=1)
+    has_verif = np.nan_to_num(montant_verif) != 0
+    safe_verif = np.where(has_verif, montant_verif, 1.0)
+    ecart = np.where(has_verif, total - safe_verif, 0.0)
+    return total, ecart, np.where(has_verif, ecart / safe_verif * 100, 0.0)
+
+
+def diff_allocation(previous_percent, previous_amount, final_percent, final_amount, atol=1e-9):
+    # Comparer l'allocation enregistrée (NaN = pas de ligne) à la nouvelle allocation.
+    # Retourne trois masques (insertions, mises à jour, suppressions) : seules ces
+    # cellules doivent être écrites en base
+    stored = ~np.isnan(previous_percent)
+    allocated = final_percent > 0
+
+    unchanged = (np.isclose(np.nan_to_num(previous_percent), final_percent, rtol=0, atol=atol)
+                 & np.isclose(np.nan_to_num(previous_amount), final_amount, rtol=0, atol=atol))
+
+    inserts = allocated & ~stored
+    updates = allocated & stored & ~unchanged
+    deletes = stored & ~allocated
+    return inserts, updates, deletes
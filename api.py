@@ -0,0 +1,545 @@
+# api.py
+# API JSON versionnée (/api/v1) : mêmes opérations que les pages HTML, sans rendu de
+# templates. Les grilles (vérif, allocation) sont des matrices denses phases x intervenants
+# dans l'ordre de "phase_ids" / "intervenant_ids" ; null = cellule non renseignée.
+import numpy as np
+from flask import Blueprint, abort, current_app, jsonify, request, url_for
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import HTTPException
+
+from allocation import ALLOCATION_METHODS, TOLERANCE_ECART
+from grids import allocation_matrices, dense_values, project_axes, store_grids, verif_matrix, verif_row
+from jobs import job_to_dict
+from locking import RETRY_ATTEMPTS, ConflictError, lock_project, run_with_retry
+from models import db, Project, Phase, Intervenant, PhaseIntervenantVerif, Job
+from pagecache import bump_version
+from scenarios import MAX_SCENARIOS, evaluate_scenarios, project_inputs
+from services import PERCENT_TOLERANCE, PROJECT_SORTS, PROJECTS_PER_PAGE, MAX_PROJECTS_PER_PAGE, \
+    allocation_totals, get_project_or_404, list_projects, recalculate_allocation, save_verif_cell, save_verif_grid
+from summary import get_summary, refresh_summary
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    # Erreurs au format JSON pour les clients de l'API
+    return jsonify(error=error.description), error.code
+
+
+@api.errorhandler(ConflictError)
+def api_conflict(error):
+    # Version envoyée obsolète : le client doit relire le projet
+    db.session.rollback()
+    return jsonify(error=str(error)), 409
+
+
+# -- Lecture et validation des données envoyées ------------------
+
+def json_body():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, "Le corps de la requête doit être un objet JSON")
+    return data
+
+
+def number(value, field, optional=False):
+    if value is None and optional:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        abort(400, f"'{field}' doit être un nombre")
+    return float(value)
+
+
+def text(value, field):
+    if not isinstance(value, str) or not value.strip():
+        abort(400, f"'{field}' est obligatoire")
+    return value.strip()
+
+
+def expected_version(data):
+    # Verrouillage optimiste : version du projet lue par le client ("version", facultatif)
+    version = data.get('version')
+    if version is not None and (isinstance(version, bool) or not isinstance(version, int)):
+        abort(400, "'version' doit être un entier")
+    return version
+
+
+def retry_attempts(version):
+    # Avec une version, un conflit est signalé au client (409) ; sans version, la
+    # dernière écriture l'emporte et la requête est rejouée sur les données à jour
+    return 1 if version is not None else RETRY_ATTEMPTS
+
+
+def check_percentages(percentages):
+    # Même règle que la page d'édition des phases : la somme doit faire 100%
+    total = sum(percentages)
+    if abs(total - 100.0) > PERCENT_TOLERANCE:
+        abort(400, f"La somme des pourcentages doit être égale à 100% (actuellement {total:.2f}%)")
+
+
+def parse_grid(grid, n_phases, n_intervenants, field='grid'):
+    # Matrice dense phases x intervenants -> liste de lignes de nombres ou None
+    if (not isinstance(grid, list) or len(grid) != n_phases
+            or any(not isinstance(row, list) or len(row) != n_intervenants for row in grid)):
+        abort(400, f"'{field}' doit être une matrice {n_phases} x {n_intervenants}")
+    return [[number(value, field, optional=True) for value in row] for row in grid]
+
+
+# -- Sérialisation -----------------------------------------------
+
+def requested_fields():
+    # Sélection de champs : ?fields=id,name,total_marche
+    fields = request.args.get('fields', '')
+    return {field.strip() for field in fields.split(',') if field.strip()}
+
+
+def select_fields(data, fields):
+    if not fields:
+        return data
+    return {key: value for key, value in data.items() if key in fields}
+
+
+def project_to_dict(project, summary):
+    return {
+        'id': project.id,
+        'name': project.name,
+        'total_marche': project.total_marche,
+        'version': project.version,
+        'updated_at': project.updated_at.isoformat() if project.updated_at else None,
+        'phases_total_percent': summary.phases_total_percent,
+        'intervenants_total_verif': summary.intervenants_total_verif,
+        'allocation_total_amount': summary.allocation_total_amount,
+        'calculated_at': summary.calculated_at.isoformat() if summary.calculated_at else None,
+        'phases': [
+            {'id': phase.id, 'name': phase.name, 'percentage': phase.percentage}
+            for phase in project.phases
+        ],
+        'intervenants': [
+            {'id': intervenant.id, 'name': intervenant.name, 'montant_verif': intervenant.montant_verif}
+            for intervenant in project.intervenants
+        ],
+    }
+
+
+def project_response(project_id, status=200):
+    # Relire le projet après un commit pour renvoyer son état à jour
+    project = get_project_or_404(project_id)
+    data = project_to_dict(project, get_summary(project))
+    return jsonify(select_fields(data, requested_fields())), status
+
+
+def grid_axes(project):
+    return {
+        'phase_ids': [phase.id for phase in project.phases],
+        'intervenant_ids': [intervenant.id for intervenant in project.intervenants],
+    }
+
+
+# -- Projets -----------------------------------------------------
+
+@api.get('/projects')
+def projects_list():
+    sort = request.args.get('sort', 'id')
+    if sort not in PROJECT_SORTS:
+        abort(400, f"Tri inconnu '{sort}' (valeurs possibles : {', '.join(PROJECT_SORTS)})")
+    limit = min(max(request.args.get('limit', PROJECTS_PER_PAGE, type=int), 1), MAX_PROJECTS_PER_PAGE)
+
+    projects, next_cursor = list_projects(search=request.args.get('q', '').strip(),
+                                          sort=sort,
+                                          descending=request.args.get('order') == 'desc',
+                                          limit=limit,
+                                          min_total=request.args.get('min_total', type=float),
+                                          max_total=request.args.get('max_total', type=float),
+                                          after=request.args.get('after'))
+    fields = requested_fields()
+    return jsonify(projects=[select_fields(row._asdict(), fields) for row in projects],
+                   next=next_cursor)
+
+
+@api.post('/projects')
+def projects_create():
+    # Création d'un projet complet en une requête : phases, intervenants, grille vérif
+    # (facultative) et calcul de l'allocation (facultatif, "calculate": true)
+    data = json_body()
+    phases = data.get('phases') or []
+    intervenants = data.get('intervenants') or []
+    if not isinstance(phases, list) or not isinstance(intervenants, list):
+        abort(400, "'phases' et 'intervenants' doivent être des listes")
+
+    project = Project(name=text(data.get('name'), 'name'),
+                      total_marche=number(data.get('total_marche'), 'total_marche'))
+    project.phases = [
+        Phase(name=text(phase.get('name'), 'phases.name'),
+              percentage=number(phase.get('percentage'), 'phases.percentage'))
+        for phase in phases if isinstance(phase, dict)
+    ]
+    project.intervenants = [
+        Intervenant(name=text(intervenant.get('name'), 'intervenants.name'),
+                    montant_verif=number(intervenant.get('montant_verif'), 'intervenants.montant_verif'))
+        for intervenant in intervenants if isinstance(intervenant, dict)
+    ]
+    if len(project.phases) != len(phases) or len(project.intervenants) != len(intervenants):
+        abort(400, "Chaque phase et chaque intervenant doit être un objet JSON")
+    if phases:
+        check_percentages([phase.percentage for phase in project.phases])
+
+    grid = None
+    if data.get('verif') is not None:
+        grid = parse_grid(data['verif'], len(phases), len(intervenants), 'verif')
+
+    db.session.add(project)
+    db.session.flush()
+    if grid is not None:
+        rows = [
+            {'project_id': project.id, 'phase_id': phase.id,
+             'intervenant_id': intervenant.id, 'montant_verif': grid[i][j]}
+            for i, phase in enumerate(project.phases)
+            for j, intervenant in enumerate(project.intervenants)
+            if grid[i][j] is not None
+        ]
+        if rows:
+            db.session.execute(db.insert(PhaseIntervenantVerif), rows)
+            store_grids('verif', {project.id: (*project_axes(project), np.array([grid], dtype=float))})
+
+    if data.get('calculate') and project.phases and project.intervenants:
+        recalculate_allocation(project)
+    else:
+        refresh_summary(project)
+    db.session.commit()
+
+    return project_response(project.id, 201)
+
+
+@api.get('/projects/<int:project_id>')
+def project_get(project_id):
+    return project_response(project_id)
+
+
+@api.patch('/projects/<int:project_id>')
+def project_update(project_id):
+    project = Project.query.get_or_404(project_id)
+    data = json_body()
+    if 'name' in data:
+        project.name = text(data['name'], 'name')
+    if 'total_marche' in data:
+        project.total_marche = number(data['total_marche'], 'total_marche')
+    refresh_summary(project)
+    bump_version(project.id)
+    db.session.commit()
+    return project_response(project_id)
+
+
+# -- Phases et intervenants --------------------------------------
+
+@api.post('/projects/<int:project_id>/phases')
+def phase_add(project_id):
+    project = Project.query.get_or_404(project_id)
+    data = json_body()
+    phase = Phase(name=text(data.get('name'), 'name'),
+                  percentage=number(data.get('percentage'), 'percentage'),
+                  project_id=project.id)
+    db.session.add(phase)
+    refresh_summary(project)
+    bump_version(project.id)
+    db.session.commit()
+    return jsonify(id=phase.id, name=phase.name, percentage=phase.percentage), 201
+
+
+@api.patch('/projects/<int:project_id>/phases')
+def phases_update(project_id):
+    # Modifier les pourcentages : {"percentages": {"<phase_id>": 40, ...}, "version": 3}
+    data = json_body()
+    percentages = data.get('percentages')
+    if not isinstance(percentages, dict):
+        abort(400, "'percentages' doit être un objet {phase_id: pourcentage}")
+    version = expected_version(data)
+
+    def update():
+        project = get_project_or_404(project_id, selectinload(Project.phases))
+        lock_project(project, version)
+        phases = {str(phase.id): phase for phase in project.phases}
+        for phase_id, percentage in percentages.items():
+            if str(phase_id) not in phases:
+                abort(400, f"Phase {phase_id} inconnue pour ce projet")
+            phases[str(phase_id)].percentage = number(percentage, f"percentages.{phase_id}")
+        check_percentages([phase.percentage for phase in project.phases])
+        refresh_summary(project)
+        db.session.commit()
+
+    run_with_retry(update, attempts=retry_attempts(version))
+    return project_response(project_id)
+
+
+@api.post('/projects/<int:project_id>/intervenants')
+def intervenant_add(project_id):
+    project = Project.query.get_or_404(project_id)
+    data = json_body()
+    intervenant = Intervenant(name=text(data.get('name'), 'name'),
+                              montant_verif=number(data.get('montant_verif'), 'montant_verif'),
+                              project_id=project.id)
+    db.session.add(intervenant)
+    refresh_summary(project)
+    bump_version(project.id)
+    db.session.commit()
+    return jsonify(id=intervenant.id, name=intervenant.name, montant_verif=intervenant.montant_verif), 201
+
+
+# -- Grille vérif ------------------------------------------------
+
+def verif_response(project):
+    return jsonify(**grid_axes(project), grid=dense_values(verif_matrix(project)))
+
+
+@api.get('/projects/<int:project_id>/verif')
+def verif_get(project_id):
+    project = get_project_or_404(project_id, selectinload(Project.phases),
+                                 selectinload(Project.intervenants))
+    return verif_response(project)
+
+
+@api.put('/projects/<int:project_id>/verif')
+def verif_put(project_id):
+    # Remplacer la grille vérif ; seules les cellules modifiées sont écrites
+    data = json_body()
+    version = expected_version(data)
+
+    def save():
+        project = get_project_or_404(project_id, selectinload(Project.phases),
+                                     selectinload(Project.intervenants))
+        grid = parse_grid(data.get('grid'), len(project.phases), len(project.intervenants))
+        submitted = {
+            (phase.id, intervenant.id): grid[i][j]
+            for i, phase in enumerate(project.phases)
+            for j, intervenant in enumerate(project.intervenants)
+        }
+        lock_project(project, version)
+        if save_verif_grid(project, submitted):
+            refresh_summary(project)
+            db.session.commit()
+        else:
+            # Aucune cellule modifiée : la version reste inchangée
+            db.session.rollback()
+        return project
+
+    return verif_response(run_with_retry(save, attempts=retry_attempts(version)))
+
+
+@api.patch('/projects/<int:project_id>/verif/<int:phase_id>/<int:intervenant_id>')
+def verif_cell_patch(project_id, phase_id, intervenant_id):
+    # Modifier une seule cellule : {"montant_verif": 1200 (null = non spécifié),
+    # "version": 3, "recalculate": true}. Réponse : ligne de la phase, total vérif de
+    # l'intervenant et, avec recalculate, ligne et totaux de l'allocation recalculée.
+    data = json_body()
+    if 'montant_verif' not in data:
+        abort(400, "'montant_verif' est obligatoire")
+    montant_verif = number(data['montant_verif'], 'montant_verif', optional=True)
+    recalculate = data.get('recalculate', False)
+    if not isinstance(recalculate, bool):
+        abort(400, "'recalculate' doit être un booléen")
+    version = expected_version(data)
+
+    def save():
+        project = get_project_or_404(project_id)
+        phase_ids, intervenant_ids = project_axes(project)
+        if phase_id not in phase_ids or intervenant_id not in intervenant_ids:
+            abort(404, "Cellule inconnue pour ce projet")
+        intervenant = project.intervenants[intervenant_ids.index(intervenant_id)]
+        total_verif = intervenant.summary.total_verif_detail if intervenant.summary is not None else 0.0
+        lock_project(project, version)
+        update = save_verif_cell(project, phase_id, intervenant_id, montant_verif, recalculate=recalculate)
+        if update is None:
+            db.session.rollback()
+            return project, total_verif, None
+        db.session.commit()
+        return (project, *update)
+
+    project, total_verif, allocation = run_with_retry(save, attempts=retry_attempts(version))
+    intervenant = next(item for item in project.intervenants if item.id == intervenant_id)
+    ecart = total_verif - intervenant.montant_verif if intervenant.montant_verif else 0.0
+    response = {
+        'version': project.version,
+        'phase_id': phase_id,
+        'intervenant_ids': [item.id for item in project.intervenants],
+        'row': dense_values(verif_row(project, phase_id)[None])[0],
+        'total': {
+            'intervenant_id': intervenant_id,
+            'total_verif': total_verif,
+            'verif': intervenant.montant_verif,
+            'ecart': ecart,
+            'ecart_percent': ecart / intervenant.montant_verif * 100 if intervenant.montant_verif else 0.0,
+        },
+        'allocation': None,
+    }
+    if allocation is not None:
+        percent, amount = allocation
+        i = [phase.id for phase in project.phases].index(phase_id)
+        totals, ecarts, ecart_percents = allocation_totals(project, amount)
+        response['allocation'] = {
+            'percent': percent[i].tolist(),
+            'amount': amount[i].tolist(),
+            'totals': [{'intervenant_id': item.id, 'amount': float(totals[j]), 'verif': item.montant_verif,
+                        'ecart': float(ecarts[j]), 'ecart_percent': float(ecart_percents[j])}
+                       for j, item in enumerate(project.intervenants)],
+            'outside_tolerance': [item.id for item, ecart_percent in zip(project.intervenants, ecart_percents)
+                                  if abs(ecart_percent) > TOLERANCE_ECART],
+        }
+    return jsonify(response)
+
+
+# -- Allocation --------------------------------------------------
+
+def allocation_method(value, field='method'):
+    if value is None:
+        return current_app.config.get('ALLOCATION_METHOD', 'greedy')
+    if value not in ALLOCATION_METHODS:
+        abort(400, f"'{field}' doit valoir {' ou '.join(repr(method) for method in ALLOCATION_METHODS)}")
+    return value
+
+
+def allocation_response(project, status=200):
+    percent, amount = allocation_matrices(project)
+    summary = get_summary(project)
+    totals = [
+        {
+            'intervenant_id': intervenant.id,
+            'amount': intervenant.summary.total_amount if intervenant.summary else 0.0,
+            'verif': intervenant.montant_verif,
+            'ecart': intervenant.summary.ecart if intervenant.summary else 0.0,
+        }
+        for intervenant in project.intervenants
+    ]
+    # Intervenants dont l'écart dépasse la tolérance. feasible : le dernier calcul respecte
+    # toutes les contraintes (montants positifs, non impliqués à 0, phases, tolérance) ;
+    # avec la méthode 'solver', faux signifie qu'aucune allocation valide n'existe et que
+    # l'allocation gloutonne a été conservée. None si le projet n'a jamais été calculé.
+    outside = [total['intervenant_id'] for total in totals
+               if total['verif'] and abs(total['ecart'] / total['verif']) * 100 > TOLERANCE_ECART]
+    return jsonify(**grid_axes(project),
+                   percent=dense_values(percent),
+                   amount=dense_values(amount),
+                   totals=totals,
+                   outside_tolerance=outside,
+                   feasible=summary.allocation_feasible,
+                   calculated_at=summary.calculated_at.isoformat() if summary.calculated_at else None), status
+
+
+@api.get('/projects/<int:project_id>/allocation')
+def allocation_get(project_id):
+    return allocation_response(get_project_or_404(project_id))
+
+
+@api.post('/projects/<int:project_id>/allocation')
+def allocation_calculate(project_id):
+    # {"method": "solver"} (facultatif) : méthode de la troisième passe
+    method = allocation_method((request.get_json(silent=True) or {}).get('method'))
+
+    def recalculate():
+        # Relu à chaque tentative : un recalcul concurrent est rejoué sur les données à jour
+        project = get_project_or_404(project_id)
+        if not project.phases or not project.intervenants:
+            abort(409, "Le projet doit avoir des phases et des intervenants pour calculer l'allocation")
+        recalculate_allocation(project, method)
+        db.session.commit()
+
+    run_with_retry(recalculate)
+    return allocation_response(get_project_or_404(project_id))
+
+
+# -- Variantes de l'allocation (sans écriture) ------------------
+
+def item_index(items, item_id, field):
+    # Position d'une phase ou d'un intervenant du projet à partir de son identifiant
+    for k, item in enumerate(items):
+        if str(item.id) == str(item_id):
+            return k
+    abort(400, f"'{field}' : identifiant {item_id} inconnu pour ce projet")
+
+
+def parse_overrides(values, items, field):
+    # {"<id>": valeur} -> {position: valeur}
+    if not isinstance(values, dict):
+        abort(400, f"'{field}' doit être un objet {{id: valeur}}")
+    return {item_index(items, item_id, field): value for item_id, value in values.items()}
+
+
+def parse_variant(data, project, baseline, position):
+    # Variante : seules les clés fournies remplacent les paramètres actuels du projet
+    field = f"variants[{position}]"
+    if not isinstance(data, dict):
+        abort(400, f"'{field}' doit être un objet")
+    variant = {'name': str(data.get('name') or f"variante {position + 1}")}
+    if 'total_marche' in data:
+        variant['total_marche'] = number(data['total_marche'], f"{field}.total_marche")
+    if 'tolerance' in data:
+        variant['tolerance'] = number(data['tolerance'], f"{field}.tolerance")
+        if variant['tolerance'] < 0:
+            abort(400, f"'{field}.tolerance' doit être positive")
+    if 'method' in data:
+        variant['method'] = allocation_method(data['method'], f"{field}.method")
+    if 'buffer' in data:
+        # Intervenant tampon, par son identifiant
+        variant['buffer_index'] = item_index(project.intervenants, data['buffer'], f"{field}.buffer")
+    if 'percentages' in data:
+        percentages = baseline['percentages'].copy()
+        for i, value in parse_overrides(data['percentages'], project.phases, f"{field}.percentages").items():
+            percentages[i] = number(value, f"{field}.percentages")
+        check_percentages(percentages.tolist())
+        variant['percentages'] = percentages
+    if 'montant_verif' in data:
+        montant_verif = baseline['montant_verif'].copy()
+        for j, value in parse_overrides(data['montant_verif'], project.intervenants,
+                                        f"{field}.montant_verif").items():
+            value = number(value, f"{field}.montant_verif", optional=True)
+            montant_verif[j] = np.nan if value is None else value
+        variant['montant_verif'] = montant_verif
+    if 'grid' in data:
+        grid = parse_grid(data['grid'], len(project.phases), len(project.intervenants), f"{field}.grid")
+        variant['verif'] = np.array(grid, dtype=float).reshape(baseline['verif'].shape)
+    return variant
+
+
+@api.post('/projects/<int:project_id>/scenarios')
+def scenarios_evaluate(project_id):
+    # Comparer des variantes de l'allocation sans rien enregistrer :
+    # {"variants": [{"name": "tampon BET", "buffer": 12, "tolerance": 3, "method": "solver",
+    #                "percentages": {"<phase_id>": 40}, "montant_verif": {"<intervenant_id>": 1000},
+    #                "grid": [[...]], "total_marche": 1200000}, ...]}
+    # La situation actuelle est renvoyée en premier ; ?grids=1 ajoute les grilles calculées.
+    data = json_body()
+    variants = data.get('variants')
+    if not isinstance(variants, list):
+        abort(400, "'variants' doit être une liste")
+    if len(variants) > MAX_SCENARIOS:
+        abort(400, f"{MAX_SCENARIOS} variantes au plus par requête")
+
+    project = get_project_or_404(project_id, selectinload(Project.phases),
+                                 selectinload(Project.intervenants))
+    if not project.phases or not project.intervenants:
+        abort(409, "Le projet doit avoir des phases et des intervenants pour calculer l'allocation")
+    baseline = project_inputs(project, allocation_method(None))
+    variants = [parse_variant(variant, project, baseline, position)
+                for position, variant in enumerate(variants)]
+    return jsonify(**grid_axes(project),
+                   scenarios=evaluate_scenarios(project, baseline, variants,
+                                                include_grids=request.args.get('grids') == '1'))
+
+
+# -- Tâches de recalcul en arrière-plan ----------------------------
+
+@api.post('/jobs')
+def job_submit():
+    # {"project_id": 12} pour un projet, {} pour recalculer tous les projets
+    data = request.get_json(silent=True) or {}
+    project_id = data.get('project_id')
+    if project_id is not None:
+        if isinstance(project_id, bool) or not isinstance(project_id, int):
+            abort(400, "'project_id' doit être un entier")
+        Project.query.get_or_404(project_id)
+    job = current_app.extensions['job_runner'].submit(project_id)
+    return jsonify(job_to_dict(job)), 202, {'Location': url_for('api.job_get', job_id=job.id)}
+
+
+@api.get('/jobs/<int:job_id>')
+def job_get(job_id):
+    return jsonify(job_to_dict(Job.query.get_or_404(job_id)))
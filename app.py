@@ -1,15 +1,73 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, flash
+import os
+import time
+from datetime import timezone
+from zoneinfo import ZoneInfo
 
-from models import db, Project, Phase, Intervenant, PhaseIntervenant, PhaseIntervenantVerif
+import click
+import numpy as np
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, flash, jsonify, \
+    stream_with_context
+from sqlalchemy.orm import selectinload
+
+from allocation import TOLERANCE_ECART, allocate, find_buffer_index, first_pass, valid_allocation
+from api import api
+from assets import Assets, build_assets, vendor_assets
+from compression import ENCODINGS, init_compression
+from database import database_config, init_database
+from exporter import EXPORT_FORMATS, check_format, export_chunks, export_stream
+from grids import GRID_STORAGES, allocation_cells, pack_projects, verif_cells, verif_row_cells
+from importer import IMPORT_CHUNK_SIZE, import_projects
+from instrumentation import Instrumentation, add_timers
+from jobs import JOB_CHUNK_SIZE, JobRunner, job_to_dict, recalculate_in_pool
+from models import db, Project, Phase, Intervenant, PhaseIntervenant, PhaseIntervenantVerif, Job
+from locking import ConflictError, lock_project
+from migrations import upgrade
+from pagecache import PageCache, bump_version, cached_project_page
+from querycount import PAGE_QUERY_BUDGETS, count_queries, explain_query_plan, full_scans
+from services import PERCENT_TOLERANCE, PROJECT_SORTS, PROJECTS_PER_PAGE, MAX_PROJECTS_PER_PAGE, \
+    allocation_totals, get_project_or_404, list_projects, save_verif_cell, save_verif_grid
+from summary import get_summary, intervenant_summaries, refresh_missing_summaries, refresh_summary
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'  
+app.config.update(database_config())  # DATABASE_URL et DB_POOL_* (voir database.py)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'votre_clé_secrète'  # Nécessaire pour flash messages
+app.config['SQLITE_JOURNAL_MODE'] = 'WAL'  # Lectures non bloquées par les écritures
+app.config['SQLITE_BUSY_TIMEOUT'] = 5000  # Attente (ms) d'un verrou d'écriture
+app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'
+app.config['PAGE_CACHE_MAX_ENTRIES'] = 256  # Pages de projet gardées en mémoire
+app.config['PAGE_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+app.config['JOB_WORKERS'] = None  # Processus de recalcul en arrière-plan (None = un par cœur)
+app.config['JOB_AUTOSTART'] = True  # False : tâches laissées en attente pour 'flask run-jobs'
+app.config['ALLOCATION_METHOD'] = os.environ.get('ALLOCATION_METHOD', 'greedy')  # 'solver' : ajustement jusqu'à ±5%
+app.config['GRID_STORAGE'] = os.environ.get('GRID_STORAGE', 'rows')  # 'packed' : grilles aussi stockées en bloc
+if app.config['GRID_STORAGE'] not in GRID_STORAGES:
+    raise ValueError(f"GRID_STORAGE doit valoir {' ou '.join(GRID_STORAGES)}")
+app.config['INSTRUMENTATION'] = os.environ.get('INSTRUMENTATION') == '1'  # Server-Timing, journal, /_metrics
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR')  # Profils cProfile des routes d'allocation (?profile=1)
+app.config['COMPRESSION'] = os.environ.get('COMPRESSION') != '0'  # Réponses compressées (brotli ou gzip)
+app.config['DISPLAY_TIMEZONE'] = os.environ.get('DISPLAY_TIMEZONE', 'Europe/Paris')  # Heures affichées (stockées en UTC)
+
+# Initialiser l'instance de db avec l'application (pool de connexions, pragmas SQLite)
+init_database(app)
+
+# Mesures par requête (SQL, rendu, allocation), désactivées par défaut
+instrumentation = Instrumentation(app)
+
+# Compression des réponses et fichiers statiques construits (voir compression.py et assets.py)
+init_compression(app)
+assets = Assets(app)
 
-# Initialiser l'instance de db avec l'application
-db.init_app(app)
+# API JSON (/api/v1), réponses sans indentation même en mode debug
+app.register_blueprint(api)
+app.json.compact = True
+
+# Cache des pages de lecture des projets (invalidé par la version du projet)
+page_cache = PageCache(app.config['PAGE_CACHE_MAX_ENTRIES'], app.config['PAGE_CACHE_MAX_BYTES'])
+
+# Recalculs d'allocation en arrière-plan (pool de processus)
+job_runner = JobRunner(app, workers=app.config['JOB_WORKERS'])
 
 # Fonction pour créer les tables
 @app.cli.command("init-db")
@@ -18,13 +76,373 @@ def create_tables():
         db.create_all()
         print("Base de données initialisée !")
 
+# Importer des projets depuis un fichier CSV ou XLSX (voir importer.py pour le format)
+@app.cli.command("import-projects")
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=IMPORT_CHUNK_SIZE, show_default=True,
+              help="Nombre de projets insérés par transaction")
+def import_projects_command(path, chunk_size):
+    with app.app_context():
+        with open(path, 'rb') as stream:
+            try:
+                report = import_projects(stream, path, chunk_size=chunk_size)
+            except ValueError as error:
+                raise click.ClickException(str(error))
+        for error in report.errors:
+            print(error)
+        print(f"{report.projects} projet(s) importé(s) : {report.phases} phase(s), "
+              f"{report.intervenants} intervenant(s), {report.verifs} montant(s) vérif")
+        if report.skipped:
+            print(f"{report.skipped} projet(s) ignoré(s) ({report.error_count} erreur(s))")
+            raise SystemExit(1)
+
+# Exporter les allocations (un projet, une sélection ou toute la base)
+@app.cli.command("export-allocations")
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)),
+              help="Format du fichier (par défaut : extension du fichier)")
+@click.option('--project', 'project_id', type=int, help="Identifiant d'un projet")
+@click.option('--q', 'search', default='', help="Filtre sur le nom des projets")
+@click.option('--min-total', type=float, help="Total marché minimal")
+@click.option('--max-total', type=float, help="Total marché maximal")
+def export_allocations_command(path, export_format, project_id, search, min_total, max_total):
+    export_format = export_format or path.rpartition('.')[2].lower()
+    with app.app_context():
+        try:
+            blocks = export_stream(export_format, export_chunks(project_id, search, min_total, max_total))
+        except ValueError as error:
+            raise click.ClickException(str(error))
+        with open(path, 'wb') as output:
+            for block in blocks:
+                output.write(block.encode('utf-8') if isinstance(block, str) else block)
+        print(f"Allocations exportées dans {path}")
+
+# Recalculer l'allocation de tous les projets (clôture mensuelle, changement de règle)
+@app.cli.command("allocate-all")
+@click.option('--workers', type=int, default=os.cpu_count() or 1, show_default=True,
+              help="Nombre de processus de calcul")
+@click.option('--chunk-size', default=JOB_CHUNK_SIZE, show_default=True,
+              help="Projets calculés et enregistrés par transaction")
+@click.option('--dry-run', is_flag=True, help="Calculer sans rien enregistrer")
+def allocate_all(workers, chunk_size, dry_run):
+    with app.app_context():
+        project_ids = db.session.scalars(db.select(Project.id).order_by(Project.id)).all()
+    
+    start = time.perf_counter()
+    done = skipped = failed = 0
+    timers = {}
+    with click.progressbar(length=len(project_ids), label="Calcul des allocations") as progress:
+        for chunk_done, chunk_skipped, chunk_failed, errors, chunk_timers in recalculate_in_pool(
+                app, project_ids, max(workers, 1), max(chunk_size, 1), dry_run=dry_run):
+            add_timers(timers, chunk_timers)
+            done += chunk_done
+            skipped += chunk_skipped
+            failed += chunk_failed
+            progress.update(chunk_done + chunk_skipped + chunk_failed)
+            for error in errors:
+                click.echo(error, err=True)
+    elapsed = time.perf_counter() - start
+    
+    action = "calculé(s) (dry-run, rien n'est enregistré)" if dry_run else "recalculé(s)"
+    print(f"{done} projet(s) {action}, {skipped} ignoré(s) (sans phases ou intervenants), {failed} en erreur")
+    print(f"{elapsed:.2f} s, {done / elapsed if elapsed else 0:.1f} projets/s "
+          f"({workers} processus, paquets de {chunk_size})")
+    # Durées cumulées sur tous les processus
+    print("Passes du moteur : " + ", ".join(f"{name} {duration:.3f} s" for name, duration in sorted(timers.items())))
+    if failed:
+        raise SystemExit(1)
+
+# Exécuter les tâches de recalcul restées en attente (serveur arrêté avant leur exécution)
+@app.cli.command("run-jobs")
+def run_jobs():
+    with app.app_context():
+        for job in job_runner.run_pending():
+            print(f"Tâche {job.id} : {job.status} ({job.done} recalculé(s), {job.skipped} ignoré(s), "
+                  f"{job.failed} en erreur)")
+
+# Mettre à niveau une base existante (index et contraintes ajoutés depuis sa création)
+@app.cli.command("migrate-db")
+def migrate_tables():
+    with app.app_context():
+        changes = upgrade(db.engine)
+        for change in changes:
+            print(f"Ajouté : {change}")
+        created = refresh_missing_summaries()
+        if created:
+            print(f"Ajouté : totaux de {created} projet(s)")
+        print("Base de données à jour !")
+
+# Créer (ou refaire) les blocs des grilles de tous les projets, avant de passer au mode
+# GRID_STORAGE = 'packed' (voir grids.py)
+@app.cli.command("pack-grids")
+@click.option('--chunk-size', default=500, show_default=True, help="Nombre de projets traités par transaction")
+def pack_grids_command(chunk_size):
+    with app.app_context():
+        db.create_all()
+        last_id = 0
+        packed = 0
+        while True:
+            projects = Project.query.options(
+                selectinload(Project.phases), selectinload(Project.intervenants)
+            ).filter(Project.id > last_id).order_by(Project.id).limit(chunk_size).all()
+            if not projects:
+                break
+            pack_projects(projects)
+            db.session.commit()
+            packed += len(projects)
+            last_id = projects[-1].id
+        print(f"Grilles de {packed} projet(s) enregistrées en bloc")
+        if app.config['GRID_STORAGE'] != 'packed':
+            print("Mode actuel : GRID_STORAGE=rows (les blocs ne seront lus et tenus à jour qu'avec "
+                  "GRID_STORAGE=packed)")
+
+# Télécharger Bootstrap dans static/vendor/ (machine connectée ; fichiers à versionner)
+@app.cli.command("vendor-assets")
+def vendor_assets_command():
+    for path, size, digest in vendor_assets(app.static_folder):
+        print(f"{path} : {size} octets, sha256 {digest}")
+    print("Lancer 'flask build-assets' pour construire les fichiers")
+
+# Construire static/dist/ : fichiers nommés par l'empreinte de leur contenu et leurs
+# variantes précompressées (pris en compte au prochain démarrage du service). Échoue si
+# Bootstrap n'est pas téléchargé : les pages construites ne doivent pas dépendre du CDN.
+@app.cli.command("build-assets")
+def build_assets_command():
+    missing = assets.vendor_missing()
+    if missing:
+        print(f"Fichiers tiers non téléchargés : {', '.join(missing)} (lancer 'flask vendor-assets' "
+              f"sur une machine connectée puis versionner static/vendor/)")
+        raise SystemExit(1)
+    
+    manifest = build_assets(app.static_folder)
+    for path, target in sorted(manifest.items()):
+        print(f"{path} -> {target}")
+    print(f"{len(manifest)} fichier(s) construit(s), variantes : {', '.join(ENCODINGS)}")
+
+# Vérifier avec EXPLAIN (QUERY PLAN) que les requêtes des routes utilisent les index
+@app.cli.command("check-indexes")
+def check_indexes():
+    statements = {
+        'phases par projet': db.select(Phase).where(Phase.project_id == 1),
+        'intervenants par projet': db.select(Intervenant).where(Intervenant.project_id == 1),
+        'allocations par projet': db.select(PhaseIntervenant).where(PhaseIntervenant.project_id == 1),
+        'allocations par intervenant': db.select(PhaseIntervenant).where(PhaseIntervenant.intervenant_id == 1),
+        'vérifs par projet': db.select(PhaseIntervenantVerif).where(PhaseIntervenantVerif.project_id == 1),
+        'vérifs par intervenant': db.select(PhaseIntervenantVerif).where(PhaseIntervenantVerif.intervenant_id == 1),
+    }
+    
+    failures = []
+    with app.app_context(), db.engine.connect() as connection:
+        for label, statement in statements.items():
+            plan = explain_query_plan(connection, statement)
+            print(f"{label} : {' | '.join(plan)}")
+            if full_scans(plan):
+                failures.append(label)
+    
+    if failures:
+        print(f"Parcours complet de table pour : {', '.join(failures)} (lancer 'flask migrate-db')")
+        raise SystemExit(1)
+    print("Toutes les requêtes contrôlées utilisent un index")
+
+# Grilles (total, pourcentages, vérif, montants vérif, indice du tampon) que la méthode
+# 'solver' doit résoudre en respectant toutes les contraintes
+SOLVER_REGRESSION_GRIDS = {
+    'tampon fixé, phase 0 négative': (
+        1000, [25, 50, 25],
+        [[np.nan, 0, 11], [135, np.nan, np.nan], [np.nan, np.nan, 58]],
+        [461, 335, 240], 2),
+    "ajustement sans convergence, tampon non impliqué": (
+        1000, [54.72, 8.937, 32.159, 4.184],
+        [[40.28, np.nan, np.nan], [np.nan, np.nan, 0], [np.nan, 0, np.nan], [0, np.nan, 129.47]],
+        [452.27, np.nan, 446.34], 1),
+}
+
+# Existe-t-il une allocation valide ? Décision exacte, indépendante du solveur, par
+# énumération des coupes du problème de transport (2^intervenants : petites grilles).
+# Les cellules fixées gardent leur montant de la première passe, les nulles restent à 0 ;
+# chaque phase doit recevoir son reste r sur ses cellules non spécifiées, chaque
+# intervenant un total (reste) dans [l, u]. Une allocation existe si et seulement si,
+# pour tout ensemble C d'intervenants, les phases ayant une cellule non spécifiée hors
+# de C plus min(somme des u de C, somme des l de C + somme des r - somme des l) couvrent
+# la somme des r.
+def cut_feasible(total_marche, percentages, verif, montant_verif, buffer_index, tolerance=TOLERANCE_ECART):
+    phase_amount = total_marche * np.asarray(percentages, dtype=float) / 100
+    _, first = first_pass(phase_amount[None], verif[None], np.asarray([buffer_index]))
+    movable = np.isnan(verif)
+    frozen = np.where(movable | (verif == 0), 0.0, first[0])
+    remainder = phase_amount - frozen.sum(axis=1)
+    slack = 1e-9 * max(np.abs(phase_amount).max(initial=0.0), 1.0)
+    
+    has_verif = np.nan_to_num(montant_verif) != 0
+    safe_verif = np.where(has_verif, montant_verif, 0.0)
+    margin = np.abs(safe_verif) * tolerance / 100
+    low = np.maximum(np.where(has_verif, safe_verif - margin - frozen.sum(axis=0), 0.0), 0.0)
+    high = np.where(has_verif, safe_verif + margin - frozen.sum(axis=0), np.inf)
+    if (remainder < -slack).any() or (high < low - slack).any():
+        return False
+    required = np.maximum(remainder, 0.0).sum()
+    if low.sum() > required + slack:
+        return False
+    
+    for subset in range(2 ** verif.shape[1]):
+        inside = np.array([(subset >> j) & 1 for j in range(verif.shape[1])], dtype=bool)
+        cut = np.maximum(remainder, 0.0)[(movable & ~inside).any(axis=1)].sum()
+        if cut + min(high[inside].sum(), low[inside].sum() + required - low.sum()) < required - slack:
+            return False
+    return True
+
+# Vérifier la méthode 'solver' contre cut_feasible sur des grilles de régression et
+# aléatoires : verdict (feasible) identique, et allocation rendue valide quand une
+# solution existe (montants >= 0, non impliqués à 0, phases à leur montant, intervenants
+# dans la tolérance, cellules fixées à leur montant de la première passe)
+@app.cli.command("check-solver")
+@click.option('--grids', default=3000, show_default=True, help="Nombre de grilles aléatoires à contrôler")
+@click.option('--seed', default=0, show_default=True)
+def check_solver(grids, seed):
+    rng = np.random.default_rng(seed)
+    cases = list(SOLVER_REGRESSION_GRIDS.items())
+    for index in range(grids):
+        n_phases, n_intervenants = rng.integers(2, 8), rng.integers(2, 6)
+        verif = np.full((n_phases, n_intervenants), np.nan)
+        draw = rng.random(verif.shape)
+        verif[draw < 0.2] = 0
+        fixed = (draw >= 0.2) & (draw < 0.45)
+        verif[fixed] = rng.uniform(5, 150, fixed.sum())
+        montant_verif = rng.uniform(50, 500, n_intervenants)
+        montant_verif[rng.random(n_intervenants) < 0.2] = np.nan
+        cases.append((f"grille aléatoire {index}",
+                      (1000, rng.dirichlet(np.ones(n_phases)) * 100, verif, montant_verif,
+                       int(rng.integers(n_intervenants)))))
+    
+    failures = []
+    feasible_count = 0
+    for label, (total_marche, percentages, verif, montant_verif, buffer_index) in cases:
+        verif = np.asarray(verif, dtype=float)
+        montant_verif = np.asarray(montant_verif, dtype=float)
+        expected = cut_feasible(total_marche, percentages, verif, montant_verif, buffer_index)
+        _, amount, feasible = allocate(total_marche, percentages, verif, montant_verif, buffer_index,
+                                       method='solver')
+        feasible_count += expected
+        if feasible != expected:
+            failures.append(f"{label} : solveur feasible={feasible}, décision exacte {expected}")
+            continue
+        if not expected:
+            continue
+        
+        phase_amount = total_marche * np.asarray(percentages, dtype=float) / 100
+        _, first = first_pass(phase_amount[None], verif[None], np.asarray([buffer_index]))
+        fixed = verif > 0
+        if (not valid_allocation(amount[None], phase_amount[None], verif[None], montant_verif[None])[0]
+                or not np.allclose(amount[fixed], first[0][fixed])):
+            failures.append(f"{label} : allocation invalide {np.round(amount, 2).tolist()}")
+    
+    if failures:
+        for failure in failures:
+            print(failure)
+        raise SystemExit(1)
+    print(f"{len(cases)} grille(s) contrôlée(s), {feasible_count} avec solution : "
+          f"verdicts exacts, allocations valides")
+
+# Vérifier que les pages d'un projet émettent un nombre constant de requêtes
+@app.cli.command("check-queries")
+@click.option('--limit', default=50, show_default=True, help="Nombre maximal de projets à contrôler")
+def check_queries(limit):
+    client = app.test_client()
+    counts = {endpoint: {} for endpoint in PAGE_QUERY_BUDGETS}
+    
+    with app.app_context():
+        projects = Project.query.options(
+            selectinload(Project.phases),
+            selectinload(Project.intervenants)
+        ).order_by(Project.id).limit(limit).all()
+        # Les pages redirigent tant qu'un projet n'a ni phases ni intervenants
+        sizes = {project.id: (len(project.phases), len(project.intervenants))
+                 for project in projects if project.phases and project.intervenants}
+        engine = db.engine
+    
+    for project_id, (n_phases, n_intervenants) in sizes.items():
+        for endpoint in PAGE_QUERY_BUDGETS:
+            with app.test_request_context():
+                url = url_for(endpoint, project_id=project_id)
+            # Mesurer le rendu complet, pas une page servie depuis le cache
+            page_cache.clear()
+            with count_queries(engine) as counter:
+                client.get(url)
+            counts[endpoint][project_id] = counter.count
+        print(f"Projet {project_id} ({n_phases} phases x {n_intervenants} intervenants) : "
+              + ", ".join(f"{endpoint}={counts[endpoint][project_id]}" for endpoint in PAGE_QUERY_BUDGETS))
+    
+    failures = []
+    for endpoint, budget in PAGE_QUERY_BUDGETS.items():
+        observed = set(counts[endpoint].values())
+        if len(observed) > 1:
+            failures.append(f"{endpoint} : nombre de requêtes variable selon la taille du projet {sorted(observed)}")
+        if observed and max(observed) > budget:
+            failures.append(f"{endpoint} : {max(observed)} requêtes (budget {budget})")
+    
+    if failures:
+        for failure in failures:
+            print(failure)
+        raise SystemExit(1)
+    print(f"{len(sizes)} projet(s) contrôlé(s) : nombre de requêtes constant pour chaque page")
+
 # -- Routes ------------------------------------------------------
 
+# Adresse d'une route dont certains paramètres sont complétés par le JavaScript de la page :
+# url_template('job_status', 'job_id') -> '/jobs/{job_id}'. Chaque paramètre reçoit une
+# valeur repère (valide pour les convertisseurs int) remplacée ensuite par '{nom}'.
+URL_TEMPLATE_SENTINEL = 987654321
+
+@app.template_global()
+def url_template(endpoint, *placeholders, **values):
+    sentinels = {name: URL_TEMPLATE_SENTINEL + index for index, name in enumerate(placeholders)}
+    url = url_for(endpoint, **values, **sentinels)
+    for name, sentinel in sentinels.items():
+        if url.count(str(sentinel)) != 1:
+            raise ValueError(f"Paramètre {name} introuvable dans l'adresse de {endpoint}")
+        url = url.replace(str(sentinel), '{' + name + '}')
+    return url
+
+# Date enregistrée en UTC (sans fuseau) affichée à l'heure locale (DISPLAY_TIMEZONE)
+@app.template_filter('local_time')
+def local_time(value, fmt='%d/%m/%Y %H:%M'):
+    local = value.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(app.config['DISPLAY_TIMEZONE']))
+    return local.strftime(fmt)
+
+# Paramètres de la liste des projets lus dans la requête (voir services.list_projects)
+def index_arguments(args):
+    sort = args.get('sort', 'id')
+    if sort not in PROJECT_SORTS:
+        sort = 'id'
+    return {
+        'search': args.get('q', '').strip(),
+        'sort': sort,
+        'descending': args.get('order') == 'desc',
+        'limit': min(max(args.get('limit', PROJECTS_PER_PAGE, type=int), 1), MAX_PROJECTS_PER_PAGE),
+        'min_total': args.get('min_total', type=float),
+        'max_total': args.get('max_total', type=float),
+        'after': args.get('after'),
+    }
+
+def render_index(arguments, projects, next_cursor):
+    return render_template('index.html',
+                           projects=projects,
+                           search=arguments['search'],
+                           sort=arguments['sort'],
+                           order='desc' if arguments['descending'] else 'asc',
+                           limit=arguments['limit'],
+                           min_total=arguments['min_total'],
+                           max_total=arguments['max_total'],
+                           next_cursor=next_cursor,
+                           is_first_page=not arguments['after'])
+
 @app.route('/')
 def index():
-    # Page d'accueil : liste des projets
-    all_projects = Project.query.all()
-    return render_template('index.html', projects=all_projects)
+    # Page d'accueil : liste paginée des projets (pagination par curseur)
+    arguments = index_arguments(request.args)
+    projects, next_cursor = list_projects(**arguments)
+    
+    return render_index(arguments, projects, next_cursor)
 
 @app.route('/project/new', methods=['GET', 'POST'])
 def create_project():
@@ -36,6 +454,8 @@ def create_project():
         # Créer l'objet Project
         new_project = Project(name=project_name, total_marche=float(total_marche))
         db.session.add(new_project)
+        db.session.flush()
+        refresh_summary(new_project)
         db.session.commit()
 
         # Rediriger vers l'accueil ou la page de détail
@@ -44,22 +464,35 @@ def create_project():
         # Simplement afficher le formulaire
         return render_template('create_project.html')
 
+@app.route('/projects/import', methods=['GET', 'POST'])
+def import_projects_upload():
+    report = None
+    error = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if upload is None or not upload.filename:
+            error = "Veuillez choisir un fichier CSV ou XLSX"
+        else:
+            try:
+                report = import_projects(upload.stream, upload.filename)
+            except ValueError as exc:
+                error = str(exc)
+    return render_template('import_projects.html', report=report, error=error)
+
 @app.route('/project/<int:project_id>')
+@cached_project_page(page_cache)
 def project_detail(project_id):
-    project = Project.query.get_or_404(project_id)
-    
-    # Calculer le total des pourcentages et montants des phases
-    phases_total_percent = sum(phase.percentage for phase in project.phases)
-    phases_total_amount = sum(project.total_marche * phase.percentage / 100 for phase in project.phases)
+    project = get_project_or_404(project_id)
     
-    # Calculer le total des montants vérif des intervenants
-    intervenants_total_verif = sum(intervenant.montant_verif for intervenant in project.intervenants)
+    # Totaux des phases et des montants vérif des intervenants (matérialisés)
+    summary = get_summary(project)
+    intervenants_total_verif = summary.intervenants_total_verif
     intervenants_total_percent = (intervenants_total_verif / project.total_marche * 100) if project.total_marche else 0
     
     return render_template('project_detail.html', 
                            project=project,
-                           phases_total_percent=phases_total_percent,
-                           phases_total_amount=phases_total_amount,
+                           phases_total_percent=summary.phases_total_percent,
+                           phases_total_amount=summary.phases_total_amount,
                            intervenants_total_verif=intervenants_total_verif,
                            intervenants_total_percent=intervenants_total_percent)
 
@@ -72,6 +505,8 @@ def add_phase(project_id):
     
     new_phase = Phase(name=phase_name, percentage=percentage, project_id=project.id)
     db.session.add(new_phase)
+    refresh_summary(project)
+    bump_version(project.id)
     db.session.commit()
     
     return redirect(url_for('project_detail', project_id=project.id))
@@ -87,13 +522,16 @@ def add_intervenant(project_id):
                                   montant_verif=montant_verif, 
                                   project_id=project.id)
     db.session.add(new_intervenant)
+    refresh_summary(project)
+    bump_version(project.id)
     db.session.commit()
     
     return redirect(url_for('project_detail', project_id=project.id))
 
 @app.route('/project/<int:project_id>/allocation')
+@cached_project_page(page_cache)
 def project_allocation(project_id):
-    project = Project.query.get_or_404(project_id)
+    project = get_project_or_404(project_id)
     
     # Vérifier si nous avons des phases et des intervenants
     if not project.phases:
@@ -104,275 +542,61 @@ def project_allocation(project_id):
         flash("Veuillez d'abord ajouter des intervenants au projet", "warning")
         return redirect(url_for('project_detail', project_id=project.id))
     
-    # Calculer le total des pourcentages et montants des phases
-    phases_total_percent = sum(phase.percentage for phase in project.phases)
-    phases_total_amount = sum(project.total_marche * phase.percentage / 100 for phase in project.phases)
-    
-    # Récupérer toutes les allocations existantes
-    allocations = PhaseIntervenant.query.filter(
-        PhaseIntervenant.phase_id.in_([phase.id for phase in project.phases])
-    ).all()
-    
-    # Créer un dictionnaire pour accéder facilement aux allocations
-    allocation_data = {}
-    for allocation in allocations:
-        allocation_data[(allocation.phase_id, allocation.intervenant_id)] = allocation
-    
-    # Calculer les totaux par intervenant
-    intervenant_totals = {}
-    for intervenant in project.intervenants:
-        total_amount = sum(
-            alloc.final_amount for alloc in allocations 
-            if alloc.intervenant_id == intervenant.id and alloc.final_amount is not None
-        )
-        
-        intervenant_totals[intervenant.id] = {
-            'amount': total_amount,
+    # Totaux des phases et des intervenants (matérialisés)
+    summary = get_summary(project)
+    
+    # Allocations existantes, accessibles par (phase_id, intervenant_id) (voir grids.py)
+    allocation_data = allocation_cells(project)
+    
+    # Totaux par intervenant
+    intervenant_totals = {
+        intervenant.id: {
+            'amount': intervenant.summary.total_amount,
             'verif': intervenant.montant_verif,
-            'ecart': total_amount - intervenant.montant_verif if intervenant.montant_verif else 0
+            'ecart': intervenant.summary.ecart
         }
+        for intervenant in project.intervenants
+        if intervenant.summary is not None
+    }
     
     return render_template('project_allocation.html', 
                           project=project,
-                          phases_total_percent=phases_total_percent,
-                          phases_total_amount=phases_total_amount,
+                          summary=summary,
+                          phases_total_percent=summary.phases_total_percent,
+                          phases_total_amount=summary.phases_total_amount,
                           allocation_data=allocation_data,
                           intervenant_totals=intervenant_totals)
 
 # Route modifiée pour le calcul d'allocation
 @app.route('/project/<int:project_id>/allocation/calculate', methods=['POST'])
 def calculate_allocation(project_id):
-    project = Project.query.get_or_404(project_id)
+    project = get_project_or_404(project_id)
     
     # Vérifier si nous avons des phases et des intervenants
     if not project.phases or not project.intervenants:
         flash("Le projet doit avoir des phases et des intervenants pour calculer l'allocation", "danger")
         return redirect(url_for('project_allocation', project_id=project.id))
     
-    # Identifier l'intervenant MB (s'il existe) qui servira de variable d'ajustement par défaut
-    mb_intervenant = next((i for i in project.intervenants if i.name.lower() == 'mb'), None)
-    
-    # Si MB n'existe pas, prendre le dernier intervenant comme variable d'ajustement
-    if not mb_intervenant and project.intervenants:
-        mb_intervenant = project.intervenants[-1]
-        flash(f"Aucun intervenant 'MB' trouvé, '{mb_intervenant.name}' sera utilisé comme variable d'ajustement par défaut", "warning")
-    
-    # Récupérer les montants vérif détaillés
-    verifs = PhaseIntervenantVerif.query.filter(
-        PhaseIntervenantVerif.phase_id.in_([phase.id for phase in project.phases])
-    ).all()
-    
-    # Créer un dictionnaire pour accéder facilement aux verifs
-    verif_data = {}
-    for verif in verifs:
-        verif_data[(verif.phase_id, verif.intervenant_id)] = verif.montant_verif
-    
-    # Supprimer les allocations existantes
-    PhaseIntervenant.query.filter(
-        PhaseIntervenant.phase_id.in_([phase.id for phase in project.phases])
-    ).delete(synchronize_session=False)
-    
-    # Initialiser le dictionnaire d'allocations
-    allocation_by_phase_intervenant = {}
-    
-    # Première passe : traiter les phases une par une
-    for phase in project.phases:
-        phase_amount = project.total_marche * phase.percentage / 100
-        remaining_percent = 100.0  # Pourcentage restant pour cette phase
-        remaining_amount = phase_amount  # Montant restant pour cette phase
-        phase_allocations = {}
-        
-        # Identifier les intervenants avec des montants vérif définis pour cette phase
-        fixed_intervenants = []
-        adjustable_intervenants = []
-        zero_intervenants = []
-        
-        for intervenant in project.intervenants:
-            verif_montant = verif_data.get((phase.id, intervenant.id))
-            
-            if verif_montant is not None:
-                if verif_montant > 0:
-                    fixed_intervenants.append(intervenant)
-                elif verif_montant == 0:
-                    zero_intervenants.append(intervenant)
-            else:
-                # Si pas de montant vérif défini, l'intervenant est ajustable
-                adjustable_intervenants.append(intervenant)
-        
-        # Traiter d'abord les intervenants avec des montants vérif fixes
-        total_fixed_amount = 0
-        for intervenant in fixed_intervenants:
-            verif_montant = verif_data.get((phase.id, intervenant.id), 0)
-            
-            # Calculer le pourcentage que cela représente de la phase
-            alloc_percent = (verif_montant / phase_amount) * 100
-            
-            # Limiter le pourcentage au restant disponible si nécessaire
-            if alloc_percent > remaining_percent:
-                alloc_percent = remaining_percent
-                verif_montant = phase_amount * (alloc_percent / 100)
-            
-            # Stocker l'allocation
-            phase_allocations[(phase.id, intervenant.id)] = {
-                'percent': alloc_percent,
-                'amount': verif_montant
-            }
-            
-            # Mettre à jour les pourcentages et montants restants
-            remaining_percent -= alloc_percent
-            remaining_amount -= verif_montant
-            total_fixed_amount += verif_montant
-        
-        # Déterminer quel intervenant sert de tampon pour cette phase
-        # Si MB a un montant vérif défini pour cette phase, c'est un autre intervenant qui sera le tampon
-        buffer_intervenant = None
-        
-        # Vérifier si MB est dans les fixed_intervenants
-        if mb_intervenant and mb_intervenant in fixed_intervenants:
-            # MB a un montant fixe pour cette phase, choisir un autre tampon parmi les ajustables
-            if adjustable_intervenants:
-                buffer_intervenant = adjustable_intervenants[0]
-                adjustable_intervenants.remove(buffer_intervenant)
-        else:
-            # MB n'a pas de montant fixe, il est le tampon par défaut
-            buffer_intervenant = mb_intervenant
-            if buffer_intervenant in adjustable_intervenants:
-                adjustable_intervenants.remove(buffer_intervenant)
-        
-        # Répartir le pourcentage restant équitablement entre les intervenants ajustables (hors tampon)
-        if adjustable_intervenants and remaining_percent > 0:
-            per_adjustable_percent = remaining_percent / len(adjustable_intervenants)
-            
-            for intervenant in adjustable_intervenants:
-                alloc_percent = per_adjustable_percent
-                alloc_amount = phase_amount * (alloc_percent / 100)
-                
-                # Stocker l'allocation
-                phase_allocations[(phase.id, intervenant.id)] = {
-                    'percent': alloc_percent,
-                    'amount': alloc_amount
-                }
-                
-                # Mettre à jour le pourcentage restant
-                remaining_percent -= alloc_percent
-                remaining_amount -= alloc_amount
-        
-        # Attribuer le reste au tampon (si défini)
-        if buffer_intervenant and remaining_percent > 0:
-            phase_allocations[(phase.id, buffer_intervenant.id)] = {
-                'percent': remaining_percent,
-                'amount': remaining_amount
-            }
-        
-        # Ajouter les allocations de cette phase au dictionnaire global
-        allocation_by_phase_intervenant.update(phase_allocations)
-    
-    # Deuxième passe : vérifier les écarts par rapport aux montants vérif totaux
-    intervenant_totals = {}
-    for intervenant in project.intervenants:
-        # Calculer le total pour cet intervenant sur toutes les phases
-        total_amount = sum(
-            allocation_by_phase_intervenant.get((phase.id, intervenant.id), {}).get('amount', 0)
-            for phase in project.phases
-        )
-        
-        # Calculer l'écart par rapport à la vérif globale
-        if intervenant.montant_verif:
-            ecart = total_amount - intervenant.montant_verif
-            ecart_percent = (ecart / intervenant.montant_verif) * 100
-        else:
-            ecart = 0
-            ecart_percent = 0
-        
-        intervenant_totals[intervenant.id] = {
-            'amount': total_amount,
-            'verif': intervenant.montant_verif,
-            'ecart': ecart,
-            'ecart_percent': ecart_percent
-        }
-    
-    # Troisième passe : ajuster les phases où les intervenants sont ajustables
-    # pour respecter la contrainte de ±5% sur les montants vérif globaux
-    adjustments_needed = []
+    # Identifier l'intervenant qui servira de variable d'ajustement (MB, sinon le dernier)
+    names = [intervenant.name for intervenant in project.intervenants]
+    buffer_name = names[find_buffer_index(names)]
+    if buffer_name.lower() != 'mb':
+        flash(f"Aucun intervenant 'MB' trouvé, '{buffer_name}' sera utilisé comme variable d'ajustement par défaut", "warning")
     
-    for intervenant in project.intervenants:
-        if intervenant == mb_intervenant:
-            continue  # On ne fait pas d'ajustements sur MB qui est notre tampon principal
-            
-        if intervenant.montant_verif and abs(intervenant_totals[intervenant.id]['ecart_percent']) > 5:
-            # Cet intervenant a besoin d'un ajustement
-            ecart = intervenant_totals[intervenant.id]['ecart']
-            adjustments_needed.append((intervenant, ecart))
-    
-    # Trier les ajustements par écart absolu décroissant (traiter d'abord les plus grands écarts)
-    adjustments_needed.sort(key=lambda x: abs(x[1]), reverse=True)
-    
-    # Pour chaque intervenant nécessitant un ajustement
-    for intervenant, ecart in adjustments_needed:
-        # Identifier les phases où l'intervenant est ajustable
-        adjustable_phases = []
-        for phase in project.phases:
-            if (phase.id, intervenant.id) not in verif_data or verif_data[(phase.id, intervenant.id)] is None:
-                adjustable_phases.append(phase)
-        
-        # Si pas de phases ajustables, on ne peut rien faire
-        if not adjustable_phases:
-            continue
-        
-        # Répartir l'ajustement entre les phases ajustables
-        adjustment_per_phase = ecart / len(adjustable_phases)
-        
-        for phase in adjustable_phases:
-            phase_amount = project.total_marche * phase.percentage / 100
-            
-            # Récupérer l'allocation actuelle
-            current_allocation = allocation_by_phase_intervenant.get((phase.id, intervenant.id), {'percent': 0, 'amount': 0})
-            buffer_allocation = allocation_by_phase_intervenant.get((phase.id, mb_intervenant.id), {'percent': 0, 'amount': 0})
-            
-            # Calculer le nouvel amount après ajustement
-            new_amount = current_allocation['amount'] - adjustment_per_phase
-            
-            # Vérifier que le nouveau montant est positif
-            if new_amount < 0:
-                new_amount = 0
-            
-            # Calculer le nouveau pourcentage
-            new_percent = (new_amount / phase_amount) * 100
-            delta_percent = current_allocation['percent'] - new_percent
-            
-            # Mettre à jour l'allocation
-            allocation_by_phase_intervenant[(phase.id, intervenant.id)] = {
-                'percent': new_percent,
-                'amount': new_amount
-            }
-            
-            # Transférer la différence au tampon (MB)
-            if mb_intervenant:
-                buffer_allocation['percent'] += delta_percent
-                buffer_allocation['amount'] += adjustment_per_phase
-                allocation_by_phase_intervenant[(phase.id, mb_intervenant.id)] = buffer_allocation
-    
-    # Enregistrer toutes les allocations dans la base de données
-    for (phase_id, intervenant_id), allocation in allocation_by_phase_intervenant.items():
-        if allocation['percent'] > 0:  # Ne pas créer d'allocation à 0%
-            alloc = PhaseIntervenant(
-                phase_id=phase_id,
-                intervenant_id=intervenant_id,
-                final_percent=allocation['percent'],
-                final_amount=allocation['amount']
-            )
-            db.session.add(alloc)
+    # Le calcul est confié au gestionnaire de tâches : la page d'allocation suit son
+    # avancement et se recharge une fois l'allocation enregistrée
+    # ?profile=1 (avec PROFILE_DIR) : profil cProfile de la tâche, pas de son enregistrement
+    job = job_runner.submit(project.id, profile=request.args.get('profile') == '1')
     
-    db.session.commit()
-    
-    flash("L'allocation a été calculée avec succès", "success")
-    return redirect(url_for('project_allocation', project_id=project.id))
+    flash("Le calcul de l'allocation a été lancé", "info")
+    return redirect(url_for('project_allocation', project_id=project_id, job=job.id))
 
 # Dans app.py, ajouter ces nouvelles routes
 
 @app.route('/project/<int:project_id>/verif-detail')
+@cached_project_page(page_cache)
 def project_verif_detail(project_id):
-    project = Project.query.get_or_404(project_id)
+    project = get_project_or_404(project_id)
     
     # Vérifier que le projet a des phases et des intervenants
     if not project.phases:
@@ -383,46 +607,29 @@ def project_verif_detail(project_id):
         flash("Veuillez d'abord ajouter des intervenants au projet", "warning")
         return redirect(url_for('project_detail', project_id=project.id))
     
-    # Récupérer les montants vérif existants
-    verifs = PhaseIntervenantVerif.query.filter(
-        PhaseIntervenantVerif.phase_id.in_([phase.id for phase in project.phases])
-    ).all()
-    
-    # Créer un dictionnaire pour accéder facilement aux verifs
-    verif_data = {}
-    for verif in verifs:
-        verif_data[(verif.phase_id, verif.intervenant_id)] = verif
-    
-    # Calculer les totaux par intervenant
-    intervenant_verif_totals = {}
-    for intervenant in project.intervenants:
-        total_verif = sum(
-            verif.montant_verif for verif in verifs 
-            if verif.intervenant_id == intervenant.id and verif.montant_verif is not None
-        )
-        intervenant_verif_totals[intervenant.id] = total_verif
-    
-    # Calculer le total des pourcentages et montants des phases
-    phases_total_percent = sum(phase.percentage for phase in project.phases)
-    phases_total_amount = sum(project.total_marche * phase.percentage / 100 for phase in project.phases)
+    # Montants vérif existants, accessibles par (phase_id, intervenant_id) (voir grids.py)
+    verif_data = verif_cells(project)
+    
+    # Totaux des phases et des montants vérif par intervenant (matérialisés)
+    summary = get_summary(project)
+    intervenant_verif_totals = {
+        intervenant_id: totals.total_verif_detail
+        for intervenant_id, totals in intervenant_summaries(project).items()
+    }
     
     return render_template('project_verif_detail.html', 
                            project=project,
                            verif_data=verif_data,
                            intervenant_verif_totals=intervenant_verif_totals,
-                           phases_total_percent=phases_total_percent,
-                           phases_total_amount=phases_total_amount)
+                           phases_total_percent=summary.phases_total_percent,
+                           phases_total_amount=summary.phases_total_amount)
 
 @app.route('/project/<int:project_id>/verif-detail/save', methods=['POST'])
 def save_verif_detail(project_id):
-    project = Project.query.get_or_404(project_id)
-    
-    # Supprimer les verifs existants
-    PhaseIntervenantVerif.query.filter(
-        PhaseIntervenantVerif.phase_id.in_([phase.id for phase in project.phases])
-    ).delete(synchronize_session=False)
+    project = get_project_or_404(project_id)
     
-    # Récupérer les données du formulaire et créer de nouveaux verifs
+    # Récupérer les données du formulaire (None = champ vide, l'intervenant est ajustable)
+    submitted = {}
     for phase in project.phases:
         for intervenant in project.intervenants:
             field_name = f"verif_{phase.id}_{intervenant.id}"
@@ -431,49 +638,91 @@ def save_verif_detail(project_id):
             # Convertir en float si non vide
             if verif_value.strip():
                 try:
-                    montant_verif = float(verif_value)
-                    # Créer un nouvel enregistrement PhaseIntervenantVerif
-                    verif = PhaseIntervenantVerif(
-                        phase_id=phase.id,
-                        intervenant_id=intervenant.id,
-                        montant_verif=montant_verif
-                    )
-                    db.session.add(verif)
+                    submitted[(phase.id, intervenant.id)] = float(verif_value)
                 except ValueError:
                     flash(f"Valeur invalide pour {phase.name} - {intervenant.name}: {verif_value}", "danger")
                     return redirect(url_for('project_verif_detail', project_id=project.id))
+            else:
+                submitted[(phase.id, intervenant.id)] = None
+    
+    # Verrouillage optimiste : refuser le formulaire si le projet a changé depuis son affichage
+    try:
+        lock_project(project, request.form.get('version', type=int))
+    except ConflictError:
+        flash("Le projet a été modifié entre-temps : vérifiez les montants et enregistrez-les à nouveau", "danger")
+        return redirect(url_for('project_verif_detail', project_id=project_id))
+    
+    # N'écrire que les cellules modifiées (sans modification, la version reste inchangée)
+    if save_verif_grid(project, submitted):
+        refresh_summary(project)
+        db.session.commit()
+    else:
+        db.session.rollback()
     
-    db.session.commit()
     flash("Les montants vérif ont été enregistrés avec succès", "success")
-    return redirect(url_for('project_verif_detail', project_id=project.id))
+    return redirect(url_for('project_verif_detail', project_id=project_id))
+
+# Enregistrement d'une seule cellule de la grille vérif (éditeur de la page, voir
+# static/js/verif_editor.js) : formulaire montant_verif (vide = tampon), version et
+# recalculate=1 pour recalculer l'allocation. La réponse ne contient que la ligne de la
+# phase et le total de l'intervenant (fragment HTML) ; erreurs en texte brut.
+@app.route('/project/<int:project_id>/verif-detail/cells/<int:phase_id>/<int:intervenant_id>', methods=['PATCH'])
+def update_verif_cell(project_id, phase_id, intervenant_id):
+    project = get_project_or_404(project_id)
+    phase = next((phase for phase in project.phases if phase.id == phase_id), None)
+    intervenant = next((intervenant for intervenant in project.intervenants if intervenant.id == intervenant_id), None)
+    if phase is None or intervenant is None:
+        return "Cellule inconnue pour ce projet", 404
+    
+    verif_value = request.form.get('montant_verif', '').strip()
+    try:
+        montant_verif = float(verif_value) if verif_value else None
+    except ValueError:
+        return f"Valeur invalide pour {phase.name} - {intervenant.name}: {verif_value}", 400
+    
+    # Total affiché si la cellule n'a pas changé (lu avant toute écriture)
+    total_verif = intervenant.summary.total_verif_detail if intervenant.summary is not None else 0.0
+    try:
+        lock_project(project, request.form.get('version', type=int))
+    except ConflictError:
+        db.session.rollback()
+        return "Le projet a été modifié entre-temps : rechargez la page avant de continuer", 409
+    
+    outside_tolerance = None
+    update = save_verif_cell(project, phase_id, intervenant_id, montant_verif,
+                             recalculate=request.form.get('recalculate') == '1')
+    if update is None:
+        # Aucune modification : la version reste inchangée
+        db.session.rollback()
+    else:
+        total_verif, allocation = update
+        if allocation is not None:
+            _, _, ecart_percent = allocation_totals(project, allocation[1])
+            outside_tolerance = [item.name for item, percent in zip(project.intervenants, ecart_percent)
+                                 if abs(percent) > TOLERANCE_ECART]
+        db.session.commit()
+    
+    return render_template('_verif_cell_update.html',
+                           project=project,
+                           phase=phase,
+                           intervenant=intervenant,
+                           verif_data=verif_row_cells(project, phase_id),
+                           total_verif=total_verif,
+                           outside_tolerance=outside_tolerance)
 
 @app.route('/project/<int:project_id>/delete', methods=['POST'])
 def delete_project(project_id):
-    project = Project.query.get_or_404(project_id)
-    
-    # Supprimer toutes les allocations liées au projet
-    PhaseIntervenant.query.filter(
-        PhaseIntervenant.phase_id.in_([phase.id for phase in project.phases])
-    ).delete(synchronize_session=False)
-    
-    # Supprimer toutes les vérifications liées au projet
-    if 'PhaseIntervenantVerif' in globals():  # Vérification si le modèle existe
-        PhaseIntervenantVerif.query.filter(
-            PhaseIntervenantVerif.phase_id.in_([phase.id for phase in project.phases])
-        ).delete(synchronize_session=False)
-    
-    # Supprimer toutes les phases et intervenants du projet
-    for phase in project.phases:
-        db.session.delete(phase)
-    
-    for intervenant in project.intervenants:
-        db.session.delete(intervenant)
-    
-    # Supprimer le projet lui-même
-    db.session.delete(project)
+    # Une seule requête : phases, intervenants, allocations, vérifs et totaux sont
+    # supprimés par la base (ON DELETE CASCADE)
+    name = db.session.scalar(
+        db.delete(Project).where(Project.id == project_id).returning(Project.name)
+    )
+    if name is None:
+        abort(404)
     db.session.commit()
+    page_cache.invalidate(project_id)
     
-    flash(f"Le projet '{project.name}' a été supprimé avec succès", "success")
+    flash(f"Le projet '{name}' a été supprimé avec succès", "success")
     return redirect(url_for('index'))
 
 @app.route('/project/<int:project_id>/edit', methods=['GET', 'POST'])
@@ -488,6 +737,8 @@ def edit_project(project_id):
         # Mettre à jour le projet
         project.name = project_name
         project.total_marche = float(total_marche)
+        refresh_summary(project)
+        bump_version(project.id)
         db.session.commit()
         
         flash("Les modifications ont été enregistrées avec succès", "success")
@@ -498,9 +749,16 @@ def edit_project(project_id):
 
 @app.route('/project/<int:project_id>/phases/edit', methods=['GET', 'POST'])
 def edit_phases(project_id):
-    project = Project.query.get_or_404(project_id)
+    project = get_project_or_404(project_id, selectinload(Project.phases))
     
     if request.method == 'POST':
+        # Verrouillage optimiste : refuser le formulaire si le projet a changé depuis son affichage
+        try:
+            lock_project(project, request.form.get('version', type=int))
+        except ConflictError:
+            flash("Le projet a été modifié entre-temps : vérifiez les pourcentages et enregistrez-les à nouveau", "danger")
+            return redirect(url_for('edit_phases', project_id=project_id))
+        
         # Récupérer les pourcentages modifiés
         for phase in project.phases:
             percentage_key = f'percentage_{phase.id}'
@@ -513,10 +771,11 @@ def edit_phases(project_id):
         
         # Vérifier que la somme des pourcentages est égale à 100%
         total_percentage = sum(phase.percentage for phase in project.phases)
-        if abs(total_percentage - 100.0) > 0.01:  # Tolérance de 0.01% pour les erreurs d'arrondi
+        if abs(total_percentage - 100.0) > PERCENT_TOLERANCE:  # Tolérance de 0.01% pour les erreurs d'arrondi
             flash(f"La somme des pourcentages doit être égale à 100% (actuellement {total_percentage:.2f}%)", "danger")
             return redirect(url_for('edit_phases', project_id=project.id))
         
+        refresh_summary(project)
         db.session.commit()
         flash("Les pourcentages des phases ont été modifiés avec succès", "success")
         return redirect(url_for('project_detail', project_id=project.id))
@@ -524,6 +783,44 @@ def edit_phases(project_id):
         # Afficher le formulaire d'édition des phases
         return render_template('edit_phases.html', project=project)
 
+# Export des allocations en flux (CSV, XLSX ou Parquet) ; mêmes filtres que l'accueil,
+# ou un seul projet avec ?project=<id>
+@app.route('/export/allocations.<export_format>')
+def export_allocations(export_format):
+    try:
+        check_format(export_format)
+    except ValueError as error:
+        abort(404, str(error))
+    chunks = export_chunks(project_id=request.args.get('project', type=int),
+                           search=request.args.get('q', '').strip(),
+                           min_total=request.args.get('min_total', type=float),
+                           max_total=request.args.get('max_total', type=float))
+    return Response(stream_with_context(export_stream(export_format, chunks)),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename=allocations.{export_format}'})
+
+# Recalculer tous les projets en arrière-plan (après un changement de règle)
+@app.route('/jobs/recalculate-all', methods=['POST'])
+def recalculate_all():
+    job = job_runner.submit()
+    return redirect(url_for('index', job=job.id))
+
+# Avancement et résultat d'une tâche de recalcul
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = Job.query.get_or_404(job_id)
+    return jsonify(job_to_dict(job))
+
+# Compteurs du cache des pages (usage interne)
+@app.route('/_cache/stats')
+def cache_stats():
+    return jsonify(page_cache.stats())
+
+@app.route('/_metrics')
+def metrics():
+    # Histogrammes par route des durées mesurées (INSTRUMENTATION=1)
+    return jsonify(instrumentation.snapshot())
+
 # -- Lancement serveur -------------------------------------------
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
\ No newline at end of file
@@ -0,0 +1,229 @@
+# asgi.py
+# Point d'entrée ASGI pour la production :
+#   uvicorn asgi:application --workers 4 --no-access-log
+# Les pages de lecture (index, project_detail, project_allocation, project_verif_detail)
+# interrogent la base avec le moteur asynchrone de SQLAlchemy (aiosqlite, ou asyncpg pour
+# PostgreSQL) sans occuper de thread : une page de projet inchangée (304) ou en cache est
+# renvoyée directement depuis la boucle d'événements. Le travail CPU (rendu des gabarits,
+# pages absentes du cache, calculs d'allocation) et toutes les autres routes passent par
+# l'application Flask, dans un pool de threads borné.
+#   --workers N   -> processus (un par cœur), chacun avec sa boucle, son pool et son cache
+#   ASGI_THREADS  -> threads du pool de chaque processus (8 par défaut)
+#   DB_POOL_*     -> pools de connexions synchrone et asynchrone (voir database.py)
+# Avec INSTRUMENTATION=1, toutes les requêtes passent par Flask (mesures complètes).
+# Les pages sont compressées comme par Flask (voir compression.py et pagecache.encode_page).
+import asyncio
+import os
+from urllib.parse import parse_qsl
+
+from a2wsgi import WSGIMiddleware
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+from werkzeug.utils import get_content_type
+
+from app import app, index_arguments, instrumentation, page_cache, render_index
+from compression import encode
+from database import install_sqlite_pragmas
+from models import db
+from pagecache import encode_page, not_modified, page_etag, project_states_query
+from services import project_page, project_page_query
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS') or 8)
+
+# Pilotes asynchrones des bases reconnues
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+# Pages de projet servies depuis la boucle d'événements quand le cache les contient
+CACHED_PAGES = ('project_detail', 'project_allocation', 'project_verif_detail')
+
+# Nombre maximal de projets par lecture groupée des versions
+STATE_BATCH_SIZE = 500
+
+
+def async_engine(flask_app):
+    # Moteur asynchrone sur la base de l'application (chemin SQLite résolu par
+    # Flask-SQLAlchemy), avec les mêmes options de pool et les mêmes pragmas
+    with flask_app.app_context():
+        url = db.engine.url
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"Pas de pilote asynchrone pour la base '{backend}'")
+    engine = create_async_engine(url.set(drivername=ASYNC_DRIVERS[backend]),
+                                 **flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+    if backend == 'sqlite':
+        install_sqlite_pragmas(engine.sync_engine,
+                               flask_app.config['SQLITE_JOURNAL_MODE'],
+                               flask_app.config['SQLITE_BUSY_TIMEOUT'],
+                               flask_app.config['SQLITE_SYNCHRONOUS'])
+    return engine
+
+
+def request_headers(scope):
+    return {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+
+
+def headers_encoding(flask_app, headers):
+    # En-tête Accept-Encoding, ou None si la compression est désactivée
+    return headers.get('accept-encoding') if flask_app.config['COMPRESSION'] else None
+
+
+async def send_response(send, status, headers, body=b''):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class ProjectStates:
+    # Versions des projets lues par lots : les pages demandées pendant une lecture en cours
+    # attendent la suivante, qui les regroupe en une seule requête SQL. Chaque réponse
+    # repose donc sur une lecture commencée après l'arrivée de sa requête.
+    def __init__(self, engine):
+        self.engine = engine
+        self._waiting = {}  # project_id -> [futures]
+        self._reader = None
+
+    async def get(self, project_id):
+        # (version, updated_at) du projet, ou None s'il n'existe pas
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(project_id, []).append(future)
+        if self._reader is None:
+            self._reader = asyncio.create_task(self._read())
+        return await future
+
+    async def _read(self):
+        try:
+            while self._waiting:
+                batch = dict(list(self._waiting.items())[:STATE_BATCH_SIZE])
+                for project_id in batch:
+                    del self._waiting[project_id]
+                try:
+                    async with self.engine.connect() as connection:
+                        rows = (await connection.execute(project_states_query(list(batch)))).all()
+                except Exception as error:
+                    for futures in batch.values():
+                        for future in futures:
+                            if not future.done():
+                                future.set_exception(error)
+                    continue
+                states = {row.id: (row.version, row.updated_at) for row in rows}
+                for project_id, futures in batch.items():
+                    for future in futures:
+                        if not future.done():
+                            future.set_result(states.get(project_id))
+        finally:
+            self._reader = None
+
+
+class Application:
+    def __init__(self, flask_app, threads=ASGI_THREADS):
+        self.flask_app = flask_app
+        # Routes Flask exécutées dans le pool de threads, aussi utilisé pour les rendus
+        self.wsgi = WSGIMiddleware(flask_app, workers=threads)
+        self.executor = self.wsgi.executor
+        self.engine = async_engine(flask_app)
+        self.states = ProjectStates(self.engine)
+        self.urls = flask_app.url_map.bind('')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if (scope['type'] == 'http' and scope['method'] == 'GET' and not scope.get('root_path')
+                and not instrumentation.enabled):
+            try:
+                endpoint, view_args = self.urls.match(scope['path'], method='GET')
+            except HTTPException:  # 404, 405 ou redirection : réponse de Flask
+                endpoint = None
+            if endpoint == 'index':
+                await self.index(scope, send)
+                return
+            if endpoint in CACHED_PAGES and await self.cached_page(scope, send, endpoint,
+                                                                   view_args['project_id']):
+                return
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    self.flask_app.extensions['assets'].require_vendor(self.flask_app)
+                except RuntimeError as error:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def cached_page(self, scope, send, endpoint, project_id):
+        # Même réponse que pagecache.cached_project_page : 304 si le navigateur a déjà la
+        # version courante, page en cache sinon. Retourne False si la page doit être rendue
+        # par Flask (absente du cache, ou projet inconnu : 404)
+        state = await self.states.get(project_id)
+        if state is None:
+            return False
+        version, updated_at = state
+        etag = page_etag(endpoint, project_id, version, self.flask_app.extensions['assets'].build_id)
+        headers = request_headers(scope)
+
+        status, body = 304, b''
+        response_headers = []
+        if not not_modified(etag, updated_at, parse_etags(headers.get('if-none-match')),
+                            parse_date(headers.get('if-modified-since'))):
+            key = (endpoint, project_id)
+            entry = page_cache.get(key, version)
+            if entry is None:
+                return False
+            _, body, mimetype, _ = entry
+            # Compression calculée une fois par version de la page, puis gardée en cache
+            body, encoding = encode_page(page_cache, key, version, body, mimetype,
+                                         headers_encoding(self.flask_app, headers))
+            status = 200
+            response_headers = [('content-type', get_content_type(mimetype, 'utf-8')),
+                                ('content-length', str(len(body)))]
+            if encoding is not None:
+                response_headers.append(('content-encoding', encoding))
+
+        if self.flask_app.config['COMPRESSION']:
+            response_headers.append(('vary', 'Accept-Encoding'))
+        response_headers.append(('etag', quote_etag(etag, weak=True)))
+        if updated_at is not None:
+            response_headers.append(('last-modified', http_date(updated_at)))
+        response_headers.append(('cache-control', 'no-cache'))
+        await send_response(send, status, response_headers, body)
+        return True
+
+    async def index(self, scope, send):
+        # Liste des projets lue par le moteur asynchrone, page rendue dans le pool de threads
+        query_string = scope['query_string'].decode('latin-1')
+        arguments = index_arguments(MultiDict(parse_qsl(query_string, keep_blank_values=True)))
+        async with self.engine.connect() as connection:
+            rows = (await connection.execute(project_page_query(**arguments))).all()
+        projects, next_cursor = project_page(rows, arguments['sort'], arguments['limit'])
+
+        body, encoding = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.render, scope, render_index, arguments, projects, next_cursor)
+        response_headers = [('content-type', 'text/html; charset=utf-8'), ('content-length', str(len(body)))]
+        if encoding is not None:
+            response_headers.append(('content-encoding', encoding))
+        if self.flask_app.config['COMPRESSION']:
+            response_headers.append(('vary', 'Accept-Encoding'))
+        await send_response(send, 200, response_headers, body)
+
+    def render(self, scope, view, *args):
+        # Rendu d'un gabarit dans un contexte de requête Flask (url_for, request.args),
+        # compressé selon le navigateur -> (corps, encodage ou None)
+        headers = request_headers(scope)
+        base_url = f"{scope.get('scheme', 'http')}://{headers.get('host', 'localhost')}"
+        with self.flask_app.test_request_context(scope['path'], base_url=base_url,
+                                                 query_string=scope['query_string'].decode('latin-1')):
+            body = view(*args).encode()
+        return encode(body, 'text/html', headers_encoding(self.flask_app, headers))
+
+
+application = Application(app)
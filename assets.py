@@ -0,0 +1,187 @@
+# assets.py
+# Fichiers statiques servis par l'application elle-même, sans CDN (déploiement hors ligne) :
+#   flask vendor-assets  -> télécharge Bootstrap (version figée) dans static/vendor/, à
+#                           lancer une fois sur une machine connectée puis à versionner
+#   flask build-assets   -> copie chaque fichier de static/ sous un nom contenant l'empreinte
+#                           de son contenu (static/dist/css/style.3f2a9c1b0d4e.css), avec
+#                           ses variantes précompressées (.gz, et .br si brotli est
+#                           installé), et écrit static/dist/manifest.json
+# Dans les gabarits, asset_url('css/style.css') donne l'adresse du fichier construit : son
+# nom change avec son contenu, il peut donc être gardé un an par le navigateur
+# (Cache-Control: immutable). En mode debug, ou sans manifeste, les fichiers de static/
+# sont servis tels quels. Bootstrap doit être téléchargé et versionné : sans lui,
+# 'flask build-assets' refuse de construire et le service ASGI refuse de démarrer
+# (require_vendor) ; seul le mode debug le prend alors sur le CDN, avec un avertissement.
+# L'empreinte du manifeste (build_id) entre dans l'ETag des pages : après un déploiement,
+# le navigateur ne garde pas une page qui pointe vers des fichiers construits supprimés.
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import urllib.request
+
+from flask import current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+from compression import ENCODINGS, STATIC_LEVELS, compress, compressible, negotiate
+
+BOOTSTRAP_VERSION = '5.3.0-alpha1'
+
+# Fichiers tiers (chemin sous static/ -> adresse d'origine)
+VENDOR_ASSETS = {
+    'vendor/bootstrap/bootstrap.min.css':
+        f'https://cdn.jsdelivr.net/npm/bootstrap@{BOOTSTRAP_VERSION}/dist/css/bootstrap.min.css',
+    'vendor/bootstrap/bootstrap.bundle.min.js':
+        f'https://cdn.jsdelivr.net/npm/bootstrap@{BOOTSTRAP_VERSION}/dist/js/bootstrap.bundle.min.js',
+}
+
+# Sous-dossier de static/ des fichiers construits
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+# Extensions des variantes précompressées
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Durée de cache des fichiers construits (un an)
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Caractères de l'empreinte SHA-256 gardés dans le nom des fichiers
+HASH_LENGTH = 12
+
+
+def hashed_name(path, data):
+    root, extension = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{extension}"
+
+
+def source_files(static_folder):
+    # Fichiers de static/ (hors fichiers construits), chemins relatifs avec des '/'
+    for directory, subdirectories, filenames in os.walk(static_folder):
+        relative = os.path.relpath(directory, static_folder)
+        if relative == '.':
+            subdirectories[:] = [name for name in subdirectories if name != DIST_DIR]
+        for filename in sorted(filenames):
+            yield os.path.normpath(os.path.join(relative, filename)).replace(os.sep, '/')
+
+
+def build_assets(static_folder):
+    # Reconstruire static/dist/ : copies nommées par empreinte, variantes compressées
+    # (gardées seulement si elles sont plus petites) et manifeste. Retourne le manifeste.
+    dist = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for path in source_files(static_folder):
+        with open(os.path.join(static_folder, path), 'rb') as stream:
+            data = stream.read()
+        target = hashed_name(path, data)
+        destination = os.path.join(dist, target)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, 'wb') as stream:
+            stream.write(data)
+
+        mimetype, _ = mimetypes.guess_type(path)
+        if compressible(mimetype, len(data)):
+            for encoding in ENCODINGS:
+                compressed = compress(data, encoding, STATIC_LEVELS)
+                if len(compressed) < len(data):
+                    with open(destination + ENCODING_SUFFIXES[encoding], 'wb') as stream:
+                        stream.write(compressed)
+        manifest[path] = f'{DIST_DIR}/{target}'
+
+    with open(os.path.join(dist, MANIFEST), 'w') as stream:
+        json.dump(manifest, stream, indent=2, sort_keys=True)
+    return manifest
+
+
+def vendor_assets(static_folder):
+    # Télécharger les fichiers tiers dans static/ -> [(chemin, taille, empreinte SHA-256)]
+    downloaded = []
+    for path, source in VENDOR_ASSETS.items():
+        with urllib.request.urlopen(source, timeout=30) as response:
+            data = response.read()
+        destination = os.path.join(static_folder, *path.split('/'))
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with open(destination, 'wb') as stream:
+            stream.write(data)
+        downloaded.append((path, len(data), hashlib.sha256(data).hexdigest()))
+    return downloaded
+
+
+def manifest_id(manifest):
+    # Empreinte du manifeste, 'dev' sans fichiers construits
+    if not manifest:
+        return 'dev'
+    data = json.dumps(manifest, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST)) as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return {}
+
+
+class Assets:
+    def __init__(self, app=None):
+        self.static_folder = None
+        self.manifest = {}
+        self.build_id = manifest_id(self.manifest)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['assets'] = self
+        self.static_folder = app.static_folder
+        # Manifeste lu au démarrage : après 'flask build-assets', redémarrer le service
+        self.manifest = load_manifest(self.static_folder)
+        self.build_id = manifest_id(self.manifest)
+        app.jinja_env.globals['asset_url'] = self.url
+        app.view_functions['static'] = self.send_static_file
+        missing = self.vendor_missing()
+        if missing:
+            app.logger.warning("Fichiers tiers non téléchargés : %s (lancer 'flask vendor-assets') ; "
+                               "CDN en mode debug, démarrage refusé sinon", ', '.join(missing))
+
+    def vendor_missing(self):
+        # Fichiers tiers pas encore téléchargés
+        return [path for path in VENDOR_ASSETS if not self._exists(path)]
+
+    def require_vendor(self, app):
+        # Au démarrage d'un service hors mode debug : pas de page qui dépende du CDN
+        missing = self.vendor_missing()
+        if missing and not app.debug:
+            raise RuntimeError(f"Fichiers tiers non téléchargés : {', '.join(missing)} (lancer "
+                               f"'flask vendor-assets' puis versionner static/vendor/)")
+
+    def _exists(self, filename):
+        return os.path.isfile(os.path.join(self.static_folder, *filename.split('/')))
+
+    def url(self, filename):
+        # En mode debug, les fichiers modifiés sont servis sans reconstruction
+        if filename in self.manifest and not current_app.debug:
+            return url_for('static', filename=self.manifest[filename])
+        if filename in VENDOR_ASSETS and current_app.debug and not self._exists(filename):
+            return VENDOR_ASSETS[filename]
+        return url_for('static', filename=filename)
+
+    def send_static_file(self, filename):
+        if not filename.startswith(f'{DIST_DIR}/'):
+            return send_from_directory(self.static_folder, filename)
+        # Fichier construit : variante précompressée acceptée par le navigateur, s'il y en a
+        path = safe_join(self.static_folder, filename)
+        available = [encoding for encoding in ENCODINGS
+                     if path is not None and os.path.isfile(path + ENCODING_SUFFIXES[encoding])]
+        encoding = negotiate(request.headers.get('Accept-Encoding'), available) if available else None
+        mimetype, _ = mimetypes.guess_type(filename)
+        response = send_from_directory(self.static_folder,
+                                       filename + ENCODING_SUFFIXES.get(encoding, ''),
+                                       mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if available:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        return response
@@ -0,0 +1,338 @@
+# benchmark.py
+# Mesures de performance reproductibles, en deux parties :
+#   allocation : moteur d'allocation seul (allocation.py), pour des grilles de tailles
+#                croissantes (phases x intervenants)
+#   routes     : pages et formulaires de l'application via le client de test Flask, sur
+#                des jeux de données générés (generate_test_data.py) de tailles croissantes
+# Chaque mesure donne les percentiles de latence, le nombre de requêtes SQL et le pic
+# de mémoire Python. Les résultats peuvent être enregistrés comme référence (--save)
+# puis comparés à une référence (--compare) : le script échoue en cas de régression.
+#   python benchmark.py --save benchmarks.json
+#   python benchmark.py routes --projects 100,1000 --compare benchmarks.json
+#   python benchmark.py allocation --grid-phases 10,100 --grid-intervenants 8,64
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy.orm import selectinload
+
+from allocation import ALLOCATION_METHODS, allocate, build_verif_matrix, find_buffer_index
+from generate_test_data import dataset_app, generate_dataset, parse_range, synthetic_project
+from models import db, Project, PhaseIntervenantVerif, Job
+from querycount import count_queries
+from services import recalculate_allocation
+
+# Dossier des jeux de données générés (réutilisés d'une exécution à l'autre)
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'benchmarks')
+
+# Pages et formulaires mesurés
+ROUTES = ('index', 'project_detail', 'project_allocation', 'project_verif_detail',
+          'save_verif_detail', 'calculate_allocation', 'calculate_allocation:calcul')
+
+# Écart toléré par rapport à la référence (latence et mémoire, en proportion)
+DEFAULT_TOLERANCE = 0.25
+
+
+def parse_sizes(value):
+    # "5,20,50" -> [5, 20, 50]
+    return [int(size) for size in value.split(',') if size.strip()]
+
+
+def summarize(durations, queries=None, peak=None):
+    # Percentiles en millisecondes, requêtes SQL par appel (maximum), pic mémoire en Kio
+    durations = np.asarray(durations) * 1000
+    result = {
+        'runs': len(durations),
+        'mean_ms': round(float(durations.mean()), 4),
+        'p50_ms': round(float(np.percentile(durations, 50)), 4),
+        'p95_ms': round(float(np.percentile(durations, 95)), 4),
+        'p99_ms': round(float(np.percentile(durations, 99)), 4),
+    }
+    if queries is not None:
+        result['queries'] = max(queries)
+    if peak is not None:
+        result['peak_kib'] = round(peak / 1024, 1)
+    return result
+
+
+def measure_peak(function):
+    # Pic de mémoire Python (octets) pendant un appel, mesuré à part : tracemalloc
+    # ralentit l'exécution et fausserait les latences
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# -- Moteur d'allocation -----------------------------------------
+
+def benchmark_allocation(phase_counts, intervenant_counts, repeat=50, seed=0,
+                         null_share=0.5, zero_share=0.2, methods=('greedy',)):
+    # Calcul d'un projet tel que le fait calculate_allocation : construction de la
+    # matrice vérif à partir des cellules enregistrées, puis les trois passes, avec
+    # chacune des méthodes demandées (clé suffixée du nom de la méthode hors 'greedy')
+    rng = np.random.default_rng(seed)
+    results = {}
+    for n_phases in phase_counts:
+        for n_intervenants in intervenant_counts:
+            project = synthetic_project(rng, 0, n_phases, max(n_intervenants, 2), null_share, zero_share)
+            phase_ids = list(range(len(project['phases'])))
+            intervenant_ids = list(range(len(project['intervenants'])))
+            phase_index = {name: i for i, name in enumerate(project['phases'])}
+            intervenant_index = {name: j for j, name in enumerate(project['intervenants'])}
+            cells = [(phase_index[phase], intervenant_index[intervenant], montant)
+                     for _, phase, intervenant, montant in project['verifs']]
+            percentages = list(project['phases'].values())
+            montants = list(project['intervenants'].values())
+            buffer_index = find_buffer_index(list(project['intervenants']))
+
+            for method in methods:
+                def run():
+                    verif = build_verif_matrix(phase_ids, intervenant_ids, cells)
+                    allocate(project['total_marche'], percentages, verif, montants, buffer_index,
+                             method=method)
+
+                run()
+                durations = []
+                # Comme timeit : le ramasse-miettes ne se déclenche pas au milieu des mesures
+                gc.collect()
+                gc.disable()
+                try:
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        run()
+                        durations.append(time.perf_counter() - start)
+                finally:
+                    gc.enable()
+                key = f"allocation/{n_phases}x{n_intervenants}" + ('' if method == 'greedy' else f":{method}")
+                results[key] = summarize(durations, peak=measure_peak(run))
+                print(f"{key} : {format_result(results[key])}")
+    return results
+
+
+# -- Routes de l'application -------------------------------------
+
+def dataset_path(projects, phases, intervenants, seed):
+    return os.path.join(DATA_DIR, f"projects-{projects}-p{phases[0]}-{phases[1]}"
+                                  f"-i{intervenants[0]}-{intervenants[1]}-seed{seed}.db")
+
+
+def ensure_dataset(projects, phases, intervenants, seed):
+    # Générer le jeu de données (allocations calculées) s'il n'existe pas encore
+    path = dataset_path(projects, phases, intervenants, seed)
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        print(f"Génération de {os.path.relpath(path)}...")
+        app = dataset_app(f"sqlite:///{path}.tmp")
+        with app.app_context():
+            db.create_all()
+            generate_dataset(projects, phases, intervenants, seed=seed, allocate=True)
+            db.engine.dispose()
+        os.replace(f"{path}.tmp", path)
+    return path
+
+
+def benchmark_routes(database, requests=30, samples=10, seed=0):
+    # Mesurer les routes sur une base existante, dans le processus courant. L'application
+    # est importée ici : sa base est fixée par DATABASE_URL au moment de l'import.
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.abspath(database)}"
+    from app import app, page_cache
+
+    # Les tâches de calcul ne sont pas lancées en arrière-plan pendant les mesures :
+    # le calcul lui-même est mesuré à part (calculate_allocation:calcul)
+    app.config['JOB_AUTOSTART'] = False
+    client = app.test_client()
+    rng = np.random.default_rng(seed)
+
+    with app.app_context():
+        engine = db.engine
+        project_ids = db.session.scalars(db.select(Project.id).order_by(Project.id)).all()
+        if not project_ids:
+            raise SystemExit(f"Aucun projet dans {database}")
+        # Projets mesurés : un échantillon fixe (même graine = mêmes projets)
+        sample = sorted(int(project_id) for project_id in
+                        rng.choice(project_ids, size=min(samples, len(project_ids)), replace=False))
+
+        # Formulaire vérif de chaque projet (grille enregistrée, une cellule modifiée à chaque envoi)
+        forms = {}
+        for project in Project.query.options(selectinload(Project.phases), selectinload(Project.intervenants)
+                                             ).filter(Project.id.in_(sample)):
+            saved = {(verif.phase_id, verif.intervenant_id): verif.montant_verif for verif in
+                     PhaseIntervenantVerif.query.filter_by(project_id=project.id)}
+            forms[project.id] = {
+                f"verif_{phase.id}_{intervenant.id}": ('' if saved.get((phase.id, intervenant.id)) is None
+                                                       else str(saved[(phase.id, intervenant.id)]))
+                for phase in project.phases for intervenant in project.intervenants
+            }
+        db.session.rollback()
+
+    def recalculate(project_id):
+        with app.app_context():
+            project = db.session.get(Project, project_id,
+                                     options=[selectinload(Project.phases), selectinload(Project.intervenants)])
+            recalculate_allocation(project)
+            db.session.commit()
+
+    def save_form(project_id):
+        # Basculer la première cellule entre vide et 0 pour que chaque envoi écrive une ligne
+        form = forms[project_id]
+        field = next(iter(form))
+        form[field] = '' if form[field] else '0'
+        return client.post(f"/project/{project_id}/verif-detail/save", data=form)
+
+    requests_by_route = {
+        'index': lambda project_id: client.get('/'),
+        'project_detail': lambda project_id: client.get(f"/project/{project_id}"),
+        'project_allocation': lambda project_id: client.get(f"/project/{project_id}/allocation"),
+        'project_verif_detail': lambda project_id: client.get(f"/project/{project_id}/verif-detail"),
+        'save_verif_detail': save_form,
+        'calculate_allocation': lambda project_id: client.post(f"/project/{project_id}/allocation/calculate"),
+        'calculate_allocation:calcul': recalculate,
+    }
+
+    results = {}
+    for route in ROUTES:
+        call = requests_by_route[route]
+        durations = []
+        queries = []
+        for run in range(requests + 1):
+            project_id = sample[run % len(sample)]
+            # Mesurer le rendu complet, pas une page servie depuis le cache
+            page_cache.clear()
+            with count_queries(engine) as counter:
+                start = time.perf_counter()
+                response = call(project_id)
+                elapsed = time.perf_counter() - start
+            if response is not None and response.status_code >= 400:
+                raise SystemExit(f"{route} : réponse {response.status_code} pour le projet {project_id}")
+            # Premier appel : préchauffage (compilation des gabarits et des requêtes)
+            if run:
+                durations.append(elapsed)
+                queries.append(counter.count)
+        page_cache.clear()
+        results[route] = summarize(durations, queries, measure_peak(lambda: call(sample[0])))
+
+    with app.app_context():
+        # Tâches enregistrées par calculate_allocation pendant les mesures
+        Job.query.filter_by(status='pending').delete()
+        db.session.commit()
+    return results
+
+
+def run_routes(sizes, phases, intervenants, requests, samples, seed):
+    # Un processus par jeu de données : la base de l'application est fixée à son import
+    results = {}
+    for size in sizes:
+        path = ensure_dataset(size, phases, intervenants, seed)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), 'routes', '--database', path, '--json',
+             '--requests', str(requests), '--samples', str(samples), '--seed', str(seed)],
+            check=True, stdout=subprocess.PIPE, text=True,
+        ).stdout
+        for route, result in json.loads(output).items():
+            key = f"routes/{size}/{route}"
+            results[key] = result
+            print(f"{key} : {format_result(result)}")
+    return results
+
+
+# -- Référence et comparaison ------------------------------------
+
+def format_result(result):
+    text = (f"p50 {result['p50_ms']:.3f} ms, p95 {result['p95_ms']:.3f} ms, "
+            f"p99 {result['p99_ms']:.3f} ms")
+    if 'queries' in result:
+        text += f", {result['queries']} requête(s)"
+    if 'peak_kib' in result:
+        text += f", pic {result['peak_kib']:.0f} Kio"
+    return text
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    # Régressions par rapport à la référence : latence médiane ou pic de mémoire au-delà
+    # de la tolérance, requêtes SQL supplémentaires. Les percentiles hauts, trop sensibles
+    # à la charge de la machine, sont affichés mais pas comparés.
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        for metric in ('p50_ms', 'peak_kib'):
+            if metric in result and metric in reference and result[metric] > reference[metric] * (1 + tolerance):
+                regressions.append(f"{key} : {metric} {result[metric]} (référence {reference[metric]})")
+        if result.get('queries', 0) > reference.get('queries', result.get('queries', 0)):
+            regressions.append(f"{key} : {result['queries']} requêtes (référence {reference['queries']})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mesurer les performances de l'application.")
+    parser.add_argument('part', nargs='?', choices=('all', 'allocation', 'routes'), default='all')
+    parser.add_argument('--grid-phases', type=parse_sizes, default='5,10,20,50,100',
+                        help="allocation : nombres de phases des grilles mesurées")
+    parser.add_argument('--grid-intervenants', type=parse_sizes, default='4,8,16,32',
+                        help="allocation : nombres d'intervenants des grilles mesurées")
+    parser.add_argument('--repeat', type=int, default=50, help="allocation : calculs mesurés par grille")
+    parser.add_argument('--methods', type=lambda value: value.split(','), default='greedy',
+                        help=f"allocation : méthodes mesurées ({','.join(ALLOCATION_METHODS)})")
+    parser.add_argument('--projects', type=parse_sizes, default='100,1000,10000',
+                        help="routes : tailles des jeux de données")
+    parser.add_argument('--phases', type=parse_range, default='5-15', help="routes : phases par projet")
+    parser.add_argument('--intervenants', type=parse_range, default='4-12', help="routes : intervenants par projet")
+    parser.add_argument('--database', help="routes : mesurer une base existante au lieu des jeux générés")
+    parser.add_argument('--requests', type=int, default=30, help="routes : appels mesurés par route")
+    parser.add_argument('--samples', type=int, default=10, help="routes : projets sur lesquels les appels sont répartis")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FICHIER', help="Enregistrer les résultats comme référence (JSON)")
+    parser.add_argument('--compare', metavar='FICHIER', help="Comparer à une référence ; échoue en cas de régression")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Dégradation tolérée par rapport à la référence (0.25 = 25%%)")
+    parser.add_argument('--json', action='store_true', help="Écrire les résultats bruts (JSON) sur la sortie")
+    args = parser.parse_args()
+
+    if args.database:
+        results = benchmark_routes(args.database, args.requests, args.samples, args.seed)
+        if args.json:
+            print(json.dumps(results))
+            return
+        for route, result in results.items():
+            print(f"{route} : {format_result(result)}")
+    else:
+        results = {}
+        if args.part in ('all', 'allocation'):
+            results.update(benchmark_allocation(args.grid_phases, args.grid_intervenants, args.repeat, args.seed,
+                                                methods=args.methods))
+        if args.part in ('all', 'routes'):
+            results.update(run_routes(args.projects, args.phases, args.intervenants,
+                                      args.requests, args.samples, args.seed))
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as output:
+            json.dump({'created_at': datetime.now().isoformat(timespec='seconds'),
+                       'python': platform.python_version(),
+                       'machine': platform.platform(),
+                       'results': results}, output, indent=2, sort_keys=True)
+        print(f"Référence enregistrée dans {args.save}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as source:
+            baseline = json.load(source)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            for regression in regressions:
+                print(f"Régression : {regression}")
+            raise SystemExit(1)
+        print(f"Aucune régression par rapport à {args.compare} (tolérance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# compression.py
+# Compression des réponses : brotli si le paquet est installé et accepté par le
+# navigateur, gzip sinon. Les réponses textuelles assez grandes (pages, JSON, CSV) sont
+# compressées après la vue ; les pages du cache (pagecache.py) et les fichiers statiques
+# construits (assets.py) ont leurs variantes compressées calculées une fois pour toutes.
+import gzip
+
+try:
+    import brotli
+except ImportError:  # brotli est optionnel : gzip seulement
+    brotli = None
+
+from flask import current_app, request
+
+# Encodages proposés, par ordre de préférence
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# Types de contenu compressés (les images et archives le sont déjà)
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/css', 'text/csv', 'text/plain', 'text/javascript',
+                          'application/javascript', 'application/json', 'image/svg+xml')
+
+# Taille minimale (octets) d'une réponse compressée : en dessous, le gain ne couvre pas le coût
+COMPRESS_MIN_SIZE = 1024
+
+# Niveaux : rapides pour les réponses dynamiques, maximaux pour les fichiers construits
+DYNAMIC_LEVELS = {'br': 5, 'gzip': 6}
+STATIC_LEVELS = {'br': 11, 'gzip': 9}
+
+
+def compressible(mimetype, size):
+    return mimetype in COMPRESSIBLE_MIMETYPES and size >= COMPRESS_MIN_SIZE
+
+
+def negotiate(accept_encoding, encodings=ENCODINGS):
+    # Premier encodage de la liste accepté par le client (en-tête Accept-Encoding), ou None
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding, levels=DYNAMIC_LEVELS):
+    if encoding == 'br':
+        return brotli.compress(data, quality=levels['br'])
+    # mtime=0 : même résultat pour le même contenu (fichiers construits, ETag)
+    return gzip.compress(data, compresslevel=levels['gzip'], mtime=0)
+
+
+def encode(body, mimetype, accept_encoding):
+    # Corps à envoyer selon l'en-tête Accept-Encoding -> (corps, encodage ou None)
+    encoding = negotiate(accept_encoding) if compressible(mimetype, len(body)) else None
+    if encoding is None:
+        return body, None
+    return compress(body, encoding), encoding
+
+
+def accept_encoding():
+    # Encodages acceptés par le navigateur, ou None si la compression est désactivée
+    if not current_app.config['COMPRESSION']:
+        return None
+    return request.headers.get('Accept-Encoding')
+
+
+def compress_response(response):
+    # Après la vue : compresser les réponses textuelles complètes qui ne le sont pas déjà
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or 'no-transform' in response.headers.get('Cache-Control', '')
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    body, encoding = encode(response.get_data(), response.mimetype, request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # La représentation compressée n'est plus identique octet par octet : ETag faible
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    app.config.setdefault('COMPRESSION', True)
+    if app.config['COMPRESSION']:
+        app.after_request(compress_response)
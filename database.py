@@ -0,0 +1,79 @@
+# database.py
+# Initialisation de la base pour l'application web et les processus de calcul :
+# adresse et pool de connexions lus dans l'environnement, pragmas SQLite appliqués à
+# chaque connexion.
+#   DATABASE_URL      -> sqlite:///app.db par défaut, ou postgresql://user:mdp@hôte/base
+#   DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE -> pool de connexions
+#   foreign_keys=ON   -> SQLite applique les ON DELETE CASCADE (désactivés par défaut)
+#   journal_mode=WAL  -> les lectures ne sont plus bloquées par une écriture en cours
+#   busy_timeout      -> une écriture attend la fin de la précédente au lieu d'échouer
+#   synchronous       -> NORMAL suffit en WAL (pas de corruption possible, seules les
+#                        dernières transactions peuvent être perdues en cas de coupure)
+import os
+
+from sqlalchemy import event
+
+from models import db
+
+DEFAULT_DATABASE_URL = 'sqlite:///app.db'
+
+# Options du pool de connexions et variables d'environnement correspondantes
+POOL_SETTINGS = {
+    'pool_size': ('DB_POOL_SIZE', 10),        # Connexions gardées ouvertes
+    'max_overflow': ('DB_MAX_OVERFLOW', 20),  # Connexions supplémentaires en pointe
+    'pool_timeout': ('DB_POOL_TIMEOUT', 30),  # Attente (s) d'une connexion libre
+    'pool_recycle': ('DB_POOL_RECYCLE', 1800),  # Renouveler les connexions après (s)
+}
+
+DATABASE_DEFAULTS = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_BUSY_TIMEOUT': 5000,  # En millisecondes
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+}
+
+
+def database_url(environ=os.environ):
+    # Adresse de la base ; "postgres://" (ancien schéma de certains hébergeurs) n'est
+    # plus reconnu par SQLAlchemy
+    url = environ.get('DATABASE_URL') or DEFAULT_DATABASE_URL
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def database_config(environ=os.environ):
+    # Configuration Flask-SQLAlchemy tirée de l'environnement
+    engine_options = {option: int(environ.get(variable) or default)
+                      for option, (variable, default) in POOL_SETTINGS.items()}
+    engine_options['pool_pre_ping'] = True  # Écarter les connexions coupées avant usage
+    return {
+        'SQLALCHEMY_DATABASE_URI': database_url(environ),
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options,
+    }
+
+
+def install_sqlite_pragmas(engine, journal_mode, busy_timeout, synchronous):
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(busy_timeout)}")
+        cursor.execute("PRAGMA foreign_keys = ON")
+        if journal_mode:
+            cursor.execute(f"PRAGMA journal_mode = {journal_mode}")
+        if synchronous:
+            cursor.execute(f"PRAGMA synchronous = {synchronous}")
+        cursor.close()
+
+
+def init_database(app):
+    # Remplace db.init_app(app) : moteur configuré depuis app.config
+    for key, value in DATABASE_DEFAULTS.items():
+        app.config.setdefault(key, value)
+    db.init_app(app)
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name == 'sqlite':
+            install_sqlite_pragmas(engine,
+                                   app.config['SQLITE_JOURNAL_MODE'],
+                                   app.config['SQLITE_BUSY_TIMEOUT'],
+                                   app.config['SQLITE_SYNCHRONOUS'])
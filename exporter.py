@@ -0,0 +1,172 @@
+# exporter.py
+# Export des allocations calculées (avec montants vérif et écarts) en CSV, XLSX ou
+# Parquet. Les lignes sont lues par paquets de projets (pagination par identifiant) et
+# écrites au fil de l'eau : la mémoire utilisée dépend de la taille d'un paquet, et la
+# transaction de lecture est terminée entre deux paquets pour ne pas bloquer les écritures.
+import csv
+import importlib.util
+import io
+import tempfile
+
+from models import db, Project, Phase, Intervenant, PhaseIntervenant, PhaseIntervenantVerif, \
+    IntervenantSummary
+from services import filter_projects
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# Paquets optionnels nécessaires à certains formats
+EXPORT_DEPENDENCIES = {'xlsx': 'openpyxl', 'parquet': 'pyarrow'}
+
+# Nombre de projets lus par requête
+EXPORT_CHUNK_SIZE = 200
+
+COLUMNS = ('project_id', 'projet', 'total_marche', 'phase', 'pourcentage_phase', 'intervenant',
+           'montant_verif', 'verif_phase', 'final_percent', 'final_amount', 'ecart', 'ecart_percent')
+
+
+def export_query(project_ids):
+    # Une ligne par cellule phase x intervenant allouée ou ayant un montant vérif
+    return (
+        db.select(Project.id, Project.name, Project.total_marche,
+                  Phase.name, Phase.percentage,
+                  Intervenant.name, Intervenant.montant_verif,
+                  PhaseIntervenantVerif.montant_verif,
+                  PhaseIntervenant.final_percent, PhaseIntervenant.final_amount,
+                  IntervenantSummary.ecart, IntervenantSummary.ecart_percent)
+        .select_from(Phase)
+        .join(Project, Project.id == Phase.project_id)
+        .join(Intervenant, Intervenant.project_id == Phase.project_id)
+        .outerjoin(PhaseIntervenant, db.and_(PhaseIntervenant.phase_id == Phase.id,
+                                             PhaseIntervenant.intervenant_id == Intervenant.id))
+        .outerjoin(PhaseIntervenantVerif, db.and_(PhaseIntervenantVerif.phase_id == Phase.id,
+                                                  PhaseIntervenantVerif.intervenant_id == Intervenant.id))
+        .outerjoin(IntervenantSummary, IntervenantSummary.intervenant_id == Intervenant.id)
+        .where(Phase.project_id.in_(project_ids))
+        .where(db.or_(PhaseIntervenant.id.is_not(None), PhaseIntervenantVerif.id.is_not(None)))
+        .order_by(Phase.project_id, Phase.id, Intervenant.id)
+    )
+
+
+def export_chunks(project_id=None, search='', min_total=None, max_total=None,
+                  chunk_size=EXPORT_CHUNK_SIZE):
+    # Lignes à exporter, par paquets (listes de tuples dans l'ordre de COLUMNS)
+    ids_query = filter_projects(db.select(Project.id), search, min_total, max_total)
+    if project_id is not None:
+        ids_query = ids_query.where(Project.id == project_id)
+
+    last_id = 0
+    while True:
+        project_ids = db.session.scalars(
+            ids_query.where(Project.id > last_id).order_by(Project.id).limit(chunk_size)
+        ).all()
+        if not project_ids:
+            break
+        rows = [tuple(row) for row in db.session.execute(export_query(project_ids))]
+        # Terminer la transaction de lecture entre deux paquets
+        db.session.rollback()
+        if rows:
+            yield rows
+        last_id = project_ids[-1]
+
+
+# -- Écriture des formats ----------------------------------------
+
+def csv_stream(chunks):
+    # CSV ";" lisible par Excel (BOM UTF-8), un bloc de texte par paquet
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    writer.writerow(COLUMNS)
+    yield '\ufeff' + buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+def xlsx_stream(chunks):
+    # Le format XLSX est une archive zip : le classeur est écrit en mode write_only
+    # (lignes écrites sur disque au fur et à mesure) puis renvoyé par blocs
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Allocations')
+    sheet.append(COLUMNS)
+    for rows in chunks:
+        for row in rows:
+            sheet.append(row)
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            block = output.read(64 * 1024)
+            if not block:
+                break
+            yield block
+
+
+class _ChunkSink(io.RawIOBase):
+    # Fichier en écriture seule dont le contenu est vidé après chaque paquet
+    def __init__(self):
+        self.blocks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.blocks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.blocks)
+        self.blocks = []
+        return data
+
+
+def parquet_stream(chunks):
+    # Un groupe de lignes Parquet par paquet
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([
+        ('project_id', pa.int64()), ('projet', pa.string()), ('total_marche', pa.float64()),
+        ('phase', pa.string()), ('pourcentage_phase', pa.float64()),
+        ('intervenant', pa.string()), ('montant_verif', pa.float64()),
+        ('verif_phase', pa.float64()), ('final_percent', pa.float64()), ('final_amount', pa.float64()),
+        ('ecart', pa.float64()), ('ecart_percent', pa.float64()),
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for rows in chunks:
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def check_format(export_format):
+    # Vérifier le format (et la présence de sa dépendance) avant de commencer l'export
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Format d'export inconnu : '{export_format}' ({', '.join(EXPORT_FORMATS)})")
+    module = EXPORT_DEPENDENCIES.get(export_format)
+    if module is not None and importlib.util.find_spec(module) is None:
+        raise ValueError(f"L'export {export_format.upper()} nécessite le paquet {module}")
+
+
+def export_stream(export_format, chunks):
+    # Générateur des blocs du fichier exporté (texte pour le CSV, octets sinon)
+    check_format(export_format)
+    if export_format == 'csv':
+        return csv_stream(chunks)
+    if export_format == 'xlsx':
+        return xlsx_stream(chunks)
+    return parquet_stream(chunks)
@@ -1,8 +1,31 @@
 # generate_test_data.py
-from app import app, db
-from models import Project, Phase, Intervenant
+# Données de test : deux projets d'exemple (sans option), ou un jeu de données
+# synthétique de la taille voulue pour les tests de charge et les benchmarks :
+#   python generate_test_data.py --projects 10000 --phases 5-15 --intervenants 4-12 \
+#       --null 0.5 --zero 0.2 --seed 42 --database bench.db
+# Les projets sont insérés par paquets avec des requêtes groupées (voir importer.py).
+import argparse
+import os
+import time
+
+import numpy as np
+from flask import Flask
+from sqlalchemy.orm import selectinload
+
+from database import database_config, init_database
+from importer import IMPORT_CHUNK_SIZE, ImportReport, insert_projects
+from models import db, Project, Phase, Intervenant
+from services import recalculate_allocations
+from summary import refresh_summary
+
+# Noms des phases et des intervenants générés (complétés d'un numéro au-delà)
+PHASE_NAMES = ('ESQ', 'APS', 'APD', 'PRO', 'DCE', 'ACT', 'VISA', 'DET', 'AOR', 'OPC')
+INTERVENANT_NAMES = ('Architecte', 'BET Structure', 'BET Fluides', 'Économiste', 'Acousticien',
+                     'Paysagiste', 'BET VRD', 'OPC')
 
 def generate_test_data():
+    from app import app
+
     # Créer un contexte d'application
     with app.app_context():
         # Vérifier si des données existent déjà
@@ -56,11 +79,141 @@ def generate_test_data():
             Intervenant(name="MB", montant_verif=140000.0, project_id=projet2.id)
         ]
         db.session.add_all(intervenants2)
+        db.session.flush()
+        
+        # Totaux matérialisés des deux projets
+        refresh_summary(projet1)
+        refresh_summary(projet2)
         
         # Enregistrer toutes les modifications
         db.session.commit()
         
         print("Données de test générées avec succès!")
 
+
+# -- Jeu de données synthétique ----------------------------------
+
+def dataset_app(database_url):
+    # Application minimale reliée à la base à remplir (fichier séparé des benchmarks
+    # par exemple), sans passer par la configuration de app.py
+    app = Flask(__name__)
+    app.config.update(database_config({'DATABASE_URL': database_url}))
+    init_database(app)
+    return app
+
+
+def parse_range(value):
+    # "8" -> (8, 8) ; "5-15" -> (5, 15)
+    low, _, high = str(value).partition('-')
+    low, high = int(low), int(high or low)
+    if low < 1 or high < low:
+        raise ValueError(f"intervalle invalide : '{value}'")
+    return low, high
+
+
+def _names(base, count):
+    return [base[k] if k < len(base) else f"{base[k % len(base)]} {k // len(base) + 1}" for k in range(count)]
+
+
+def synthetic_project(rng, number, n_phases, n_intervenants, null_share, zero_share):
+    # Un projet au format de importer.insert_projects. Les pourcentages des phases font
+    # 100% ; les montants vérif des intervenants se partagent le total du marché. Chaque
+    # cellule de la grille vérif est non spécifiée (pas de ligne) avec la probabilité
+    # null_share, nulle avec la probabilité zero_share, fixée sinon. L'intervenant 'MB'
+    # (tampon de l'allocation) n'a que des cellules non spécifiées.
+    total_marche = float(round(rng.uniform(1e5, 1e7), -3))
+
+    weights = rng.uniform(0.5, 2.0, n_phases)
+    percentages = np.round(weights / weights.sum() * 100, 2)
+    percentages[-1] = round(100 - percentages[:-1].sum(), 2)
+    phases = dict(zip(_names(PHASE_NAMES, n_phases), percentages.tolist()))
+
+    shares = rng.uniform(0.5, 2.0, n_intervenants)
+    montants = np.round(shares / shares.sum() * total_marche, 2)
+    intervenant_names = _names(INTERVENANT_NAMES, n_intervenants - 1) + ['MB']
+    intervenants = dict(zip(intervenant_names, montants.tolist()))
+
+    # Montant fixé : part de l'intervenant dans la phase, à ±20% près
+    draws = rng.random((n_phases, n_intervenants))
+    amounts = np.round(np.outer(percentages / 100, montants) * rng.uniform(0.8, 1.2, (n_phases, n_intervenants)), 2)
+    amounts[draws < null_share + zero_share] = 0.0
+    cells = draws >= null_share
+    cells[:, -1] = False
+    verifs = [(None, phase, intervenant_names[j], float(amounts[i, j]))
+              for i, phase in enumerate(phases) for j in np.flatnonzero(cells[i])]
+
+    return {'name': f"Projet synthétique {number}", 'total_marche': total_marche,
+            'phases': phases, 'intervenants': intervenants, 'verifs': verifs}
+
+
+def generate_dataset(projects, phases=(5, 15), intervenants=(4, 12), null_share=0.5, zero_share=0.2,
+                     seed=0, chunk_size=IMPORT_CHUNK_SIZE, allocate=False, progress=None):
+    # Insérer des projets synthétiques dans la base du contexte courant ; retourne un
+    # ImportReport. allocate=True calcule aussi les allocations (et les totaux).
+    if null_share < 0 or zero_share < 0 or null_share + zero_share > 1:
+        raise ValueError("les parts de cellules non spécifiées et nulles doivent faire au plus 1")
+    rng = np.random.default_rng(seed)
+    first = (db.session.scalar(db.select(db.func.max(Project.id))) or 0) + 1
+    report = ImportReport()
+
+    for start in range(0, projects, chunk_size):
+        chunk = [synthetic_project(rng, first + number,
+                                   int(rng.integers(phases[0], phases[1] + 1)),
+                                   int(rng.integers(max(intervenants[0], 2), max(intervenants[1], 2) + 1)),
+                                   null_share, zero_share)
+                 for number in range(start, min(start + chunk_size, projects))]
+        insert_projects(chunk, report)
+        if allocate:
+            recalculate_allocations(Project.query.options(
+                selectinload(Project.phases), selectinload(Project.intervenants)
+            ).filter(Project.id.in_([project['id'] for project in chunk])).order_by(Project.id).all())
+            db.session.commit()
+        if progress is not None:
+            progress(report)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Générer des données de test.")
+    parser.add_argument('--projects', type=int, help="Nombre de projets synthétiques (sans cette "
+                                                     "option : deux projets d'exemple)")
+    parser.add_argument('--phases', type=parse_range, default='5-15', help="Phases par projet (8 ou 5-15)")
+    parser.add_argument('--intervenants', type=parse_range, default='4-12',
+                        help="Intervenants par projet, 'MB' compris (6 ou 4-12)")
+    parser.add_argument('--null', type=float, default=0.5, help="Part des cellules vérif non spécifiées")
+    parser.add_argument('--zero', type=float, default=0.2, help="Part des cellules vérif à 0 (le reste est fixé)")
+    parser.add_argument('--seed', type=int, default=0, help="Graine du générateur aléatoire")
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help="Projets insérés par transaction")
+    parser.add_argument('--allocate', action='store_true', help="Calculer aussi les allocations")
+    parser.add_argument('--database', help="Fichier SQLite (ou adresse de base) à remplir à la place de "
+                                           "la base de l'application ; créé si besoin")
+    parser.add_argument('--append', action='store_true', help="Ajouter à une base qui contient déjà des projets")
+    args = parser.parse_args()
+
+    if args.projects is None:
+        generate_test_data()
+        return
+
+    if args.database is None:
+        from app import app
+    elif '://' in args.database:
+        app = dataset_app(args.database)
+    else:
+        app = dataset_app(f"sqlite:///{os.path.abspath(args.database)}")
+
+    with app.app_context():
+        db.create_all()
+        if not args.append and db.session.scalar(db.select(Project.id).limit(1)) is not None:
+            raise SystemExit("Des données existent déjà dans la base de données (--append pour ajouter).")
+        start = time.perf_counter()
+        report = generate_dataset(
+            args.projects, args.phases, args.intervenants, args.null, args.zero, args.seed,
+            args.chunk_size, args.allocate,
+            progress=lambda report: print(f"\r{report.projects}/{args.projects} projets", end='', flush=True))
+        elapsed = time.perf_counter() - start
+        print(f"\n{report.projects} projet(s), {report.phases} phase(s), {report.intervenants} intervenant(s), "
+              f"{report.verifs} montant(s) vérif en {elapsed:.1f} s ({db.engine.url})")
+
+
 if __name__ == "__main__":
-    generate_test_data()
\ No newline at end of file
+    main()
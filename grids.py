@@ -0,0 +1,207 @@
+# grids.py
+# Grilles vérif et allocation d'un projet sous forme de matrices phases x intervenants.
+# Par défaut elles sont lues dans phase_intervenants(_verif), une ligne par cellule. Avec
+# GRID_STORAGE = 'packed', chaque grille est aussi enregistrée d'un bloc (table
+# project_grids : matrice float64 et ordre des phases et des intervenants) par les
+# fonctions d'écriture ; la lecture tient alors en une ligne et np.frombuffer donne la
+# matrice sans copie. Les lignes restent la référence (export, totaux SQL) : en passant
+# au mode 'packed', 'flask pack-grids' crée les blocs des projets existants.
+from collections import namedtuple
+
+import numpy as np
+from flask import current_app
+
+from allocation import build_verif_matrix
+from models import db, PhaseIntervenant, PhaseIntervenantVerif, ProjectGrid
+
+GRID_STORAGES = ('rows', 'packed')
+
+# Types de grille et leurs couches : vérif (montants), allocation (pourcentages, montants)
+GRID_LAYERS = {'verif': 1, 'allocation': 2}
+
+# Format des blocs, indépendant de la machine
+FLOAT = np.dtype('<f8')
+INT = np.dtype('<i8')
+
+# Cellules renvoyées par GridCells, avec les attributs des lignes ORM utilisés par les templates
+VerifCell = namedtuple('VerifCell', 'montant_verif')
+AllocationCell = namedtuple('AllocationCell', 'final_percent final_amount')
+
+
+def packed_storage():
+    return current_app.config.get('GRID_STORAGE', 'rows') == 'packed'
+
+
+def project_axes(project):
+    # Ordre courant des phases et des intervenants (relations chargées)
+    return [phase.id for phase in project.phases], [intervenant.id for intervenant in project.intervenants]
+
+
+def _align(data, stored_phases, stored_intervenants, phase_ids, intervenant_ids):
+    # Remettre une grille enregistrée dans l'ordre courant des phases et des intervenants
+    # du projet, sans copie s'il n'a pas changé ; les phases et intervenants ajoutés depuis
+    # n'ont pas de cellule (NaN), ceux qui ont été supprimés disparaissent
+    if np.array_equal(stored_phases, phase_ids) and np.array_equal(stored_intervenants, intervenant_ids):
+        return data
+    aligned = np.full((data.shape[0], len(phase_ids), len(intervenant_ids)), np.nan)
+    phase_index = {phase_id: i for i, phase_id in enumerate(stored_phases.tolist())}
+    intervenant_index = {intervenant_id: j for j, intervenant_id in enumerate(stored_intervenants.tolist())}
+    rows = [(i, phase_index[phase_id]) for i, phase_id in enumerate(phase_ids) if phase_id in phase_index]
+    columns = [(j, intervenant_index[intervenant_id]) for j, intervenant_id in enumerate(intervenant_ids)
+               if intervenant_id in intervenant_index]
+    if rows and columns:
+        (target_rows, source_rows), (target_columns, source_columns) = zip(*rows), zip(*columns)
+        layers = range(data.shape[0])
+        aligned[np.ix_(layers, target_rows, target_columns)] = data[np.ix_(layers, source_rows, source_columns)]
+    return aligned
+
+
+def _grids_from_rows(kind, projects):
+    # Grilles construites à partir des lignes (une requête pour tous les projets)
+    if kind == 'verif':
+        columns = (PhaseIntervenantVerif.project_id, PhaseIntervenantVerif.phase_id,
+                   PhaseIntervenantVerif.intervenant_id, PhaseIntervenantVerif.montant_verif)
+    else:
+        columns = (PhaseIntervenant.project_id, PhaseIntervenant.phase_id, PhaseIntervenant.intervenant_id,
+                   PhaseIntervenant.final_percent, PhaseIntervenant.final_amount)
+    cells = {project.id: [] for project in projects}
+    for row in db.session.execute(db.select(*columns).where(columns[0].in_(list(cells)))):
+        cells[row[0]].append(row[1:])
+
+    grids = {}
+    for project in projects:
+        phase_ids, intervenant_ids = project_axes(project)
+        grids[project.id] = np.stack([
+            build_verif_matrix(phase_ids, intervenant_ids,
+                               ((cell[0], cell[1], cell[2 + layer]) for cell in cells[project.id]))
+            for layer in range(GRID_LAYERS[kind])
+        ])
+    return grids
+
+
+def load_grids(kind, projects):
+    # Grilles des projets (phases et intervenants chargés) : {project_id: (couches, P, I)},
+    # NaN pour les cellules sans ligne. Les matrices lues d'un bloc sont en lecture seule.
+    projects = list(projects)
+    grids = {}
+    if packed_storage() and projects:
+        by_id = {project.id: project for project in projects}
+        stored = db.session.execute(
+            db.select(ProjectGrid.project_id, ProjectGrid.phase_ids, ProjectGrid.intervenant_ids,
+                      ProjectGrid.data)
+            .where(ProjectGrid.kind == kind, ProjectGrid.project_id.in_(list(by_id)))
+        )
+        for row in stored:
+            stored_phases = np.frombuffer(row.phase_ids, dtype=INT)
+            stored_intervenants = np.frombuffer(row.intervenant_ids, dtype=INT)
+            data = np.frombuffer(row.data, dtype=FLOAT).reshape(
+                GRID_LAYERS[kind], len(stored_phases), len(stored_intervenants))
+            grids[row.project_id] = _align(data, stored_phases, stored_intervenants,
+                                           *project_axes(by_id[row.project_id]))
+    # Projets sans bloc (mode 'rows', ou bloc pas encore créé) : lecture des lignes
+    missing = [project for project in projects if project.id not in grids]
+    if missing:
+        grids.update(_grids_from_rows(kind, missing))
+    return grids
+
+
+def write_grids(kind, grids):
+    # Remplacer les blocs {project_id: (phase_ids, intervenant_ids, matrice (couches, P, I))}
+    # dans la transaction en cours
+    if not grids:
+        return
+    db.session.execute(db.delete(ProjectGrid).where(ProjectGrid.kind == kind,
+                                                    ProjectGrid.project_id.in_(list(grids))))
+    db.session.execute(ProjectGrid.__table__.insert(), [
+        {'project_id': project_id, 'kind': kind,
+         'phase_ids': np.asarray(phase_ids, dtype=INT).tobytes(),
+         'intervenant_ids': np.asarray(intervenant_ids, dtype=INT).tobytes(),
+         'data': np.ascontiguousarray(data, dtype=FLOAT).tobytes()}
+        for project_id, (phase_ids, intervenant_ids, data) in grids.items()
+    ])
+
+
+def store_grids(kind, grids):
+    # Appelé par chaque écriture de cellules, après les lignes : sans effet hors mode 'packed'
+    if packed_storage():
+        write_grids(kind, grids)
+
+
+def pack_projects(projects):
+    # Créer ou refaire les blocs de projets existants à partir de leurs lignes
+    for kind in GRID_LAYERS:
+        grids = _grids_from_rows(kind, projects)
+        write_grids(kind, {project.id: (*project_axes(project), grids[project.id]) for project in projects})
+
+
+# -- Lecture par les routes --------------------------------------
+
+class GridCells:
+    # Accès {(phase_id, intervenant_id): cellule} à une grille, comme les dictionnaires de
+    # lignes ORM qu'utilisaient les templates ; get() renvoie None pour une cellule sans ligne
+    def __init__(self, cell_type, data, phase_ids, intervenant_ids):
+        self._cell_type = cell_type
+        self._data = data
+        self._phase_index = {phase_id: i for i, phase_id in enumerate(phase_ids)}
+        self._intervenant_index = {intervenant_id: j for j, intervenant_id in enumerate(intervenant_ids)}
+
+    def get(self, key, default=None):
+        i = self._phase_index.get(key[0])
+        j = self._intervenant_index.get(key[1])
+        if i is None or j is None:
+            return default
+        values = self._data[:, i, j].tolist()
+        if values[0] != values[0]:  # NaN : pas de ligne
+            return default
+        return self._cell_type(*values)
+
+    def __getitem__(self, key):
+        cell = self.get(key)
+        if cell is None:
+            raise KeyError(key)
+        return cell
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+def verif_matrix(project):
+    # Grille vérif (P, I), NaN = non spécifié
+    return load_grids('verif', [project])[project.id][0]
+
+
+def allocation_matrices(project):
+    # Pourcentages et montants alloués (P, I), NaN = pas d'allocation
+    data = load_grids('allocation', [project])[project.id]
+    return data[0], data[1]
+
+
+def verif_row(project, phase_id):
+    # Montants vérif d'une seule phase (I,), NaN = non spécifié ; en mode 'rows', seules
+    # les lignes de cette phase sont lues
+    phase_ids, intervenant_ids = project_axes(project)
+    if packed_storage():
+        return verif_matrix(project)[phase_ids.index(phase_id)]
+    rows = db.session.execute(
+        db.select(PhaseIntervenantVerif.intervenant_id, PhaseIntervenantVerif.montant_verif)
+        .where(PhaseIntervenantVerif.project_id == project.id, PhaseIntervenantVerif.phase_id == phase_id)
+    )
+    return build_verif_matrix([phase_id], intervenant_ids,
+                              ((phase_id, intervenant_id, montant_verif) for intervenant_id, montant_verif in rows))[0]
+
+
+def verif_cells(project):
+    return GridCells(VerifCell, load_grids('verif', [project])[project.id], *project_axes(project))
+
+
+def verif_row_cells(project, phase_id):
+    return GridCells(VerifCell, verif_row(project, phase_id)[None, None], [phase_id], project_axes(project)[1])
+
+
+def allocation_cells(project):
+    return GridCells(AllocationCell, load_grids('allocation', [project])[project.id], *project_axes(project))
+
+
+def dense_values(matrix):
+    # Matrice -> listes de nombres, None pour NaN (JSON)
+    return [[None if value != value else value for value in row] for row in matrix.tolist()]
@@ -0,0 +1,288 @@
+# importer.py
+# Import en masse de projets depuis un fichier CSV ou XLSX. Le fichier est lu ligne à
+# ligne et les projets sont insérés par paquets (une transaction par paquet) : la
+# mémoire utilisée dépend de la taille d'un paquet, pas de celle du fichier.
+#
+# Une ligne par élément, la colonne "type" indique de quoi il s'agit :
+#   type        | projet | total_marche | phase | pourcentage | intervenant | montant_verif
+#   projet      | Ecole  | 1200000      |       |             |             |
+#   phase       | Ecole  |              | ESQ   | 10          |             |
+#   intervenant | Ecole  |              |       |             | MB          | 300000
+#   verif       | Ecole  |              | ESQ   |             | MB          | 15000
+# Les lignes d'un projet suivent sa ligne "projet" ; les lignes "verif" désignent la
+# phase et l'intervenant par leur nom (montant vide = non spécifié, 0 = non impliqué).
+import csv
+import io
+import os
+import zipfile
+
+from allocation import build_verif_matrix
+from grids import packed_storage, store_grids
+from models import db, Project, Phase, Intervenant, PhaseIntervenantVerif
+from services import PERCENT_TOLERANCE
+from summary import insert_new_summaries
+
+COLUMNS = ('type', 'projet', 'total_marche', 'phase', 'pourcentage', 'intervenant', 'montant_verif')
+
+# Nombre de projets insérés par transaction
+IMPORT_CHUNK_SIZE = 500
+
+# Nombre maximal d'erreurs conservées dans le rapport
+MAX_REPORTED_ERRORS = 100
+
+
+class ImportReport:
+    def __init__(self):
+        self.projects = 0
+        self.phases = 0
+        self.intervenants = 0
+        self.verifs = 0
+        self.skipped = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f"ligne {line} : {message}")
+
+    def __repr__(self):
+        return (f"<ImportReport(projects={self.projects}, phases={self.phases}, "
+                f"intervenants={self.intervenants}, verifs={self.verifs}, skipped={self.skipped})>")
+
+
+# -- Lecture du fichier ------------------------------------------
+
+def _csv_rows(stream):
+    # Séparateur ";" (export Excel français) ou ","
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    first_line = text.readline()
+    delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
+    yield from csv.reader([first_line], delimiter=delimiter)
+    yield from csv.reader(text, delimiter=delimiter)
+
+
+def _xlsx_rows(stream):
+    # Première feuille du classeur, lue en mode streaming
+    try:
+        import openpyxl
+    except ImportError:
+        raise ValueError("L'import de fichiers XLSX nécessite le paquet openpyxl")
+    try:
+        workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    except zipfile.BadZipFile:
+        raise ValueError("Fichier XLSX illisible")
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_rows(stream, filename):
+    # (numéro de ligne, {colonne: valeur}) pour chaque ligne non vide du fichier
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.xlsx':
+        rows = _xlsx_rows(stream)
+    elif extension in ('.csv', '.txt'):
+        rows = _csv_rows(stream)
+    else:
+        raise ValueError(f"Format non pris en charge : '{extension}' (CSV ou XLSX attendu)")
+
+    header = next(rows, None) or ()
+    columns = [str(column or '').strip().lower() for column in header]
+    missing = [column for column in ('type', 'projet') if column not in columns]
+    if missing:
+        raise ValueError(f"Colonne(s) manquante(s) dans l'en-tête : {', '.join(missing)}")
+
+    for line, values in enumerate(rows, start=2):
+        record = {column: value for column, value in zip(columns, values)
+                  if column in COLUMNS and value not in (None, '')}
+        if record:
+            yield line, record
+
+
+def parse_number(value):
+    # Nombre d'une cellule : "1 234,5" (format français) ou 1234.5 ; None si vide
+    if value is None or isinstance(value, (int, float)):
+        return None if value is None else float(value)
+    value = str(value).strip().replace(' ', '').replace(' ', '').replace(',', '.')
+    return float(value) if value else None
+
+
+def parse_text(value):
+    return str(value).strip() if value is not None else ''
+
+
+# -- Validation des projets --------------------------------------
+
+def _new_project(line, record, report):
+    project = {'line': line, 'name': parse_text(record.get('projet')), 'valid': True,
+               'phases': {}, 'intervenants': {}, 'verifs': []}
+    if not project['name']:
+        report.error(line, "nom de projet manquant")
+        project['valid'] = False
+    try:
+        project['total_marche'] = parse_number(record.get('total_marche'))
+    except ValueError:
+        project['total_marche'] = None
+    if project['total_marche'] is None:
+        report.error(line, f"total_marche invalide pour le projet '{project['name']}'")
+        project['valid'] = False
+    return project
+
+
+def _add_item(project, line, kind, record, report):
+    # Ajouter une phase, un intervenant ou un montant vérif au projet en cours
+    try:
+        if kind == 'phase':
+            name = parse_text(record.get('phase'))
+            percentage = parse_number(record.get('pourcentage'))
+            if not name or percentage is None:
+                raise ValueError("phase sans nom ou sans pourcentage")
+            if name in project['phases']:
+                raise ValueError(f"phase '{name}' en double")
+            project['phases'][name] = percentage
+        elif kind == 'intervenant':
+            name = parse_text(record.get('intervenant'))
+            montant_verif = parse_number(record.get('montant_verif'))
+            if not name or montant_verif is None:
+                raise ValueError("intervenant sans nom ou sans montant vérif")
+            if name in project['intervenants']:
+                raise ValueError(f"intervenant '{name}' en double")
+            project['intervenants'][name] = montant_verif
+        elif kind == 'verif':
+            phase = parse_text(record.get('phase'))
+            intervenant = parse_text(record.get('intervenant'))
+            montant_verif = parse_number(record.get('montant_verif'))
+            if montant_verif is not None:
+                project['verifs'].append((line, phase, intervenant, montant_verif))
+        else:
+            raise ValueError(f"type de ligne inconnu '{kind}'")
+    except ValueError as error:
+        report.error(line, str(error))
+        project['valid'] = False
+
+
+def _check_project(project, report):
+    # Règles appliquées par les formulaires : somme des phases = 100%, vérifs sur des
+    # phases et intervenants du projet
+    if project['phases']:
+        total = sum(project['phases'].values())
+        if abs(total - 100.0) > PERCENT_TOLERANCE:
+            report.error(project['line'], f"la somme des pourcentages du projet '{project['name']}' "
+                                          f"doit être égale à 100% (actuellement {total:.2f}%)")
+            project['valid'] = False
+    cells = set()
+    for line, phase, intervenant, _ in project['verifs']:
+        if phase not in project['phases'] or intervenant not in project['intervenants']:
+            report.error(line, f"vérif sur une phase ou un intervenant inconnu ('{phase}' / '{intervenant}')")
+            project['valid'] = False
+        elif (phase, intervenant) in cells:
+            report.error(line, f"vérif en double pour '{phase}' / '{intervenant}'")
+            project['valid'] = False
+        cells.add((phase, intervenant))
+    if not project['valid']:
+        report.skipped += 1
+    return project['valid']
+
+
+def parse_projects(rows, report):
+    # Regrouper les lignes par projet ; seuls les projets valides sont renvoyés
+    project = None
+    for line, record in rows:
+        kind = parse_text(record.get('type')).lower()
+        if kind == 'projet':
+            if project is not None and _check_project(project, report):
+                yield project
+            project = _new_project(line, record, report)
+            continue
+        if project is None:
+            report.error(line, "ligne placée avant toute ligne 'projet'")
+            continue
+        name = parse_text(record.get('projet'))
+        if name and name != project['name']:
+            report.error(line, f"ligne du projet '{name}' placée dans le projet '{project['name']}'")
+            project['valid'] = False
+            continue
+        _add_item(project, line, kind, record, report)
+    if project is not None and _check_project(project, report):
+        yield project
+
+
+# -- Insertion ---------------------------------------------------
+
+def _insert_returning_ids(model, rows):
+    # Insertion groupée ; identifiants renvoyés dans l'ordre des lignes. Les requêtes
+    # visent la table (et non le modèle) pour éviter le traitement ORM ligne par ligne.
+    if not rows:
+        return []
+    table = model.__table__
+    return db.session.scalars(
+        table.insert().returning(table.c.id, sort_by_parameter_order=True), rows
+    ).all()
+
+
+def insert_projects(projects, report):
+    # Insérer un paquet de projets validés en une transaction (une requête groupée par table),
+    # avec leurs totaux matérialisés (pas encore d'allocation).
+    project_ids = _insert_returning_ids(Project, [
+        {'name': project['name'], 'total_marche': project['total_marche']} for project in projects
+    ])
+
+    phase_rows = []
+    intervenant_rows = []
+    for project, project_id in zip(projects, project_ids):
+        project['id'] = project_id
+        phase_rows.extend({'project_id': project_id, 'name': name, 'percentage': percentage}
+                          for name, percentage in project['phases'].items())
+        intervenant_rows.extend({'project_id': project_id, 'name': name, 'montant_verif': montant_verif}
+                                for name, montant_verif in project['intervenants'].items())
+    phase_ids = iter(_insert_returning_ids(Phase, phase_rows))
+    intervenant_ids = iter(_insert_returning_ids(Intervenant, intervenant_rows))
+
+    verif_rows = []
+    grids = {}
+    summaries = []
+    packed = packed_storage()
+    for project in projects:
+        phases = {name: next(phase_ids) for name in project['phases']}
+        intervenants = {name: next(intervenant_ids) for name in project['intervenants']}
+        cells = [(phases[phase], intervenants[intervenant], montant_verif)
+                 for _, phase, intervenant, montant_verif in project['verifs']]
+        verif_totals = dict.fromkeys(intervenants.values(), 0.0)
+        for _, intervenant_id, montant_verif in cells:
+            verif_totals[intervenant_id] += montant_verif
+        summaries.append((project['id'], project['total_marche'], sum(project['phases'].values()),
+                          [(intervenant_id, project['intervenants'][name], verif_totals[intervenant_id])
+                           for name, intervenant_id in intervenants.items()]))
+        verif_rows.extend({'project_id': project['id'], 'phase_id': phase_id,
+                           'intervenant_id': intervenant_id, 'montant_verif': montant_verif}
+                          for phase_id, intervenant_id, montant_verif in cells)
+        if packed:
+            grids[project['id']] = (list(phases.values()), list(intervenants.values()),
+                                    build_verif_matrix(phases.values(), intervenants.values(), cells)[None])
+    if verif_rows:
+        db.session.execute(PhaseIntervenantVerif.__table__.insert(), verif_rows)
+    store_grids('verif', grids)
+    insert_new_summaries(summaries)
+    db.session.commit()
+
+    report.projects += len(projects)
+    report.phases += len(phase_rows)
+    report.intervenants += len(intervenant_rows)
+    report.verifs += len(verif_rows)
+
+
+def import_projects(stream, filename, chunk_size=IMPORT_CHUNK_SIZE):
+    # Importer un fichier (flux binaire) ; retourne un ImportReport.
+    # ValueError si le fichier lui-même est illisible (format, en-tête).
+    report = ImportReport()
+    chunk = []
+    for project in parse_projects(read_rows(stream, filename), report):
+        chunk.append(project)
+        if len(chunk) >= chunk_size:
+            insert_projects(chunk, report)
+            chunk = []
+    if chunk:
+        insert_projects(chunk, report)
+    return report
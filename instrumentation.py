@@ -0,0 +1,296 @@
+# instrumentation.py
+# Mesures par requête, activées par INSTRUMENTATION : nombre et durée des requêtes SQL
+# (les plus lentes sont conservées), objets chargés par l'ORM, durée du rendu des
+# gabarits et du moteur d'allocation. Elles sont renvoyées dans l'en-tête Server-Timing,
+# écrites sur une ligne de journal JSON et cumulées en histogrammes par route (/_metrics).
+# Les tâches de recalcul (jobs.py) sont mesurées de la même façon, passe par passe, hors
+# requête : une ligne de journal par tâche et des histogrammes sous 'job:recalculate'.
+# Avec PROFILE_DIR, les routes d'allocation appelées avec ?profile=1 sont exécutées sous
+# cProfile et le profil est enregistré dans ce dossier (lisible avec pstats ou snakeviz) ;
+# pour le bouton « Calculer l'allocation », c'est la tâche lancée qui est profilée.
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger('honoraires.requests')
+
+# Bornes supérieures des classes des histogrammes (en ms, en nombre de requêtes pour
+# sql_count) ; la dernière classe est ouverte
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Nombre de requêtes SQL les plus lentes conservées par requête HTTP
+SLOWEST_STATEMENTS = 3
+
+# Routes dont le profil cProfile peut être enregistré (calculate_allocation ne fait
+# qu'enregistrer une tâche : c'est la tâche qui est profilée, voir jobs.py)
+PROFILED_ENDPOINTS = ('project_allocation', 'api.allocation_get', 'api.allocation_calculate')
+
+# Nom sous lequel les mesures des tâches de recalcul sont cumulées
+JOB_METRICS = 'job:recalculate'
+
+# Mesures de la tâche en cours d'exécution dans ce fil (hors requête, voir collect_timers)
+_job_stats = ContextVar('job_stats', default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.slowest = []  # (durée, requête), du plus lent au plus rapide
+        self.orm_objects = 0
+        self.render_time = 0.0
+        self.timers = {}  # nom -> durée (allocation, ...)
+
+    def add_statement(self, duration, statement):
+        self.sql_count += 1
+        self.sql_time += duration
+        if len(self.slowest) < SLOWEST_STATEMENTS or duration > self.slowest[-1][0]:
+            self.slowest.append((duration, ' '.join(statement.split())[:300]))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[SLOWEST_STATEMENTS:]
+
+
+def _current_stats():
+    if has_request_context():
+        return g.get('request_stats')
+    return _job_stats.get()
+
+
+@contextmanager
+def collect_timers():
+    # Mesurer les étapes (timed) d'un traitement hors requête : tâche de recalcul, dans
+    # le fil des tâches ou dans un processus du pool. Donne le dictionnaire nom -> durée (s).
+    stats = RequestStats()
+    token = _job_stats.set(stats)
+    try:
+        yield stats.timers
+    finally:
+        _job_stats.reset(token)
+
+
+def add_timers(total, timers):
+    # Cumuler les durées d'un paquet dans celles de la tâche
+    for name, duration in timers.items():
+        total[name] = total.get(name, 0.0) + duration
+    return total
+
+
+@contextmanager
+def timed(name):
+    # Mesurer une étape de la requête ou de la tâche en cours (sans effet ailleurs)
+    stats = _current_stats()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.timers[name] = stats.timers.get(name, 0.0) + time.perf_counter() - start
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def to_dict(self):
+        # Classes dans l'ordre : [borne supérieure, effectif], la dernière sans borne
+        buckets = [[bound, count] for bound, count in zip(HISTOGRAM_BOUNDS + (None,), self.counts)]
+        return {'count': self.count, 'sum': round(self.total, 3),
+                'mean': round(self.total / self.count, 3) if self.count else 0.0,
+                'max': round(self.maximum, 3), 'buckets': buckets}
+
+
+class Instrumentation:
+    def __init__(self, app=None):
+        self.enabled = False
+        self.profile_dir = None
+        self._metrics = {}  # endpoint -> {mesure: Histogram}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['instrumentation'] = self
+        self.enabled = bool(app.config.get('INSTRUMENTATION'))
+        self.profile_dir = app.config.get('PROFILE_DIR')
+        if not self.enabled and not self.profile_dir:
+            return
+
+        if self.enabled:
+            # Une ligne JSON par requête, même sans configuration du journal par l'application
+            if not logger.handlers:
+                logger.addHandler(logging.StreamHandler())
+                logger.setLevel(logging.INFO)
+            with app.app_context():
+                engine = db.engine
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(db.Model, 'load', self._on_load, propagate=True)
+            before_render_template.connect(self._before_render, app)
+            template_rendered.connect(self._after_render, app)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    # -- Événements SQLAlchemy et Jinja --
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        stats = _current_stats()
+        if stats is not None:
+            stats.add_statement(time.perf_counter() - start, statement)
+
+    def _on_load(self, target, context):
+        stats = _current_stats()
+        if stats is not None:
+            stats.orm_objects += 1
+
+    def _before_render(self, sender, template, context, **extra):
+        g.render_start = time.perf_counter()
+
+    def _after_render(self, sender, template, context, **extra):
+        stats = _current_stats()
+        if stats is not None and 'render_start' in g:
+            stats.render_time += time.perf_counter() - g.pop('render_start')
+
+    # -- Cycle de la requête --
+
+    def _before_request(self):
+        if self.enabled:
+            g.request_stats = RequestStats()
+        if (self.profile_dir and request.endpoint in PROFILED_ENDPOINTS
+                and request.args.get('profile') == '1'):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    def _after_request(self, response):
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"{request.endpoint.replace('.', '_')}-"
+                                                  f"{'-'.join(map(str, (request.view_args or {}).values()))}-"
+                                                  f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+            profiler.dump_stats(path)
+            response.headers['X-Profile'] = os.path.basename(path)
+
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+        total = (time.perf_counter() - stats.start) * 1000
+        sql = stats.sql_time * 1000
+        render = stats.render_time * 1000
+        timers = {name: duration * 1000 for name, duration in stats.timers.items()}
+
+        # Server-Timing : visible dans l'onglet réseau des navigateurs
+        entries = [f'sql;dur={sql:.2f};desc="{stats.sql_count} requete(s)"', f'render;dur={render:.2f}']
+        entries.extend(f'{name};dur={duration:.2f}' for name, duration in timers.items())
+        entries.append(f'total;dur={total:.2f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(total, 3),
+            'sql_count': stats.sql_count,
+            'sql_ms': round(sql, 3),
+            'orm_objects': stats.orm_objects,
+            'render_ms': round(render, 3),
+            **{f'{name}_ms': round(duration, 3) for name, duration in timers.items()},
+            'slowest_sql': [{'ms': round(duration * 1000, 3), 'sql': statement}
+                            for duration, statement in stats.slowest],
+        }, ensure_ascii=False))
+
+        self.record(request.endpoint or 'inconnu', {
+            'duration_ms': total, 'sql_ms': sql, 'sql_count': stats.sql_count, 'render_ms': render,
+            **{f'{name}_ms': duration for name, duration in timers.items()},
+        })
+        return response
+
+    def _teardown_request(self, error=None):
+        # Requête interrompue par une exception : arrêter le profileur
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+
+    # -- Tâches de recalcul --
+
+    @contextmanager
+    def profile_job(self, job_id, enabled=True):
+        # Profil cProfile d'une tâche (enregistré comme ceux des routes, si PROFILE_DIR)
+        if not (enabled and self.profile_dir):
+            yield None
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, f"job-{job_id}-{time.strftime('%Y%m%d-%H%M%S')}-"
+                                                                f"{os.getpid()}.prof"))
+
+    def record_job(self, job, duration, timers):
+        # Durée totale et durée de chaque passe d'une tâche terminée (en secondes)
+        if not self.enabled:
+            return
+        timers = {name: value * 1000 for name, value in timers.items()}
+        logger.info(json.dumps({
+            'job': job.id,
+            'project_id': job.project_id,
+            'status': job.status,
+            'projects': job.done,
+            'duration_ms': round(duration * 1000, 3),
+            **{f'{name}_ms': round(value, 3) for name, value in timers.items()},
+        }, ensure_ascii=False))
+        self.record(JOB_METRICS, {'duration_ms': duration * 1000,
+                                  **{f'{name}_ms': value for name, value in timers.items()}})
+
+    # -- Agrégats --
+
+    def record(self, endpoint, values):
+        with self._lock:
+            histograms = self._metrics.setdefault(endpoint, {})
+            for name, value in values.items():
+                histograms.setdefault(name, Histogram()).add(value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'bounds_ms': list(HISTOGRAM_BOUNDS),
+                'endpoints': {endpoint: {name: histogram.to_dict() for name, histogram in histograms.items()}
+                              for endpoint, histograms in sorted(self._metrics.items())},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
@@ -0,0 +1,279 @@
+# jobs.py
+# Recalcul des allocations en arrière-plan, sans serveur de file d'attente : les tâches
+# sont enregistrées dans la table jobs, puis exécutées par un fil du processus web. Une
+# tâche d'un seul paquet (un projet, par exemple) est calculée dans ce fil ; les plus
+# grandes sont réparties sur un pool de processus (un par cœur par défaut), créé une fois
+# et gardé pour les tâches suivantes. Les routes web se contentent d'enregistrer la tâche
+# et répondent immédiatement.
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask
+from sqlalchemy.orm import selectinload
+
+from database import init_database
+from instrumentation import add_timers, collect_timers
+from locking import run_with_retry
+from models import db, Job, Project
+from services import recalculate_allocations
+
+# Nombre de projets confiés à un processus à la fois
+JOB_CHUNK_SIZE = 50
+
+# Nombre maximal d'erreurs conservées sur une tâche
+MAX_JOB_ERRORS = 20
+
+# Une tâche 'running' dont l'avancement n'a pas été enregistré depuis ce délai a été
+# interrompue (processus arrêté ou redémarré) : elle est marquée en échec
+STALE_JOB_AFTER = timedelta(minutes=10)
+
+STALE_JOB_ERROR = "Tâche interrompue (arrêt du serveur) : relancer le recalcul"
+
+# Application Flask des processus du pool : chaque processus a son propre moteur
+_worker_app = None
+
+
+def _init_worker(config):
+    global _worker_app
+    _worker_app = Flask(__name__)
+    _worker_app.config.update(config)
+    init_database(_worker_app)
+
+
+def worker_config(app):
+    # Configuration de la base transmise aux processus du pool, avec l'adresse résolue
+    # du moteur de l'application (chemin SQLite absolu), méthode d'allocation et stockage des grilles
+    config = {key: value for key, value in app.config.items()
+              if key.startswith(('SQLALCHEMY_', 'SQLITE_', 'ALLOCATION_', 'GRID_'))}
+    with app.app_context():
+        config['SQLALCHEMY_DATABASE_URI'] = db.engine.url.render_as_string(hide_password=False)
+    return config
+
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def pool_executor(app, workers):
+    # Processus lancés par 'spawn' : le pool ne copie ni les fils du processus web, ni
+    # les connexions de son moteur
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker, initargs=(worker_config(app),))
+
+
+def recalculate_projects(project_ids, dry_run=False, app=None):
+    # Exécuté dans un processus du pool (ou dans le fil des tâches avec app) : le paquet
+    # est calculé en un appel au moteur et enregistré en une transaction (rien n'est écrit
+    # avec dry_run). Retourne (recalculés, ignorés, en erreur, messages d'erreur,
+    # durées {étape: s} : passes du moteur d'allocation).
+    with (app or _worker_app).app_context(), collect_timers() as timers:
+        def load(ids):
+            projects = Project.query.options(
+                selectinload(Project.phases), selectinload(Project.intervenants)
+            ).filter(Project.id.in_(ids)).order_by(Project.id).all()
+            return [project for project in projects if project.phases and project.intervenants]
+
+        def recalculate(ids):
+            # Relu à chaque tentative : un recalcul concurrent est rejoué sur les données à jour
+            ready = load(ids)
+            recalculate_allocations(ready, write=not dry_run)
+            db.session.commit()
+            return len(ready)
+
+        try:
+            done = run_with_retry(lambda: recalculate(project_ids))
+            return done, len(project_ids) - done, 0, [], dict(timers)
+        except Exception:
+            db.session.rollback()
+
+        # Un projet en erreur fait échouer tout le paquet : reprise projet par projet
+        done = skipped = failed = 0
+        errors = []
+        for project_id in project_ids:
+            try:
+                if run_with_retry(lambda: recalculate([project_id])):
+                    done += 1
+                else:
+                    skipped += 1
+            except Exception as error:
+                db.session.rollback()
+                failed += 1
+                errors.append(f"projet {project_id} : {error}")
+        return done, skipped, failed, errors, dict(timers)
+
+
+def recalculate_in_pool(app, project_ids, workers, chunk_size=JOB_CHUNK_SIZE, dry_run=False):
+    # Répartir les projets par paquets sur un pool de processus ; le résultat de chaque
+    # paquet (voir recalculate_projects) est renvoyé dès qu'il est terminé
+    chunks = [project_ids[i:i + chunk_size] for i in range(0, len(project_ids), chunk_size)]
+    if not chunks:
+        return
+    with pool_executor(app, min(workers, len(chunks))) as pool:
+        yield from recalculate_chunks(pool, chunks, dry_run)
+
+
+def recalculate_chunks(pool, chunks, dry_run=False):
+    futures = [pool.submit(recalculate_projects, chunk, dry_run) for chunk in chunks]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def is_stale(job):
+    heartbeat = job.heartbeat_at or job.started_at
+    return job.status == 'running' and heartbeat is not None and heartbeat < utc_now() - STALE_JOB_AFTER
+
+
+def job_to_dict(job):
+    # Une tâche interrompue est déjà présentée en échec (le suivi de la page s'arrête),
+    # avant d'être marquée comme telle par fail_stale_jobs()
+    processed = job.done + job.skipped + job.failed
+    stale = is_stale(job)
+    return {
+        'id': job.id,
+        'project_id': job.project_id,
+        'status': 'failed' if stale else job.status,
+        'total': job.total,
+        'done': job.done,
+        'skipped': job.skipped,
+        'failed': job.failed,
+        'progress': processed / job.total if job.total else (1.0 if job.finished_at else 0.0),
+        'errors': [STALE_JOB_ERROR] if stale else job.errors.splitlines() if job.errors else [],
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+class JobRunner:
+    def __init__(self, app=None, workers=None, chunk_size=JOB_CHUNK_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pool = None  # Pool de processus, créé à la première grande tâche
+        self._lock = threading.Lock()
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['job_runner'] = self
+
+    def submit(self, project_id=None, profile=False):
+        # Enregistrer une tâche (project_id None = tous les projets) et la mettre en file ;
+        # avec JOB_AUTOSTART = False, elle attend 'flask run-jobs' (autre processus).
+        # profile=True : profil cProfile de la tâche dans PROFILE_DIR (calcul dans ce processus)
+        self.fail_stale_jobs()
+        job = Job(project_id=project_id, status='pending', created_at=utc_now())
+        db.session.add(job)
+        db.session.commit()
+        if self.app.config.get('JOB_AUTOSTART', True):
+            self._start()
+            self._queue.put((job.id, profile))
+        return job
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='job-runner', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        with self.app.app_context():
+            self.fail_stale_jobs()
+        while True:
+            job_id, profile = self._queue.get()
+            with self.app.app_context():
+                self.run_job(job_id, profile)
+
+    def fail_stale_jobs(self):
+        # Marquer en échec les tâches restées 'running' après l'arrêt du processus qui les
+        # exécutait (plus d'avancement depuis STALE_JOB_AFTER) ; retourne leur nombre
+        now = utc_now()
+        failed = db.session.execute(
+            db.update(Job).where(Job.status == 'running',
+                                 db.func.coalesce(Job.heartbeat_at, Job.started_at) < now - STALE_JOB_AFTER)
+            .values(status='failed', finished_at=now, errors=STALE_JOB_ERROR)
+        ).rowcount
+        db.session.commit()
+        return failed
+
+    def _recalculate(self, project_ids):
+        # Résultats par paquet (voir recalculate_projects) : un seul paquet est calculé
+        # dans ce fil, les autres sur le pool de processus
+        chunks = [project_ids[i:i + self.chunk_size] for i in range(0, len(project_ids), self.chunk_size)]
+        if len(chunks) <= 1:
+            yield from (recalculate_projects(chunk, app=self.app) for chunk in chunks)
+            return
+        if self._pool is None:
+            self._pool = pool_executor(self.app, self.workers)
+        try:
+            yield from recalculate_chunks(self._pool, chunks)
+        except BrokenProcessPool:
+            # Processus du pool arrêté : un nouveau pool sera créé pour la tâche suivante
+            self._pool = None
+            raise
+
+    def run_job(self, job_id, profile=False):
+        # Exécuter une tâche en attente ; sans effet si un autre processus l'a déjà prise
+        now = utc_now()
+        claimed = db.session.execute(
+            db.update(Job).where(Job.id == job_id, Job.status == 'pending')
+            .values(status='running', started_at=now, heartbeat_at=now)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return None
+
+        job = db.session.get(Job, job_id)
+        if job.project_id is None:
+            project_ids = db.session.scalars(db.select(Project.id).order_by(Project.id)).all()
+        else:
+            project_ids = [job.project_id]
+        job.total = len(project_ids)
+        db.session.commit()
+
+        instrumentation = self.app.extensions.get('instrumentation')
+        start = time.perf_counter()
+        timers = {}
+        errors = []
+        try:
+            # Avancement enregistré à chaque paquet terminé
+            with instrumentation.profile_job(job_id, profile) if instrumentation else nullcontext():
+                for done, skipped, failed, chunk_errors, chunk_timers in self._recalculate(project_ids):
+                    add_timers(timers, chunk_timers)
+                    job.done += done
+                    job.skipped += skipped
+                    job.failed += failed
+                    errors.extend(chunk_errors)
+                    job.errors = '\n'.join(errors[:MAX_JOB_ERRORS]) or None
+                    job.heartbeat_at = utc_now()
+                    db.session.commit()
+            job.status = 'failed' if job.failed else 'done'
+        except Exception as error:
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+            job.status = 'failed'
+            job.errors = '\n'.join((errors + [str(error)])[:MAX_JOB_ERRORS])
+        job.finished_at = utc_now()
+        db.session.commit()
+        if instrumentation:
+            instrumentation.record_job(job, time.perf_counter() - start, timers)
+        return job
+
+    def run_pending(self):
+        # Exécuter dans le processus courant les tâches restées en attente
+        # (par exemple après un redémarrage du serveur)
+        self.fail_stale_jobs()
+        job_ids = db.session.scalars(
+            db.select(Job.id).where(Job.status == 'pending').order_by(Job.id)
+        ).all()
+        return [job for job in map(self.run_job, job_ids) if job is not None]
@@ -0,0 +1,204 @@
+# loadtest.py
+# Test de charge local des pages de lecture (index, project_detail, project_allocation,
+# project_verif_detail) : débit en requêtes par seconde et latences, pour le service
+# synchrone (gunicorn, workers à threads) et pour le mode ASGI (uvicorn asgi:application),
+# avec le même nombre de processus et de threads par processus.
+# Les clients gardent leur connexion ouverte et enchaînent les pages de projets tirés au
+# hasard ; une part des requêtes est conditionnelle (If-None-Match), comme celles d'un
+# navigateur qui revient sur une page déjà vue.
+#   python loadtest.py
+#   python loadtest.py --workers 4 --threads 8 --concurrency 64 --duration 20
+#   python loadtest.py --database instance/app.db --modes asgi
+# gunicorn (mode sync) n'est pas une dépendance de l'application : pip install gunicorn
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+from benchmark import ensure_dataset
+from generate_test_data import parse_range
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+MODES = ('sync', 'asgi')
+
+# Pages demandées, {project_id} remplacé par un projet tiré au hasard
+PAGES = ('/', '/project/{project_id}', '/project/{project_id}/allocation',
+         '/project/{project_id}/verif-detail')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(mode, port, workers, threads):
+    if mode == 'sync':
+        return [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+                '--workers', str(workers), '--worker-class', 'gthread', '--threads', str(threads),
+                '--log-level', 'warning']
+    return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', str(port),
+            '--workers', str(workers), '--no-access-log', '--log-level', 'warning']
+
+
+def start_server(mode, database, workers, threads):
+    # Lancer le serveur et attendre qu'il réponde
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.abspath(database)}", ASGI_THREADS=str(threads))
+    process = subprocess.Popen(server_command(mode, port, workers, threads), cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Le serveur {mode} s'est arrêté (code {process.returncode})")
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/_cache/stats', timeout=1).read()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"Le serveur {mode} ne répond pas")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def fetch(reader, writer, path, headers=None):
+    # Une requête HTTP/1.1 sur une connexion gardée ouverte -> (statut, en-têtes, corps)
+    lines = [f'GET {path} HTTP/1.1', 'Host: 127.0.0.1']
+    lines.extend(f'{name}: {value}' for name, value in (headers or {}).items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    response_headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    if response_headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while size := int((await reader.readline()).strip(), 16):
+            body += await reader.readexactly(size)
+            await reader.readline()
+        await reader.readline()
+    else:
+        body = await reader.readexactly(int(response_headers.get('content-length', 0)))
+    return status, response_headers, body
+
+
+async def client(port, requests, etags, conditional, deadline, rng, durations, errors):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while time.perf_counter() < deadline:
+            path = rng.choice(requests)
+            headers = {'If-None-Match': etags[path]} if path in etags and rng.random() < conditional else None
+            start = time.perf_counter()
+            status, _, _ = await fetch(reader, writer, path, headers)
+            durations.append(time.perf_counter() - start)
+            if status not in (200, 304):
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def load(port, requests, concurrency, duration, conditional, seed):
+    # Premier passage sur chaque page (cache des pages rempli, ETags relevés), puis charge
+    etags = {}
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for path in requests:
+        status, headers, _ = await fetch(reader, writer, path)
+        if status != 200:
+            raise SystemExit(f"{path} : statut {status}")
+        if 'etag' in headers:
+            etags[path] = headers['etag']
+    writer.close()
+
+    durations, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*(client(port, requests, etags, conditional, start + duration,
+                                  random.Random(seed + k), durations, errors)
+                           for k in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    durations = np.asarray(durations) * 1000
+    return {
+        'requests': len(durations),
+        'errors': len(errors),
+        'rps': round(len(durations) / elapsed, 1),
+        'p50_ms': round(float(np.percentile(durations, 50)), 2),
+        'p95_ms': round(float(np.percentile(durations, 95)), 2),
+        'p99_ms': round(float(np.percentile(durations, 99)), 2),
+    }
+
+
+def project_ids(port, count, seed):
+    listing = json.loads(urllib.request.urlopen(f'http://127.0.0.1:{port}/api/v1/projects?limit=200').read())
+    ids = [project['id'] for project in listing['projects']]
+    return random.Random(seed).sample(ids, min(count, len(ids)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge des pages de lecture (sync / ASGI)")
+    parser.add_argument('--modes', default=','.join(MODES), help="Modes comparés, séparés par des virgules")
+    parser.add_argument('--database', help="Base à utiliser (jeu de données généré sinon)")
+    parser.add_argument('--projects', type=int, default=200, help="Projets du jeu de données généré")
+    parser.add_argument('--phases', default='8-15', help="Phases par projet généré (n ou min-max)")
+    parser.add_argument('--intervenants', default='5-10', help="Intervenants par projet généré")
+    parser.add_argument('--pages', type=int, default=50, help="Projets dont les pages sont demandées")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Processus serveur")
+    parser.add_argument('--threads', type=int, default=8, help="Threads par processus")
+    parser.add_argument('--concurrency', type=int, default=32, help="Connexions clientes simultanées")
+    parser.add_argument('--duration', type=float, default=10.0, help="Durée de la charge (s) par mode")
+    parser.add_argument('--conditional', type=float, default=0.5,
+                        help="Part des requêtes conditionnelles (If-None-Match)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Enregistrer les résultats dans ce fichier")
+    args = parser.parse_args()
+
+    modes = [mode for mode in args.modes.split(',') if mode]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"mode(s) inconnu(s) : {', '.join(sorted(unknown))}")
+    database = args.database or ensure_dataset(args.projects, parse_range(args.phases),
+                                               parse_range(args.intervenants), args.seed)
+
+    results = {}
+    requests = None
+    for mode in modes:
+        process, port = start_server(mode, database, args.workers, args.threads)
+        try:
+            if requests is None:
+                requests = [page.format(project_id=project_id)
+                            for project_id in project_ids(port, args.pages, args.seed) for page in PAGES]
+            results[mode] = asyncio.run(load(port, requests, args.concurrency, args.duration,
+                                             args.conditional, args.seed))
+        finally:
+            stop_server(process)
+        print(f"{mode:5} {results[mode]['rps']:9.1f} req/s  p50 {results[mode]['p50_ms']:7.2f} ms  "
+              f"p95 {results[mode]['p95_ms']:7.2f} ms  p99 {results[mode]['p99_ms']:7.2f} ms  "
+              f"({results[mode]['requests']} requêtes, {results[mode]['errors']} erreur(s))")
+
+    if 'sync' in results and 'asgi' in results:
+        print(f"ASGI / sync : x{results['asgi']['rps'] / results['sync']['rps']:.2f} requêtes par seconde "
+              f"({args.workers} processus, {args.threads} threads, {args.concurrency} connexions)")
+    if args.json:
+        with open(args.json, 'w') as stream:
+            json.dump({'workers': args.workers, 'threads': args.threads, 'concurrency': args.concurrency,
+                       'duration': args.duration, 'conditional': args.conditional, 'results': results},
+                      stream, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# locking.py
+# Verrouillage optimiste des projets : chaque écriture sur un projet commence par
+# incrémenter sa version à condition qu'elle n'ait pas changé depuis la lecture. Une
+# écriture concurrente est ainsi détectée avant d'avoir laissé un projet à moitié
+# enregistré ; les recalculs sont rejoués, les formulaires obsolètes sont refusés.
+import random
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, Project
+
+# Nombre de tentatives et délai initial (en secondes) des écritures rejouées
+RETRY_ATTEMPTS = 5
+RETRY_DELAY = 0.05
+
+# Codes PostgreSQL des transactions à rejouer (sérialisation, interblocage)
+RETRYABLE_PGCODES = ('40001', '40P01')
+
+
+class ConflictError(Exception):
+    # Le projet a été modifié par une autre requête depuis sa lecture
+    def __init__(self, project_id):
+        super().__init__(f"Le projet {project_id} a été modifié entre-temps")
+        self.project_id = project_id
+
+
+def lock_project(project, expected_version=None):
+    # Première écriture de la transaction : incrémenter la version du projet si elle
+    # vaut toujours celle qui a été lue (ou expected_version, celle du formulaire).
+    # La ligne reste verrouillée jusqu'au commit.
+    expected_version = project.version if expected_version is None else expected_version
+    updated = db.session.execute(
+        db.update(Project)
+        .where(Project.id == project.id, Project.version == expected_version)
+        .values(version=Project.version + 1,
+                updated_at=datetime.now(timezone.utc).replace(tzinfo=None))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not updated:
+        raise ConflictError(project.id)
+    # Garder l'objet en mémoire cohérent sans le marquer comme modifié
+    set_committed_value(project, 'version', expected_version + 1)
+    return expected_version + 1
+
+
+def is_retryable(error):
+    # Conflit de version, base SQLite verrouillée ou transaction PostgreSQL à rejouer
+    if isinstance(error, ConflictError):
+        return True
+    if isinstance(error, OperationalError):
+        orig = error.orig
+        return ('database is locked' in str(orig)
+                or getattr(orig, 'pgcode', None) in RETRYABLE_PGCODES
+                or getattr(orig, 'sqlstate', None) in RETRYABLE_PGCODES)
+    return False
+
+
+def run_with_retry(work, attempts=RETRY_ATTEMPTS, delay=RETRY_DELAY):
+    # Exécuter work() (qui relit ses données et se termine par un commit) ; en cas de
+    # conflit, annuler la transaction et recommencer après une attente croissante
+    for attempt in range(attempts):
+        try:
+            return work()
+        except (ConflictError, OperationalError) as error:
+            db.session.rollback()
+            if not is_retryable(error) or attempt == attempts - 1:
+                raise
+            time.sleep(delay * 2 ** attempt * random.uniform(0.5, 1.5))
@@ -0,0 +1,152 @@
+# migrations.py
+# Mise à niveau des bases existantes : db.create_all() crée les tables manquantes mais
+# ne modifie pas les tables déjà présentes. Chaque étape est idempotente.
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import AddConstraint, CreateTable
+
+from models import db, PhaseIntervenant, PhaseIntervenantVerif
+
+# Tables dont les doublons (phase_id, intervenant_id) doivent disparaître avant
+# la création des index uniques
+JUNCTION_TABLES = (PhaseIntervenant.__table__, PhaseIntervenantVerif.__table__)
+
+
+def remove_duplicate_cells(connection, table):
+    # Garder la ligne la plus récente de chaque couple phase / intervenant
+    result = connection.execute(text(
+        f"DELETE FROM {table.name} WHERE id NOT IN ("
+        f"SELECT MAX(id) FROM {table.name} GROUP BY phase_id, intervenant_id)"
+    ))
+    return result.rowcount
+
+
+def add_missing_columns(connection):
+    # Ajouter les colonnes déclarées dans models.py qui n'existent pas encore en base.
+    # Elles sont ajoutées sans contrainte NOT NULL : les étapes suivantes les remplissent.
+    inspector = inspect(connection)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(connection.dialect)}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            connection.execute(text(ddl))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def backfill_project_ids(connection):
+    # Renseigner le projet des allocations et des vérifs à partir de leur phase
+    filled = 0
+    for table in JUNCTION_TABLES:
+        result = connection.execute(text(
+            f"UPDATE {table.name} SET project_id = "
+            f"(SELECT phases.project_id FROM phases WHERE phases.id = {table.name}.phase_id) "
+            f"WHERE project_id IS NULL"
+        ))
+        filled += result.rowcount
+    return filled
+
+
+def create_missing_indexes(connection):
+    # Créer les index déclarés dans models.py qui n'existent pas encore en base
+    inspector = inspect(connection)
+    created = []
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing:
+                continue
+            if index.unique and table in JUNCTION_TABLES:
+                remove_duplicate_cells(connection, table)
+            index.create(connection)
+            created.append(index.name)
+    return created
+
+
+def missing_cascades(connection):
+    # Clés étrangères déclarées avec ON DELETE CASCADE dans models.py mais pas en base,
+    # par table : {table: [(contrainte du modèle, nom de la contrainte en base)]}
+    inspector = inspect(connection)
+    missing = {}
+    for table in db.metadata.sorted_tables:
+        existing = {tuple(foreign_key['constrained_columns']): foreign_key
+                    for foreign_key in inspector.get_foreign_keys(table.name)}
+        for constraint in sorted(table.foreign_key_constraints, key=lambda constraint: constraint.column_keys):
+            if constraint.ondelete is None:
+                continue
+            foreign_key = existing.get(tuple(constraint.column_keys), {})
+            ondelete = (foreign_key.get('options') or {}).get('ondelete')
+            if (ondelete or '').upper() != constraint.ondelete.upper():
+                missing.setdefault(table, []).append((constraint, foreign_key.get('name')))
+    return missing
+
+
+def rebuild_sqlite_table(connection, table):
+    # SQLite ne sait pas modifier une contrainte : la table est recréée d'après
+    # models.py, ses lignes recopiées, puis ses index recréés
+    columns = ', '.join(column.name for column in table.columns)
+    create = str(CreateTable(table).compile(connection)).strip()
+    connection.execute(text(create.replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE _new_{table.name} ", 1)))
+    connection.execute(text(f"INSERT INTO _new_{table.name} ({columns}) SELECT {columns} FROM {table.name}"))
+    connection.execute(text(f"DROP TABLE {table.name}"))
+    connection.execute(text(f"ALTER TABLE _new_{table.name} RENAME TO {table.name}"))
+    for index in table.indexes:
+        index.create(connection)
+
+
+def remove_orphan_rows(connection):
+    # Lignes dont le projet, la phase ou l'intervenant n'existe plus (SQLite sans
+    # clés étrangères actives) : elles ne seraient plus jamais supprimées
+    removed = 0
+    for table_name, rowid, _, _ in connection.exec_driver_sql("PRAGMA foreign_key_check").fetchall():
+        connection.execute(text(f"DELETE FROM {table_name} WHERE rowid = :rowid"), {'rowid': rowid})
+        removed += 1
+    return removed
+
+
+def add_delete_cascades(connection):
+    # Suppression en cascade par la base (un projet = une requête DELETE)
+    changed = []
+    for table, constraints in missing_cascades(connection).items():
+        if connection.dialect.name == 'sqlite':
+            rebuild_sqlite_table(connection, table)
+        else:
+            for constraint, name in constraints:
+                if name:
+                    connection.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {name}"))
+                connection.execute(AddConstraint(constraint))
+        changed.append(table.name)
+    return changed
+
+
+def upgrade(engine):
+    # Appliquer toutes les étapes de migration ; retourne la liste des changements
+    db.metadata.create_all(engine)
+    with engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            # Les tables sont recréées sans que SQLite ne vérifie les références entre-temps
+            # (pragma sans effet dans une transaction : à exécuter avant)
+            connection.exec_driver_sql("PRAGMA foreign_keys = OFF")
+            connection.commit()
+        try:
+            with connection.begin():
+                changes = [f"colonne {name}" for name in add_missing_columns(connection)]
+                filled = backfill_project_ids(connection)
+                if filled:
+                    changes.append(f"project_id renseigné sur {filled} ligne(s)")
+                if sqlite:
+                    removed = remove_orphan_rows(connection)
+                    if removed:
+                        changes.append(f"{removed} ligne(s) orpheline(s) supprimée(s)")
+                changes.extend(f"suppression en cascade sur {name}" for name in add_delete_cascades(connection))
+                changes.extend(f"index {name}" for name in create_missing_indexes(connection))
+        finally:
+            if sqlite:
+                connection.exec_driver_sql("PRAGMA foreign_keys = ON")
+                connection.commit()
+        return changes
@@ -4,16 +4,31 @@ db = SQLAlchemy()
 
 class Project(db.Model):
     __tablename__ = 'projects'  # Correction ici (double underscore)
+    __table_args__ = (
+        # Tri et pagination par curseur de la liste des projets
+        db.Index('ix_projects_name_id', 'name', 'id'),
+        db.Index('ix_projects_total_marche_id', 'total_marche', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False) # Nom du projet
     total_marche = db.Column(db.Float, nullable=False) # Montant total du marché
 
+    # Version du projet, incrémentée à chaque modification (cache des pages, ETag)
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    updated_at = db.Column(db.DateTime, nullable=True)  # Date de la dernière modification (UTC)
+
     # Relation : un projet possede plusieurs phases
-    phases = db.relationship('Phase', backref='project', lazy=True)
+    # (supprimées par la base avec le projet : ON DELETE CASCADE, d'où passive_deletes)
+    phases = db.relationship('Phase', backref='project', lazy=True, order_by='Phase.id',
+                             passive_deletes=True)
 
     # Relation : un projet possede plusieurs intervenants
-    intervenants = db.relationship('Intervenant', backref='project', lazy=True)
+    intervenants = db.relationship('Intervenant', backref='project', lazy=True, order_by='Intervenant.id',
+                                   passive_deletes=True)
+
+    # Relation : totaux matérialisés du projet
+    summary = db.relationship('ProjectSummary', uselist=False, lazy=True, passive_deletes=True)
 
     def __repr__(self):
         return f"<Project(id={self.id}, name='{self.name}')>"
@@ -24,10 +39,10 @@ class Phase(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)  # Nom de la phase (Ex : Études, Travaux, etc.)
     percentage = db.Column(db.Float, nullable=False)  # Pourcentage de la phase par rapport au total du projet
-    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='CASCADE'), nullable=False, index=True)
     
     # Relation : une phase peut avoir plusieurs associations à des intervenants
-    allocations = db.relationship('PhaseIntervenant', backref='phase', lazy=True)
+    allocations = db.relationship('PhaseIntervenant', backref='phase', lazy=True, passive_deletes=True)
     
     def __repr__(self):
         return f"<Phase(id={self.id}, name='{self.name}', percentage={self.percentage})>"
@@ -39,10 +54,13 @@ class Intervenant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)  # Nom ou rôle de l'intervenant (ex : Architecte, MB, etc.)
     montant_verif = db.Column(db.Float, nullable=True)  # Montant 'vérif' souhaité sur l'ensemble du projet
-    project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='CASCADE'), nullable=False, index=True)
     
     # Relation : un intervenant peut être associé à plusieurs phases
-    allocations = db.relationship('PhaseIntervenant', backref='intervenant', lazy=True)
+    allocations = db.relationship('PhaseIntervenant', backref='intervenant', lazy=True, passive_deletes=True)
+
+    # Relation : totaux matérialisés de l'intervenant
+    summary = db.relationship('IntervenantSummary', uselist=False, lazy=True, passive_deletes=True)
     
     def __repr__(self):
         return f"<Intervenant(id={self.id}, name='{self.name}', montant_verif={self.montant_verif})>"
@@ -50,10 +68,17 @@ class Intervenant(db.Model):
 
 class PhaseIntervenant(db.Model):
     __tablename__ = 'phase_intervenants'
+    __table_args__ = (
+        # Une seule allocation par couple phase / intervenant (sert aussi aux recherches par phase)
+        db.Index('uq_phase_intervenant', 'phase_id', 'intervenant_id', unique=True),
+        db.Index('ix_phase_intervenants_intervenant_id', 'intervenant_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    phase_id = db.Column(db.Integer, db.ForeignKey('phases.id'), nullable=False)
-    intervenant_id = db.Column(db.Integer, db.ForeignKey('intervenants.id'), nullable=False)
+    # Projet de la phase et de l'intervenant (dénormalisé pour filtrer sur un seul index)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='CASCADE'), nullable=False, index=True)
+    phase_id = db.Column(db.Integer, db.ForeignKey('phases.id', ondelete='CASCADE'), nullable=False)
+    intervenant_id = db.Column(db.Integer, db.ForeignKey('intervenants.id', ondelete='CASCADE'), nullable=False)
     
     # Pourcentage finalement attribué à l'intervenant dans cette phase (calculé)
     final_percent = db.Column(db.Float, nullable=True)  
@@ -71,10 +96,17 @@ class PhaseIntervenant(db.Model):
 # Dans models.py
 class PhaseIntervenantVerif(db.Model):
     __tablename__ = 'phase_intervenants_verif'
+    __table_args__ = (
+        # Un seul montant vérif par couple phase / intervenant (sert aussi aux recherches par phase)
+        db.Index('uq_phase_intervenant_verif', 'phase_id', 'intervenant_id', unique=True),
+        db.Index('ix_phase_intervenants_verif_intervenant_id', 'intervenant_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    phase_id = db.Column(db.Integer, db.ForeignKey('phases.id'), nullable=False)
-    intervenant_id = db.Column(db.Integer, db.ForeignKey('intervenants.id'), nullable=False)
+    # Projet de la phase et de l'intervenant (dénormalisé pour filtrer sur un seul index)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='CASCADE'), nullable=False, index=True)
+    phase_id = db.Column(db.Integer, db.ForeignKey('phases.id', ondelete='CASCADE'), nullable=False)
+    intervenant_id = db.Column(db.Integer, db.ForeignKey('intervenants.id', ondelete='CASCADE'), nullable=False)
     
     # Montant vérif pour cette phase et cet intervenant
     # Null signifie "non spécifié" (peut servir de tampon)
@@ -82,11 +114,103 @@ class PhaseIntervenantVerif(db.Model):
     montant_verif = db.Column(db.Float, nullable=True)
     
     # Référence aux objets associés
-    phase = db.relationship('Phase', backref='verifs')
-    intervenant = db.relationship('Intervenant', backref='verifs')
+    phase = db.relationship('Phase', backref=db.backref('verifs', passive_deletes=True))
+    intervenant = db.relationship('Intervenant', backref=db.backref('verifs', passive_deletes=True))
     
     def __repr__(self):
         return (f"<PhaseIntervenantVerif("
                 f"phase_id={self.phase_id}, "
                 f"intervenant_id={self.intervenant_id}, "
-                f"montant_verif={self.montant_verif})>")
\ No newline at end of file
+                f"montant_verif={self.montant_verif})>")
+
+# Grilles d'un projet stockées en bloc (mode GRID_STORAGE = 'packed', voir grids.py) :
+# une ligne par projet et par type de grille, copie des lignes de phase_intervenants(_verif)
+class ProjectGrid(db.Model):
+    __tablename__ = 'project_grids'
+    
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='CASCADE'), primary_key=True)
+    kind = db.Column(db.String(20), primary_key=True)  # 'verif' ou 'allocation'
+    
+    # Ordre des lignes et des colonnes (entiers int64 petit-boutistes)
+    phase_ids = db.Column(db.LargeBinary, nullable=False)
+    intervenant_ids = db.Column(db.LargeBinary, nullable=False)
+    
+    # Matrices float64 petit-boutistes (couches x phases x intervenants), NaN = pas de ligne
+    data = db.Column(db.LargeBinary, nullable=False)
+    
+    def __repr__(self):
+        return f"<ProjectGrid(project_id={self.project_id}, kind='{self.kind}')>"
+
+
+# Totaux d'un projet, tenus à jour par les routes d'écriture (voir summary.py)
+class ProjectSummary(db.Model):
+    __tablename__ = 'project_summaries'
+    
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='CASCADE'), primary_key=True)
+    phases_total_percent = db.Column(db.Float, nullable=False, default=0.0)
+    phases_total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    intervenants_total_verif = db.Column(db.Float, nullable=False, default=0.0)
+    allocation_total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    
+    # Date du dernier calcul d'allocation (None si jamais calculée)
+    calculated_at = db.Column(db.DateTime, nullable=True)
+    # Le dernier calcul respecte-t-il toutes les contraintes (allocation.valid_allocation) ?
+    # Avec la méthode 'solver', faux signifie qu'aucune allocation valide n'existe.
+    allocation_feasible = db.Column(db.Boolean, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    
+    def __repr__(self):
+        return (f"<ProjectSummary("
+                f"project_id={self.project_id}, "
+                f"phases_total_percent={self.phases_total_percent}, "
+                f"intervenants_total_verif={self.intervenants_total_verif})>")
+
+
+# Totaux d'un intervenant sur l'ensemble des phases de son projet
+class IntervenantSummary(db.Model):
+    __tablename__ = 'intervenant_summaries'
+    
+    intervenant_id = db.Column(db.Integer, db.ForeignKey('intervenants.id', ondelete='CASCADE'), primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey('projects.id', ondelete='CASCADE'), nullable=False, index=True)
+    
+    # Somme des montants vérif détaillés par phase
+    total_verif_detail = db.Column(db.Float, nullable=False, default=0.0)
+    
+    # Somme des montants alloués et écart par rapport au montant vérif global
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    ecart = db.Column(db.Float, nullable=False, default=0.0)
+    ecart_percent = db.Column(db.Float, nullable=False, default=0.0)
+    
+    def __repr__(self):
+        return (f"<IntervenantSummary("
+                f"intervenant_id={self.intervenant_id}, "
+                f"total_amount={self.total_amount}, "
+                f"ecart={self.ecart})>")
+
+
+# Tâche de recalcul d'allocation exécutée en arrière-plan (voir jobs.py)
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # Projet à recalculer ; None pour "tous les projets"
+    project_id = db.Column(db.Integer, nullable=True)
+    # pending -> running -> done / failed
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    
+    # Avancement : projets à traiter, recalculés, ignorés (sans phases ou intervenants), en erreur
+    total = db.Column(db.Integer, nullable=False, default=0)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    skipped = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text, nullable=True)  # Premières erreurs, une par ligne
+    
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    # Dernier avancement enregistré (UTC) : une tâche 'running' sans avancement depuis
+    # longtemps a été interrompue (voir jobs.JobRunner.fail_stale_jobs)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f"<Job(id={self.id}, project_id={self.project_id}, status='{self.status}')>"
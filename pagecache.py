@@ -0,0 +1,190 @@
+# pagecache.py
+# Cache en mémoire des pages de lecture d'un projet. Chaque projet porte un numéro de
+# version incrémenté par toutes les routes d'écriture : une page en cache n'est servie
+# que si elle a été rendue pour la version courante du projet.
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import abort, current_app, make_response, request
+
+from compression import accept_encoding, compress, compressible, negotiate
+from models import db, Project
+
+
+class PageCache:
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # (endpoint, project_id) -> (version, body, mimetype, {encodage: corps compressé})
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, version, body, mimetype):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= entry_size(previous)
+            self._entries[key] = (version, body, mimetype, {})
+            self.size_bytes += len(body)
+            self._evict()
+
+    def encoded(self, key, version, encoding):
+        # Corps compressé d'une page en cache, calculé une seule fois par version ;
+        # None si la page n'est pas (ou plus) en cache
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            data = entry[3].get(encoding)
+        if data is None:
+            data = compress(entry[1], encoding)
+            with self._lock:
+                if self._entries.get(key) is entry and encoding not in entry[3]:
+                    entry[3][encoding] = data
+                    self.size_bytes += len(data)
+                    self._evict()
+        return data
+
+    def _evict(self):
+        # Éviction des pages les moins récemment servies (verrou déjà pris)
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= entry_size(evicted)
+            self.evictions += 1
+
+    def invalidate(self, project_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == project_id]:
+                self.size_bytes -= entry_size(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'size_bytes': self.size_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def entry_size(entry):
+    _, body, _, encodings = entry
+    return len(body) + sum(len(data) for data in encodings.values())
+
+
+def encode_page(cache, key, version, body, mimetype, accept_encoding):
+    # Corps de la page à envoyer selon Accept-Encoding -> (corps, encodage ou None) ;
+    # la version compressée est gardée dans le cache avec la page
+    encoding = negotiate(accept_encoding) if compressible(mimetype, len(body)) else None
+    if encoding is None:
+        return body, None
+    return cache.encoded(key, version, encoding) or compress(body, encoding), encoding
+
+
+def bump_version(project_id):
+    # À appeler par chaque route d'écriture, dans sa transaction (updated_at en UTC)
+    Project.query.filter_by(id=project_id).update(
+        {Project.version: Project.version + 1,
+         Project.updated_at: datetime.now(timezone.utc).replace(tzinfo=None)},
+        synchronize_session=False
+    )
+
+
+def project_state_query(project_id):
+    # Version et date de modification d'un projet (aussi exécutée par le moteur
+    # asynchrone du mode ASGI, voir asgi.py)
+    return db.select(Project.version, Project.updated_at).where(Project.id == project_id)
+
+
+def project_states_query(project_ids):
+    # Même lecture pour plusieurs projets à la fois (mode ASGI, voir asgi.ProjectStates)
+    return (db.select(Project.id, Project.version, Project.updated_at)
+            .where(Project.id.in_(project_ids)))
+
+
+def page_etag(endpoint, project_id, version, build_id):
+    # ETag faible : la page est envoyée compressée ou non selon le navigateur. build_id
+    # (empreinte du manifeste, voir assets.py) change à chaque construction des fichiers
+    # statiques : les pages en cache du navigateur pointent vers les fichiers en place
+    return f"{endpoint}-{project_id}-{version}-{build_id}"
+
+
+def not_modified(etag, updated_at, if_none_match, if_modified_since):
+    # Le navigateur a-t-il déjà cette version de la page (ETags et date analysés par werkzeug) ?
+    if if_none_match:
+        return if_none_match.contains_weak(etag)
+    return (updated_at is not None and if_modified_since is not None
+            and updated_at.replace(microsecond=0) <= if_modified_since.replace(tzinfo=None))
+
+
+def cached_project_page(cache):
+    # Décorateur des pages de lecture d'un projet : réponse 304 si le navigateur a déjà
+    # la version courante, page en cache sinon, et rendu complet en dernier recours
+    def decorator(view):
+        @wraps(view)
+        def wrapper(project_id):
+            state = db.session.execute(project_state_query(project_id)).first()
+            if state is None:
+                abort(404)
+            version, updated_at = state
+            etag = page_etag(request.endpoint, project_id, version,
+                             current_app.extensions['assets'].build_id)
+
+            if not_modified(etag, updated_at, request.if_none_match, request.if_modified_since):
+                response = make_response('', 304)
+            else:
+                key = (request.endpoint, project_id)
+                entry = cache.get(key, version)
+                if entry is not None:
+                    _, body, mimetype, _ = entry
+                    response = make_response(body)
+                    response.mimetype = mimetype
+                else:
+                    response = make_response(view(project_id))
+                    # Les redirections (projet incomplet) ne sont pas mises en cache
+                    if response.status_code != 200:
+                        return response
+                    body, mimetype = response.get_data(), response.mimetype
+                    cache.set(key, version, body, mimetype)
+                body, encoding = encode_page(cache, key, version, body, mimetype, accept_encoding())
+                if encoding is not None:
+                    response.set_data(body)
+                    response.headers['Content-Encoding'] = encoding
+
+            if current_app.config['COMPRESSION']:
+                response.vary.add('Accept-Encoding')
+            response.set_etag(etag, weak=True)
+            if updated_at is not None:
+                response.last_modified = updated_at
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,58 @@
+# querycount.py
+# Comptage des requêtes SQL émises par une portion de code (pages du projet, calculs...)
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# Nombre maximal de requêtes attendu pour chaque page d'un projet,
+# quel que soit le nombre de phases et d'intervenants
+PAGE_QUERY_BUDGETS = {
+    'project_detail': 4,
+    'project_allocation': 5,
+    'project_verif_detail': 5,
+    'edit_phases': 2,
+}
+
+
+class QueryCounter:
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __repr__(self):
+        return f"<QueryCounter(count={self.count})>"
+
+
+@contextmanager
+def count_queries(engine):
+    # Enregistrer chaque requête exécutée sur le moteur pendant le bloc
+    counter = QueryCounter()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter.statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def explain_query_plan(connection, statement):
+    # Plan d'exécution d'une requête SQLAlchemy, une ligne par étape. Sous PostgreSQL,
+    # les parcours séquentiels sont désactivés (jusqu'à la fin de la transaction) : sur
+    # de petites tables le planificateur les préfère, seul compte ici qu'un index soit
+    # utilisable.
+    compiled = statement.compile(connection, compile_kwargs={'literal_binds': True})
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        return [row[0].strip() for row in connection.exec_driver_sql(f"EXPLAIN {compiled}")]
+    return [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")]
+
+
+def full_scans(plan):
+    # Étapes du plan qui parcourent une table entière au lieu d'utiliser un index
+    return [detail for detail in plan if detail.startswith('SCAN ') or 'Seq Scan' in detail]
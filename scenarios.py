@@ -0,0 +1,98 @@
+# scenarios.py
+# Variantes ("et si ...") de l'allocation d'un projet : autre intervenant tampon, autre
+# tolérance sur les écarts, autre méthode d'allocation, autres pourcentages de phases,
+# montants vérif ou grille vérif.
+# Les variantes sont empilées et calculées ensemble par le moteur (allocate_batch), par
+# paquets de taille bornée ; rien n'est enregistré en base.
+import numpy as np
+
+from allocation import TOLERANCE_ECART, allocate_batch, find_buffer_index, intervenant_totals
+from grids import verif_matrix
+from instrumentation import timed
+
+# Nombre maximal de variantes par appel
+MAX_SCENARIOS = 1000
+
+# Nombre de cellules (variantes x phases x intervenants) calculées par appel au moteur :
+# borne la mémoire utilisée par ses tableaux intermédiaires
+SCENARIO_BATCH_CELLS = 250_000
+
+
+def project_inputs(project, method='greedy'):
+    # Paramètres actuels du projet (phases et intervenants chargés), point de départ
+    # de chaque variante
+    return {
+        'name': 'actuel',
+        'total_marche': project.total_marche,
+        'percentages': np.array([phase.percentage for phase in project.phases], dtype=float),
+        'verif': verif_matrix(project),
+        'montant_verif': np.array([intervenant.montant_verif for intervenant in project.intervenants],
+                                  dtype=float),
+        'buffer_index': find_buffer_index([intervenant.name for intervenant in project.intervenants]),
+        'tolerance': TOLERANCE_ECART,
+        'method': method,
+    }
+
+
+def _allocate_scenarios(scenarios):
+    # Allocations (B, P, I) de toutes les variantes et leur verdict (B,), voir allocate_batch
+    with timed('allocation'):
+        return allocate_batch(
+            np.array([scenario['total_marche'] for scenario in scenarios]),
+            np.stack([scenario['percentages'] for scenario in scenarios]),
+            np.stack([scenario['verif'] for scenario in scenarios]),
+            np.stack([scenario['montant_verif'] for scenario in scenarios]),
+            np.array([scenario['buffer_index'] for scenario in scenarios], dtype=np.intp),
+            tolerance=np.array([scenario['tolerance'] for scenario in scenarios]),
+            method=np.array([scenario['method'] for scenario in scenarios]),
+            timer=timed,
+        )
+
+
+def evaluate_scenarios(project, baseline, variants, include_grids=False):
+    # Calculer la situation actuelle (baseline) et chaque variante (dictionnaires qui en
+    # remplacent certaines clés). Retourne une liste de résultats, la situation actuelle
+    # en premier ; les écarts de chaque intervenant sont aussi donnés par rapport à elle.
+    scenarios = [baseline] + [{**baseline, **variant} for variant in variants]
+    n_phases, n_intervenants = baseline['verif'].shape
+    batch_size = max(1, SCENARIO_BATCH_CELLS // max(1, n_phases * n_intervenants))
+
+    intervenant_ids = [intervenant.id for intervenant in project.intervenants]
+    results = []
+    baseline_total = None
+    for start in range(0, len(scenarios), batch_size):
+        batch = scenarios[start:start + batch_size]
+        percent, amount, feasible = _allocate_scenarios(batch)
+        montant_verif = np.stack([scenario['montant_verif'] for scenario in batch])
+        total, ecart, ecart_percent = intervenant_totals(amount, montant_verif)
+        if baseline_total is None:
+            baseline_total = total[0]
+
+        for k, scenario in enumerate(batch):
+            outside = np.abs(ecart_percent[k]) > scenario['tolerance']
+            result = {
+                'name': scenario['name'],
+                'buffer_intervenant_id': intervenant_ids[scenario['buffer_index']],
+                'tolerance': scenario['tolerance'],
+                'method': scenario['method'],
+                'total_amount': float(total[k].sum()),
+                'max_ecart_percent': float(np.abs(ecart_percent[k]).max(initial=0.0)),
+                'feasible': bool(feasible[k]),
+                'outside_tolerance': [intervenant_ids[j] for j in np.flatnonzero(outside)],
+                'totals': [
+                    {
+                        'intervenant_id': intervenant_id,
+                        'amount': float(total[k, j]),
+                        'verif': None if np.isnan(montant_verif[k, j]) else float(montant_verif[k, j]),
+                        'ecart': float(ecart[k, j]),
+                        'ecart_percent': float(ecart_percent[k, j]),
+                        'delta_amount': float(total[k, j] - baseline_total[j]),
+                    }
+                    for j, intervenant_id in enumerate(intervenant_ids)
+                ],
+            }
+            if include_grids:
+                result['percent'] = percent[k].tolist()
+                result['amount'] = amount[k].tolist()
+            results.append(result)
+    return results
@@ -0,0 +1,362 @@
+# services.py
+# Opérations partagées par les pages HTML (app.py) et l'API JSON (api.py) : chargement
+# des projets, liste paginée, enregistrement des grilles et calcul de l'allocation.
+# Les fonctions d'écriture travaillent dans la transaction de l'appelant (pas de commit).
+import numpy as np
+from flask import current_app
+from sqlalchemy.orm import joinedload, selectinload
+
+from allocation import allocate_batch, build_verif_matrix, diff_allocation, find_buffer_index, intervenant_totals, \
+    stack_projects
+from grids import load_grids, packed_storage, project_axes, store_grids, verif_matrix
+from instrumentation import timed
+from models import db, Project, Phase, Intervenant, PhaseIntervenant, PhaseIntervenantVerif
+from locking import lock_project
+from summary import refresh_summary, refresh_verif_total
+
+# Tolérance sur la somme des pourcentages des phases (100%)
+PERCENT_TOLERANCE = 0.01
+
+# Options de chargement des pages d'un projet : le projet et ses totaux en une requête
+# (jointure), puis une requête par collection (selectin)
+def project_page_options():
+    return (
+        joinedload(Project.summary),
+        selectinload(Project.phases),
+        selectinload(Project.intervenants).joinedload(Intervenant.summary),
+    )
+
+# Charger un projet avec ses relations en un nombre fixe de requêtes,
+# plutôt qu'au fil des accès depuis les routes et les templates
+def get_project_or_404(project_id, *options):
+    return Project.query.options(
+        *(options or project_page_options())
+    ).filter_by(id=project_id).first_or_404()
+
+# Liste des projets : colonnes de tri autorisées et taille des pages
+PROJECT_SORTS = {
+    'id': Project.id,
+    'name': Project.name,
+    'total_marche': Project.total_marche,
+}
+PROJECTS_PER_PAGE = 50
+MAX_PROJECTS_PER_PAGE = 200
+
+# Requête de la liste des projets avec, pour chacun, les agrégats affichés sur l'accueil.
+# Les sous-requêtes corrélées s'appuient sur les index project_id : le coût ne dépend
+# que du nombre de projets de la page.
+def project_listing_query():
+    phase_count = (db.select(db.func.count(Phase.id))
+                   .where(Phase.project_id == Project.id).scalar_subquery())
+    intervenant_count = (db.select(db.func.count(Intervenant.id))
+                         .where(Intervenant.project_id == Project.id).scalar_subquery())
+    total_verif = (db.select(db.func.coalesce(db.func.sum(Intervenant.montant_verif), 0.0))
+                   .where(Intervenant.project_id == Project.id).scalar_subquery())
+    allocated = (db.select(PhaseIntervenant.id)
+                 .where(PhaseIntervenant.project_id == Project.id).exists())
+    return db.select(
+        Project.id,
+        Project.name,
+        Project.total_marche,
+        phase_count.label('phase_count'),
+        intervenant_count.label('intervenant_count'),
+        total_verif.label('total_verif'),
+        allocated.label('allocated'),
+    )
+
+# Curseur de pagination "valeur:id" du dernier projet affiché
+def parse_project_cursor(cursor, sort):
+    if not cursor or ':' not in cursor:
+        return None
+    value, _, last_id = cursor.rpartition(':')
+    try:
+        last_id = int(last_id)
+        if sort == 'id':
+            value = last_id
+        elif sort == 'total_marche':
+            value = float(value)
+    except ValueError:
+        return None
+    return value, last_id
+
+# Filtres de la liste des projets (recherche sur le nom, bornes du total marché)
+def filter_projects(query, search='', min_total=None, max_total=None):
+    if search:
+        query = query.where(Project.name.ilike(f"%{search}%"))
+    if min_total is not None:
+        query = query.where(Project.total_marche >= min_total)
+    if max_total is not None:
+        query = query.where(Project.total_marche <= max_total)
+    return query
+
+def list_projects(search='', sort='id', descending=False, limit=PROJECTS_PER_PAGE,
+                  min_total=None, max_total=None, after=None):
+    # Une page de projets (avec leurs agrégats) et le curseur de la page suivante (ou None)
+    query = project_page_query(search, sort, descending, limit, min_total, max_total, after)
+    return project_page(db.session.execute(query).all(), sort, limit)
+
+# Requête d'une page de la liste des projets, sans l'exécuter (aussi exécutée par le
+# moteur asynchrone du mode ASGI, voir asgi.py)
+def project_page_query(search='', sort='id', descending=False, limit=PROJECTS_PER_PAGE,
+                       min_total=None, max_total=None, after=None):
+    sort_column = PROJECT_SORTS[sort]
+    query = filter_projects(project_listing_query(), search, min_total, max_total)
+    
+    # Reprendre après le dernier projet de la page précédente
+    cursor = parse_project_cursor(after, sort)
+    if cursor is not None:
+        value, last_id = cursor
+        if descending:
+            query = query.where(db.or_(sort_column < value,
+                                       db.and_(sort_column == value, Project.id < last_id)))
+        else:
+            query = query.where(db.or_(sort_column > value,
+                                       db.and_(sort_column == value, Project.id > last_id)))
+    
+    if descending:
+        query = query.order_by(sort_column.desc(), Project.id.desc())
+    else:
+        query = query.order_by(sort_column, Project.id)
+    
+    # Une ligne de plus pour savoir s'il existe une page suivante
+    return query.limit(limit + 1)
+
+# Lignes de la requête précédente -> projets de la page et curseur de la page suivante
+def project_page(projects, sort, limit):
+    next_cursor = None
+    if len(projects) > limit:
+        projects = projects[:limit]
+        last = projects[-1]
+        next_cursor = f"{getattr(last, sort)}:{last.id}"
+    return projects, next_cursor
+
+# Enregistrer une allocation calculée en ne touchant que les cellules modifiées :
+# insertion des nouvelles, mise à jour des valeurs changées, suppression des allocations
+# tombées à 0%. Retourne le nombre de lignes écrites.
+def save_allocation(project, final_percent, final_amount):
+    phases = project.phases
+    intervenants = project.intervenants
+    phase_index = {phase.id: i for i, phase in enumerate(phases)}
+    intervenant_index = {intervenant.id: j for j, intervenant in enumerate(intervenants)}
+    
+    # Allocations enregistrées, sous forme de matrices (NaN = pas de ligne)
+    previous_percent = np.full(final_percent.shape, np.nan)
+    previous_amount = np.full(final_percent.shape, np.nan)
+    row_ids = {}
+    obsolete_ids = []
+    stored = db.session.execute(
+        db.select(PhaseIntervenant.id, PhaseIntervenant.phase_id, PhaseIntervenant.intervenant_id,
+                  PhaseIntervenant.final_percent, PhaseIntervenant.final_amount)
+        .where(PhaseIntervenant.project_id == project.id)
+    ).all()
+    for row in stored:
+        i = phase_index.get(row.phase_id)
+        j = intervenant_index.get(row.intervenant_id)
+        if i is None or j is None or (i, j) in row_ids:
+            # Phase ou intervenant d'un autre projet, ou doublon : la ligne n'a plus lieu d'être
+            obsolete_ids.append(row.id)
+            continue
+        row_ids[(i, j)] = row.id
+        previous_percent[i, j] = row.final_percent or 0.0
+        previous_amount[i, j] = row.final_amount or 0.0
+    
+    inserts, updates, deletes = diff_allocation(previous_percent, previous_amount,
+                                                final_percent, final_amount)
+    
+    new_rows = [
+        {
+            'project_id': project.id,
+            'phase_id': phases[i].id,
+            'intervenant_id': intervenants[j].id,
+            'final_percent': float(final_percent[i, j]),
+            'final_amount': float(final_amount[i, j])
+        }
+        for i, j in zip(*np.nonzero(inserts))
+    ]
+    changed_rows = [
+        {
+            'id': row_ids[(i, j)],
+            'final_percent': float(final_percent[i, j]),
+            'final_amount': float(final_amount[i, j])
+        }
+        for i, j in zip(*np.nonzero(updates))
+    ]
+    obsolete_ids.extend(row_ids[(i, j)] for i, j in zip(*np.nonzero(deletes)))
+    
+    if obsolete_ids:
+        PhaseIntervenant.query.filter(
+            PhaseIntervenant.id.in_(obsolete_ids)
+        ).delete(synchronize_session=False)
+    if changed_rows:
+        db.session.execute(db.update(PhaseIntervenant), changed_rows)
+    if new_rows:
+        db.session.execute(db.insert(PhaseIntervenant), new_rows)
+    
+    return len(new_rows) + len(changed_rows) + len(obsolete_ids)
+
+# Calculer l'allocation d'un projet (phases et intervenants chargés) et l'enregistrer
+# dans la transaction en cours. Retourne l'intervenant servant de variable d'ajustement.
+def recalculate_allocation(project, method=None):
+    recalculate_allocations([project], method=method)
+    names = [intervenant.name for intervenant in project.intervenants]
+    return project.intervenants[find_buffer_index(names)]
+
+# Calculer en un seul appel au moteur l'allocation de plusieurs projets (phases et
+# intervenants chargés, au moins un de chaque) et l'enregistrer dans la transaction
+# en cours, sauf si write=False. method : méthode de la troisième passe ('greedy' ou
+# 'solver', ALLOCATION_METHOD de la configuration par défaut).
+# Retourne les allocations {project_id: (pourcentages, montants)}.
+def recalculate_allocations(projects, write=True, method=None):
+    if not projects:
+        return {}
+    
+    # Grilles vérif de tous les projets en une requête (lignes ou blocs, voir grids.py)
+    verifs = load_grids('verif', projects)
+    
+    # Identifier l'intervenant MB (s'il existe) qui servira de variable d'ajustement par défaut
+    # Si MB n'existe pas, le dernier intervenant est utilisé comme variable d'ajustement
+    stacked = stack_projects(
+        (project.total_marche,
+         [phase.percentage for phase in project.phases],
+         verifs[project.id][0],
+         [intervenant.montant_verif for intervenant in project.intervenants],
+         find_buffer_index([intervenant.name for intervenant in project.intervenants]))
+        for project in projects
+    )
+    
+    # Calculer l'allocation (trois passes) de toute la pile avec le moteur vectorisé
+    with timed('allocation'):
+        final_percent, final_amount, feasible = allocate_batch(
+            *stacked, method=method or current_app.config.get('ALLOCATION_METHOD', 'greedy'), timer=timed)
+    
+    results = {}
+    grids = {}
+    for k, project in enumerate(projects):
+        n_phases = len(project.phases)
+        n_intervenants = len(project.intervenants)
+        results[project.id] = (final_percent[k, :n_phases, :n_intervenants],
+                               final_amount[k, :n_phases, :n_intervenants])
+        if write:
+            # Verrouiller le projet (version lue au chargement) avant toute écriture, puis
+            # n'écrire que les allocations qui ont changé depuis le dernier calcul
+            lock_project(project)
+            save_allocation(project, *results[project.id])
+            refresh_summary(project, calculated=True, feasible=bool(feasible[k]))
+            # Bloc de l'allocation : mêmes cellules que les lignes (pourcentage > 0)
+            allocated = results[project.id][0] > 0
+            grids[project.id] = (*project_axes(project),
+                                 np.where(allocated, np.stack(results[project.id]), np.nan))
+    store_grids('allocation', grids)
+    return results
+
+# Totaux par intervenant d'une allocation (P, I) du projet : montant alloué, écart et
+# écart en % par rapport au montant vérif global
+def allocation_totals(project, amount):
+    montant_verif = np.array([intervenant.montant_verif for intervenant in project.intervenants], dtype=float)
+    total, ecart, ecart_percent = intervenant_totals(amount[None], montant_verif[None])
+    return total[0], ecart[0], ecart_percent[0]
+
+# Enregistrer un seul montant vérif (None = cellule vidée) dans la transaction en cours :
+# une seule ligne écrite et le total vérif de l'intervenant mis à jour. Avec
+# recalculate=True, l'allocation est recalculée dans la même transaction : la troisième
+# passe lie les phases d'un intervenant, le calcul porte donc sur tout le projet, mais
+# seules les cellules d'allocation modifiées sont écrites.
+# Retourne None si la cellule n'a pas changé, sinon le total vérif de l'intervenant et
+# l'allocation recalculée (pourcentages, montants) ou None.
+def save_verif_cell(project, phase_id, intervenant_id, montant_verif, recalculate=False):
+    rows = db.session.execute(
+        db.select(PhaseIntervenantVerif.id, PhaseIntervenantVerif.montant_verif)
+        .where(PhaseIntervenantVerif.project_id == project.id,
+               PhaseIntervenantVerif.phase_id == phase_id,
+               PhaseIntervenantVerif.intervenant_id == intervenant_id)
+        .order_by(PhaseIntervenantVerif.id)
+    ).all()
+    
+    # Doublons éventuels (bases antérieures à la contrainte d'unicité) : garder le dernier
+    obsolete_ids = [row.id for row in rows[:-1]]
+    row = rows[-1] if rows else None
+    current = row.montant_verif if row is not None else None
+    if current == montant_verif and not obsolete_ids:
+        return None
+    if montant_verif is None:
+        obsolete_ids.append(row.id)
+    elif row is None:
+        db.session.execute(db.insert(PhaseIntervenantVerif), [{'project_id': project.id,
+                                                               'phase_id': phase_id,
+                                                               'intervenant_id': intervenant_id,
+                                                               'montant_verif': montant_verif}])
+    elif current != montant_verif:
+        db.session.execute(db.update(PhaseIntervenantVerif), [{'id': row.id, 'montant_verif': montant_verif}])
+    if obsolete_ids:
+        PhaseIntervenantVerif.query.filter(
+            PhaseIntervenantVerif.id.in_(obsolete_ids)
+        ).delete(synchronize_session=False)
+    
+    if packed_storage():
+        # Bloc de la grille : la grille enregistrée, cellule remplacée
+        phase_ids, intervenant_ids = project_axes(project)
+        verif = verif_matrix(project).copy()
+        verif[phase_ids.index(phase_id), intervenant_ids.index(intervenant_id)] = \
+            np.nan if montant_verif is None else montant_verif
+        store_grids('verif', {project.id: (phase_ids, intervenant_ids, verif[None])})
+    
+    total_verif = refresh_verif_total(project, intervenant_id)
+    allocation = recalculate_allocations([project])[project.id] if recalculate else None
+    return total_verif, allocation
+
+# Enregistrer une grille de montants vérif {(phase_id, intervenant_id): montant ou None}
+# en la comparant à la grille enregistrée : seules les cellules modifiées donnent lieu
+# à une insertion, une mise à jour ou une suppression. Retourne le nombre de lignes écrites.
+def save_verif_grid(project, submitted):
+    stored = db.session.execute(
+        db.select(PhaseIntervenantVerif.id, PhaseIntervenantVerif.phase_id,
+                  PhaseIntervenantVerif.intervenant_id, PhaseIntervenantVerif.montant_verif)
+        .where(PhaseIntervenantVerif.project_id == project.id)
+    ).all()
+    
+    new_rows = []
+    changed_rows = []
+    obsolete_ids = []
+    existing = {}
+    for row in stored:
+        # Doublons éventuels (bases antérieures à la contrainte d'unicité) : garder le dernier
+        previous = existing.get((row.phase_id, row.intervenant_id))
+        if previous is not None:
+            obsolete_ids.append(previous.id)
+        existing[(row.phase_id, row.intervenant_id)] = row
+    
+    for (phase_id, intervenant_id), montant_verif in submitted.items():
+        row = existing.get((phase_id, intervenant_id))
+        current = row.montant_verif if row is not None else None
+        if current == montant_verif:
+            continue
+        if montant_verif is None:
+            obsolete_ids.append(row.id)
+        elif row is None:
+            new_rows.append({'project_id': project.id,
+                             'phase_id': phase_id,
+                             'intervenant_id': intervenant_id,
+                             'montant_verif': montant_verif})
+        else:
+            changed_rows.append({'id': row.id, 'montant_verif': montant_verif})
+    
+    if obsolete_ids:
+        PhaseIntervenantVerif.query.filter(
+            PhaseIntervenantVerif.id.in_(obsolete_ids)
+        ).delete(synchronize_session=False)
+    if changed_rows:
+        db.session.execute(db.update(PhaseIntervenantVerif), changed_rows)
+    if new_rows:
+        db.session.execute(db.insert(PhaseIntervenantVerif), new_rows)
+    
+    written = len(new_rows) + len(changed_rows) + len(obsolete_ids)
+    if written:
+        # Bloc de la grille : cellules enregistrées, remplacées par celles du formulaire
+        cells = {key: row.montant_verif for key, row in existing.items()}
+        cells.update(submitted)
+        phase_ids, intervenant_ids = project_axes(project)
+        verif = build_verif_matrix(phase_ids, intervenant_ids,
+                                   ((phase_id, intervenant_id, montant_verif)
+                                    for (phase_id, intervenant_id), montant_verif in cells.items()))
+        store_grids('verif', {project.id: (phase_ids, intervenant_ids, verif[None])})
+    return written
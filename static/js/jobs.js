@@ -0,0 +1,35 @@
+// Suivi d'une tâche de recalcul en arrière-plan : la page reçoit ?job=<id> après le
+// lancement du calcul et interroge la route d'avancement jusqu'à la fin de la tâche.
+(function () {
+    const panel = document.getElementById('job-status');
+    const jobId = new URLSearchParams(window.location.search).get('job');
+    if (!panel || !jobId) {
+        return;
+    }
+    const message = panel.querySelector('.job-message');
+    const progress = panel.querySelector('.progress-bar');
+    panel.classList.remove('d-none');
+
+    function poll() {
+        fetch(panel.dataset.statusUrl.replace('{job_id}', encodeURIComponent(jobId)))
+            .then(function (response) { return response.json(); })
+            .then(function (job) {
+                const processed = job.done + job.skipped + job.failed;
+                progress.style.width = Math.round(job.progress * 100) + '%';
+                if (job.status === 'pending' || job.status === 'running') {
+                    message.textContent = 'Calcul en cours : ' + processed + ' / ' + (job.total || '?') + ' projet(s)';
+                    setTimeout(poll, 1000);
+                    return;
+                }
+                if (panel.dataset.reload && job.status === 'done') {
+                    // Recharger la page sans le paramètre job pour afficher le résultat
+                    window.location.replace(window.location.pathname);
+                    return;
+                }
+                panel.classList.replace('alert-info', job.status === 'done' ? 'alert-success' : 'alert-danger');
+                message.textContent = 'Calcul terminé : ' + job.done + ' recalculé(s), ' + job.skipped
+                    + ' ignoré(s), ' + job.failed + ' en erreur.' + (job.errors.length ? ' ' + job.errors.join(' ; ') : '');
+            });
+    }
+    poll();
+})();
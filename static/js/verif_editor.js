@@ -0,0 +1,90 @@
+// Éditeur de la grille vérif : chaque cellule modifiée est enregistrée seule (PATCH) et
+// la réponse ne remplace que la ligne de la phase et le total de l'intervenant, sans
+// recharger la page. La version du projet renvoyée est reprise dans le formulaire, qui
+// peut toujours être envoyé en entier.
+(function () {
+    const form = document.getElementById('verif-form');
+    if (!form || !window.fetch) {
+        return;
+    }
+    const version = form.querySelector('input[name="version"]');
+    const recalculate = document.getElementById('verif-recalculate');
+    // Une seule requête à la fois : les modifications suivantes attendent leur tour
+    let queue = Promise.resolve();
+
+    function showStatus(className, text) {
+        const status = document.getElementById('verif-cell-status');
+        status.className = 'alert ' + className;
+        status.textContent = text;
+    }
+
+    function replaceById(fragment, id) {
+        const current = document.getElementById(id);
+        const updated = fragment.querySelector('#' + id);
+        if (current && updated) {
+            current.replaceWith(updated);
+        }
+        return updated;
+    }
+
+    function save(input) {
+        const body = new URLSearchParams({
+            montant_verif: input.value,
+            version: version.value,
+            recalculate: recalculate && recalculate.checked ? '1' : '0'
+        });
+        input.classList.remove('is-invalid');
+        const url = form.dataset.cellUrl
+            .replace('{phase_id}', input.dataset.phase)
+            .replace('{intervenant_id}', input.dataset.intervenant);
+        return fetch(url, {
+            method: 'PATCH',
+            body: body,
+            headers: {'Accept': 'text/html'}
+        }).then(function (response) {
+            return response.text().then(function (text) {
+                if (!response.ok) {
+                    input.classList.add('is-invalid');
+                    showStatus('alert-danger', text);
+                    return;
+                }
+                const template = document.createElement('template');
+                template.innerHTML = text;
+                const fragment = template.content;
+                version.value = fragment.querySelector('table').dataset.version;
+                replaceById(fragment, 'verif-total-' + input.dataset.intervenant);
+                // La cellule en cours de saisie dans la ligne remplacée garde sa valeur et le focus
+                const focused = document.activeElement;
+                const editing = focused && focused.classList.contains('verif-cell') ? focused : null;
+                const row = replaceById(fragment, 'verif-row-' + input.dataset.phase);
+                const target = row && editing && row.querySelector('input[name="' + editing.name + '"]');
+                if (target) {
+                    target.value = editing.value;
+                    target.focus();
+                }
+                if (!replaceById(fragment, 'verif-cell-status')) {
+                    showStatus('d-none', '');
+                }
+            });
+        }).catch(function () {
+            input.classList.add('is-invalid');
+            showStatus('alert-danger', "Enregistrement impossible : vérifiez la connexion et réessayez");
+        });
+    }
+
+    // "change" : à la sortie du champ ou sur Entrée, une fois la saisie terminée
+    form.addEventListener('change', function (event) {
+        const input = event.target;
+        if (!input.classList.contains('verif-cell')) {
+            return;
+        }
+        queue = queue.then(function () { return save(input); });
+    });
+    // Entrée enregistre la cellule (en quittant le champ) au lieu d'envoyer toute la grille
+    form.addEventListener('keydown', function (event) {
+        if (event.key === 'Enter' && event.target.classList.contains('verif-cell')) {
+            event.preventDefault();
+            event.target.blur();
+        }
+    });
+})();
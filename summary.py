@@ -0,0 +1,172 @@
+# summary.py
+# Totaux matérialisés des projets et des intervenants. Les routes d'écriture appellent
+# refresh_summary() avant leur commit : les pages de lecture n'ont plus qu'à lire
+# une ligne par projet et par intervenant. Les projets créés en masse (import, générateur
+# de données) ont leurs totaux insérés avec eux, ceux d'une base plus ancienne sont créés
+# par 'flask migrate-db' : les pages de lecture n'écrivent jamais.
+from datetime import datetime, timezone
+
+from models import db, Project, Phase, Intervenant, PhaseIntervenant, PhaseIntervenantVerif, \
+    ProjectSummary, IntervenantSummary
+
+
+def utc_now():
+    # Dates enregistrées en UTC (sans fuseau), comme Project.updated_at
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def summary_rows(project_id, total_marche, phases_total_percent, intervenants):
+    # Totaux d'un projet à partir de ses intervenants
+    # [(id, montant_verif, total_verif_detail, total_amount)]
+    # -> (valeurs de ProjectSummary, lignes d'IntervenantSummary)
+    rows = []
+    for intervenant_id, montant_verif, total_verif_detail, total_amount in intervenants:
+        if montant_verif:
+            ecart = total_amount - montant_verif
+            ecart_percent = ecart / montant_verif * 100
+        else:
+            ecart = 0.0
+            ecart_percent = 0.0
+        rows.append({
+            'intervenant_id': intervenant_id,
+            'project_id': project_id,
+            'total_verif_detail': total_verif_detail,
+            'total_amount': total_amount,
+            'ecart': ecart,
+            'ecart_percent': ecart_percent,
+        })
+    values = {
+        'phases_total_percent': phases_total_percent,
+        'phases_total_amount': total_marche * phases_total_percent / 100,
+        'intervenants_total_verif': sum(montant_verif or 0.0 for _, montant_verif, _, _ in intervenants),
+        'allocation_total_amount': sum(row['total_amount'] for row in rows),
+    }
+    return values, rows
+
+
+def compute_summary(project):
+    # Totaux du projet lus dans la base, sans rien enregistrer
+    phases_total_percent = db.session.execute(
+        db.select(db.func.coalesce(db.func.sum(Phase.percentage), 0.0))
+        .where(Phase.project_id == project.id)
+    ).scalar_one()
+
+    verif_totals = (
+        db.select(PhaseIntervenantVerif.intervenant_id,
+                  db.func.sum(PhaseIntervenantVerif.montant_verif).label('total'))
+        .where(PhaseIntervenantVerif.project_id == project.id)
+        .group_by(PhaseIntervenantVerif.intervenant_id)
+        .subquery()
+    )
+    allocation_totals = (
+        db.select(PhaseIntervenant.intervenant_id,
+                  db.func.sum(PhaseIntervenant.final_amount).label('total'))
+        .where(PhaseIntervenant.project_id == project.id)
+        .group_by(PhaseIntervenant.intervenant_id)
+        .subquery()
+    )
+    intervenants = db.session.execute(
+        db.select(Intervenant.id,
+                  Intervenant.montant_verif,
+                  db.func.coalesce(verif_totals.c.total, 0.0).label('total_verif_detail'),
+                  db.func.coalesce(allocation_totals.c.total, 0.0).label('total_amount'))
+        .outerjoin(verif_totals, verif_totals.c.intervenant_id == Intervenant.id)
+        .outerjoin(allocation_totals, allocation_totals.c.intervenant_id == Intervenant.id)
+        .where(Intervenant.project_id == project.id)
+    ).all()
+    return summary_rows(project.id, project.total_marche, phases_total_percent, intervenants)
+
+
+def refresh_summary(project, calculated=False, feasible=None):
+    # Recalculer les totaux du projet à partir de la base (dans la transaction en cours).
+    # calculated=True enregistre la date du calcul d'allocation et son verdict (feasible).
+    now = utc_now()
+    values, rows = compute_summary(project)
+
+    # Une ligne par intervenant : on remplace celles du projet
+    IntervenantSummary.query.filter_by(project_id=project.id).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(db.insert(IntervenantSummary), rows)
+
+    summary = db.session.get(ProjectSummary, project.id)
+    if summary is None:
+        summary = ProjectSummary(project_id=project.id)
+        db.session.add(summary)
+    for name, value in values.items():
+        setattr(summary, name, value)
+    summary.updated_at = now
+    if calculated:
+        summary.calculated_at = now
+        summary.allocation_feasible = feasible
+    return summary
+
+
+def insert_new_summaries(projects):
+    # Totaux de projets qui viennent d'être insérés, sans allocation (import en masse) :
+    # projects = [(project_id, total_marche, phases_total_percent,
+    #              [(intervenant_id, montant_verif, total_verif_detail)])]
+    now = utc_now()
+    project_rows = []
+    intervenant_rows = []
+    for project_id, total_marche, phases_total_percent, intervenants in projects:
+        values, rows = summary_rows(project_id, total_marche, phases_total_percent,
+                                    [(*intervenant, 0.0) for intervenant in intervenants])
+        project_rows.append({'project_id': project_id, 'updated_at': now, **values})
+        intervenant_rows.extend(rows)
+    if project_rows:
+        db.session.execute(db.insert(ProjectSummary), project_rows)
+    if intervenant_rows:
+        db.session.execute(db.insert(IntervenantSummary), intervenant_rows)
+
+
+def refresh_verif_total(project, intervenant_id):
+    # Après la modification d'une seule cellule vérif : seul le total vérif détaillé de
+    # l'intervenant change. Retourne ce total.
+    total = db.session.execute(
+        db.select(db.func.coalesce(db.func.sum(PhaseIntervenantVerif.montant_verif), 0.0))
+        .where(PhaseIntervenantVerif.project_id == project.id,
+               PhaseIntervenantVerif.intervenant_id == intervenant_id)
+    ).scalar_one()
+    updated = db.session.execute(
+        db.update(IntervenantSummary)
+        .where(IntervenantSummary.project_id == project.id,
+               IntervenantSummary.intervenant_id == intervenant_id)
+        .values(total_verif_detail=total)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if updated:
+        db.session.execute(db.update(ProjectSummary).where(ProjectSummary.project_id == project.id)
+                           .values(updated_at=utc_now())
+                           .execution_options(synchronize_session=False))
+    else:
+        # Totaux pas encore créés (projet importé ou généré)
+        refresh_summary(project)
+    return total
+
+
+def get_summary(project):
+    # Totaux du projet. Sans ligne enregistrée (base pas encore passée par
+    # 'flask migrate-db'), ils sont calculés sans être enregistrés.
+    if project.summary is not None:
+        return project.summary
+    values, _ = compute_summary(project)
+    return ProjectSummary(project_id=project.id, updated_at=utc_now(), **values)
+
+
+def intervenant_summaries(project):
+    # Totaux par intervenant {intervenant_id: IntervenantSummary}, calculés sans être
+    # enregistrés comme dans get_summary() si le projet n'en a pas encore
+    if project.summary is None:
+        _, rows = compute_summary(project)
+        return {row['intervenant_id']: IntervenantSummary(**row) for row in rows}
+    return {intervenant.id: intervenant.summary for intervenant in project.intervenants
+            if intervenant.summary is not None}
+
+
+def refresh_missing_summaries():
+    # Créer les totaux des projets qui n'en ont pas encore ; retourne leur nombre
+    projects = Project.query.filter(~Project.summary.has()).all()
+    for project in projects:
+        refresh_summary(project)
+    db.session.commit()
+    return len(projects)